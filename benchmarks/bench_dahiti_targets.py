@@ -0,0 +1,55 @@
+## Time the per target and the columnar construction of the DAHITI target catalogue
+## usage: python benchmarks/bench_dahiti_targets.py
+
+import time
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from shapely import Point
+from pyaltim.portals.dahiti import dahitiTargets2gdf
+
+def syntheticDahitiTargets(n,seed=0):
+    """Generate n synthetic list-targets entries"""
+    rng=np.random.default_rng(seed)
+    lon=rng.uniform(-180,180,n)
+    lat=rng.uniform(-60,80,n)
+    products=["water_level_altimetry","water_level_hypsometry","surface_area","volume_variation"]
+    access=rng.choice([None,"public","restricted"],size=(n,len(products)),p=[0.5,0.4,0.1])
+    return [dict(dahiti_id=i,target_name=f"target {i}",type="river",longitude=lon[i],latitude=lat[i],data_access=dict(zip(products,access[i]))) for i in range(n)]
+
+def dahitiTargets2gdfLoop(targets,geom=None):
+    """Former per target construction of the catalogue"""
+    exportkeys=[ky for ky in targets[0].keys() if ky not in ['longitude','latitude','data_access']]
+    dfdict={colky:[val[colky] for val in targets] for colky in exportkeys}
+    dfdict['data_access']=[[f"{ky}:{da}" for ky,da in target['data_access'].items() if da is not None] for target in targets]
+    targetpoints=[Point(data['longitude'],data['latitude']) for data in targets]
+    gdftargets= gpd.GeoDataFrame(dfdict,geometry=targetpoints)
+    if geom is not None:
+        gdftargets=gdftargets[gdftargets.within(geom)]
+    gdftargets=gdftargets.explode('data_access')
+    gdftargets.set_crs('EPSG:4326',inplace=True)
+    return gdftargets
+
+def benchmarkTargets2gdf(sizes=(1000,10000,100000),geom=None,repeat=3):
+    """Time both constructions for increasing numbers of synthetic targets
+    returns:
+        A dataframe with the best timings (s) per catalogue size
+    """
+    rows=[]
+    for n in sizes:
+        targets=syntheticDahitiTargets(n)
+        tloop=np.inf
+        tcol=np.inf
+        for i in range(repeat):
+            t0=time.perf_counter()
+            gdfloop=dahitiTargets2gdfLoop(targets,geom)
+            tloop=min(tloop,time.perf_counter()-t0)
+            t0=time.perf_counter()
+            gdfcol=dahitiTargets2gdf(targets,geom)
+            tcol=min(tcol,time.perf_counter()-t0)
+        assert len(gdfloop) == len(gdfcol)
+        rows.append(dict(ntargets=n,nrows=len(gdfcol),loop=tloop,columnar=tcol,speedup=tloop/tcol))
+    return pd.DataFrame(rows)
+
+if __name__ == "__main__":
+    print(benchmarkTargets2gdf().to_string(index=False))
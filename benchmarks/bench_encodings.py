@@ -0,0 +1,47 @@
+## Compare the size and the encoding/decoding time of the JSON and Arrow encodings of station series
+## usage: python benchmarks/bench_encodings.py
+
+import json
+import time
+import numpy as np
+import pandas as pd
+import xarray as xr
+from pyaltim.geoslurp.types import ds2arrow,arrow2ds
+
+def syntheticSeries(n=1000,seed=0):
+    """Synthetic water level series of n epochs"""
+    rng=np.random.default_rng(seed)
+    time=pd.date_range("2002-01-01",periods=n,freq="10D")
+    return xr.Dataset(dict(water_level=("time",100+rng.normal(0,1,n)),wl_err=("time",np.abs(rng.normal(0,0.1,n)))),coords=dict(time=time),attrs=dict(source="synthetic"))
+
+def benchmarkEncodings(sizes=(100,1000,10000),repeat=5):
+    """Time both encodings for increasing series lengths
+    The JSON encoding is measured as the text of the dataset dictionary, which is what ends up in the jsonb column
+
+    returns:
+        A dataframe with the sizes (bytes) and best timings (s) per series length
+    """
+    rows=[]
+    for n in sizes:
+        ds=syntheticSeries(n)
+        timing={}
+        for name,enc,dec in [("json",lambda ds: json.dumps(ds.to_dict(),default=str),lambda txt: xr.Dataset.from_dict(json.loads(txt))),("arrow",ds2arrow,arrow2ds)]:
+            tenc=np.inf
+            tdec=np.inf
+            for i in range(repeat):
+                t0=time.perf_counter()
+                blob=enc(ds)
+                tenc=min(tenc,time.perf_counter()-t0)
+                t0=time.perf_counter()
+                dec(blob)
+                tdec=min(tdec,time.perf_counter()-t0)
+            timing[name]=(len(blob),tenc,tdec)
+        rows.append(dict(nepochs=n,json_bytes=timing["json"][0],arrow_bytes=timing["arrow"][0],json_encode=timing["json"][1],arrow_encode=timing["arrow"][1],
+            json_decode=timing["json"][2],arrow_decode=timing["arrow"][2]))
+    df=pd.DataFrame(rows)
+    df["size_ratio"]=df.json_bytes/df.arrow_bytes
+    df["decode_speedup"]=df.json_decode/df.arrow_decode
+    return df
+
+if __name__ == "__main__":
+    print(benchmarkEncodings().to_string(index=False))
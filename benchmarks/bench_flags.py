@@ -0,0 +1,34 @@
+## Compare scalar per-sample decoding of the RADS flags with the vectorized decoding
+## usage: python benchmarks/bench_flags.py
+
+import time
+import numpy as np
+from pyaltim.rads.flags import RadsFlags,radsflagbits
+
+def isSetScalar(x,n):
+    return x & 1 << n != 0
+
+def benchmarkFlags(n=2000000,repeat=3,seed=0):
+    """Time the scalar and vectorized decoding of the land/ice/rain bits
+    returns:
+        dictionary with the best timings (s) and the speedup
+    """
+    rng=np.random.default_rng(seed)
+    flags=rng.integers(0,2**16,n).astype(np.int32)
+    bits=[radsflagbits[name] for name in ("land","ice","rain")]
+    tscalar=np.inf
+    tvector=np.inf
+    for i in range(repeat):
+        t0=time.perf_counter()
+        scalar=[[isSetScalar(flag,bit) for flag in flags] for bit in bits]
+        tscalar=min(tscalar,time.perf_counter()-t0)
+        t0=time.perf_counter()
+        fl=RadsFlags(flags)
+        vector=[fl.land,fl.ice,fl.rain]
+        tvector=min(tvector,time.perf_counter()-t0)
+    for sc,vec in zip(scalar,vector):
+        assert np.array_equal(np.asarray(sc),vec)
+    return dict(nsamples=n,scalar=tscalar,vectorized=tvector,speedup=tscalar/tvector)
+
+if __name__ == "__main__":
+    print(benchmarkFlags())
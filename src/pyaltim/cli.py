@@ -0,0 +1,254 @@
+## Command line interface of pyaltim (e.g. for scheduled bulk synchronization of stations)
+
+import argparse
+import io
+import os
+import sys
+import threading
+import time
+from datetime import datetime,timedelta
+import pandas as pd
+import geopandas as gpd
+from pyaltim.core.logging import altlogger, altmetrics, logMetrics, setDebugLevel
+from pyaltim.core.pipeline import StagedPipeline
+from pyaltim.core.syncqueue import SyncQueue
+from pyaltim.core.ratelimit import setRateLimit
+from pyaltim.portals.api import setBatchMode
+
+portals=["dahiti","hydrosat","hydroweb"]
+
+#default products per portal
+defaultproducts={"dahiti":["water_level_altimetry"],"hydrosat":["WL"],"hydroweb":["HYDROWEB_RIVERS_OPE","HYDROWEB_LAKES_OPE"]}
+
+
+class Progress:
+    """Periodically log the throughput and the estimated time to completion of a synchronization
+    Parameters
+    ----------
+    name : name used in the messages
+    total : number of stations to process (None when unknown)
+    interval : seconds between reports
+    """
+    def __init__(self,name,total=None,interval=10):
+        self.name=name
+        self.total=total
+        self.interval=interval
+        self._stop=threading.Event()
+
+    def counts(self):
+        """Number of written and failed stations so far"""
+        mdict=altmetrics.to_dict()
+        done=mdict["histograms"].get(f"{self.name}.write",{}).get("count",0)
+        failed=sum(mdict["counters"].get(f"{self.name}.{counter}",0) for counter in ("notfound","transient","failed"))
+        return done,failed
+
+    def report(self):
+        done,failed=self.counts()
+        elapsed=time.monotonic()-self.t0
+        rate=(done+failed)/elapsed if elapsed > 0 else 0.0
+        mbytes=altmetrics.to_dict()["counters"].get(f"{self.name}.bytes",0)/1e6
+        msg=f"{self.name}: {done} written, {failed} failed"
+        if self.total is not None:
+            msg+=f" of {self.total}"
+        msg+=f", {rate:.2f} stations/s, {mbytes:.1f} MB"
+        if self.total is not None and rate > 0:
+            eta=timedelta(seconds=int((self.total-done-failed)/rate))
+            msg+=f", ETA {eta}"
+        altlogger.info(msg)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.report()
+
+    def __enter__(self):
+        self.t0=time.monotonic()
+        self._thread=threading.Thread(target=self._run,daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self._stop.set()
+        self._thread.join()
+        return False
+
+
+def readAoi(aoifile):
+    """Read an area of interest file (any OGR format) as a single geometry in EPSG:4326"""
+    if aoifile is None:
+        return None
+    gdf=gpd.read_file(aoifile)
+    if gdf.crs is not None:
+        gdf=gdf.to_crs(4326)
+    return gdf.geometry.union_all()
+
+
+def _envcred(var):
+    """Credentials are taken from the environment (the connectors only prompt for missing ones in interactive sessions)"""
+    return os.environ.get(var)
+
+def portalTargets(portal,product,aoi,cachedir):
+    """Return the target ids, their upstream end time (or None) and the fetch and parse functions of a portal product"""
+    if portal == "dahiti":
+        from pyaltim.portals.dahiti import DahitiConnect
+        con=DahitiConnect(_envcred("DAHITI_APIKEY"))
+        gdf=con.list_targets(aoi)
+        gdf=gdf[gdf.data_access == f"{product}:public"].drop_duplicates("dahiti_id")
+        #the last update of a target marks new data upstream
+        tends=gdf.last_update.tolist() if "last_update" in gdf.columns else None
+        return gdf.dahiti_id.tolist(),tends,con.fetch_waterlevel,lambda dah_id,raw: con.parse_waterlevel(raw,dah_id)
+    elif portal == "hydrosat":
+        from pyaltim.portals.hydrosat import HydrosatConnect
+        con=HydrosatConnect(_envcred("HYDROSAT_USER"),_envcred("HYDROSAT_PASSWORD"),cachedir=os.path.join(cachedir,"hydrosat"))
+        gdf=con.list_targets(aoi)
+        gdf=gdf[gdf.data_type == product].drop_duplicates("hyd_no")
+        return gdf.hyd_no.tolist(),None,lambda hyd_no: con.download_by_product(hyd_no,product),lambda hyd_no,fout: con.parse_hydrosat_txt(fout)
+    elif portal == "hydroweb":
+        from pyaltim.portals.hydroweb import HydrowebConnect
+        con=HydrowebConnect(collection_id=product,apikey=_envcred("HYDROWEB_APIKEY"))
+        gdf=con.get_items(aoi)
+        asseturls=dict(zip(gdf.item_id,gdf.asset_href))
+        def fetch(item_id):
+            asseturl=asseturls.get(item_id)
+            return con.download_asset(item_id,None if pd.isnull(asseturl) else asseturl)
+        return gdf.item_id.tolist(),gdf.updated.fillna(gdf.tend).tolist(),fetch,lambda item_id,text: con.readasset(io.StringIO(text))
+    raise ValueError(f"Unknown portal {portal}, choose from {portals}")
+
+
+def writeNetcdf(outdir,station,info,ds):
+    """Write a station series with its info as attributes to <outdir>/<station>.nc"""
+    ds=ds.copy()
+    ds["time"]=pd.to_datetime(ds.time.values)
+    ds.attrs.update({ky:str(val) for ky,val in info.items()})
+    fout=os.path.join(outdir,f"{station}.nc")
+    ds.to_netcdf(fout+".tmp")
+    os.replace(fout+".tmp",fout)
+
+
+def syncFiles(portal,product,aoi,cachedir,outdir,workers,maxage,maxtargets):
+    """Synchronize the stations of a portal product to netcdf files"""
+    targets,tends,fetch,parse=portalTargets(portal,product,aoi,cachedir)
+    syncq=SyncQueue(os.path.join(cachedir,f"{portal}_{product}_syncqueue.sqlite"))
+    syncq.update(targets,tends=tends,stalebefore=datetime.now()-maxage)
+    selected=syncq.next(maxtargets)
+    proddir=os.path.join(outdir,portal,product)
+    os.makedirs(proddir,exist_ok=True)
+
+    def write(station,result):
+        info,ds=result
+        writeNetcdf(proddir,station,info,ds)
+        syncq.markdone(station)
+
+    pipeline=StagedPipeline(fetch,parse,write,nfetch=workers,name=portal,onerror=syncq.markfailed)
+    with Progress(portal,total=len(selected)):
+        pipeline.run(selected)
+    return dict(targets=len(targets),skipped=len(targets)-len(selected),stopped=pipeline.stopped)
+
+
+def syncDatabase(portal,product,aoi,workers,maxtargets):
+    """Synchronize the stations of a portal product into the geoslurp database"""
+    from geoslurp.db import geoslurpConnect
+    if portal == "dahiti":
+        from pyaltim.geoslurp.dahiti import getDahitiDsets as getdsets
+    elif portal == "hydrosat":
+        from pyaltim.geoslurp.hydrosat import getHydroSatDsets as getdsets
+    else:
+        from pyaltim.geoslurp.hydroweb import getHydroWebDsets as getdsets
+    dsets=[cls for cls in getdsets(None) if getattr(cls,"product",None) == product and hasattr(cls,"register") and hasattr(cls,"syncqueue")]
+    if len(dsets) == 0:
+        raise ValueError(f"No geoslurp dataset found for {portal} product {product}")
+    dset=dsets[0](geoslurpConnect())
+    #update the holdings of the portal first
+    dset.pull()
+    #the queue stores naive UTC times
+    t0=pd.Timestamp.now(tz="UTC").tz_localize(None)
+    with Progress(portal):
+        dset.register(geom=aoi,nfetch=workers,maxtargets=maxtargets)
+    status=dset.syncqueue().status()
+    attempted=pd.to_datetime(status.lastattempt) >= t0
+    return dict(targets=len(status),skipped=int((~attempted).sum()),stopped=False)
+
+
+def portalProducts(portal,products):
+    """Select the products of a portal from a list of 'portal:product' or 'product' entries"""
+    if not products:
+        return defaultproducts[portal]
+    out=[]
+    for product in products:
+        if ":" in product:
+            prodportal,product=product.split(":",1)
+            if prodportal != portal:
+                continue
+        out.append(product)
+    return out
+
+def sync(args):
+    #never prompt when running unattended (e.g. from cron)
+    setBatchMode(not sys.stdin.isatty())
+    cachedir=os.path.abspath(args.cachedir)
+    os.makedirs(cachedir,exist_ok=True)
+    aoi=readAoi(args.aoi)
+    maxage=timedelta(days=args.maxage)
+    summary=[]
+    for portal in args.portals:
+        if args.rate is not None:
+            setRateLimit(portal,args.rate)
+        products=portalProducts(portal,args.products)
+        for product in products:
+            altlogger.info(f"Synchronizing {portal} {product}")
+            t0=time.monotonic()
+            before=altmetrics.to_dict()
+            try:
+                if args.sink == "db":
+                    res=syncDatabase(portal,product,aoi,args.workers,args.maxtargets)
+                else:
+                    res=syncFiles(portal,product,aoi,cachedir,args.outdir,args.workers,maxage,args.maxtargets)
+                error=None
+            except Exception as exc:
+                altlogger.error(f"Synchronization of {portal} {product} failed: {exc}")
+                res=dict(targets=None,skipped=None,stopped=True)
+                error=str(exc)
+            after=altmetrics.to_dict()
+            def delta(section,ky,field=None):
+                aft=after[section].get(ky,{} if field else 0)
+                bef=before[section].get(ky,{} if field else 0)
+                return (aft.get(field,0)-bef.get(field,0)) if field else aft-bef
+            summary.append(dict(portal=portal,product=product,targets=res["targets"],
+                fetched=delta("histograms",f"{portal}.write","count"),skipped=res["skipped"],
+                failed=sum(delta("counters",f"{portal}.{counter}") for counter in ("notfound","transient","failed")),bytes=delta("counters",f"{portal}.bytes"),
+                elapsed=round(time.monotonic()-t0,1),stopped=res["stopped"],error=error))
+
+    dfsum=pd.DataFrame(summary)
+    print(dfsum.to_string(index=False))
+    if args.metrics is not None:
+        logMetrics(args.metrics)
+    return 1 if dfsum.error.notna().any() else 0
+
+
+def main(argv=None):
+    parser=argparse.ArgumentParser(prog="pyaltim",description="Tools to work with satellite radar altimetry")
+    subparsers=parser.add_subparsers(dest="command",required=True)
+
+    syncparser=subparsers.add_parser("sync",help="Download new and updated stations of the altimetry portals",
+            epilog="Credentials are read from DAHITI_APIKEY, HYDROSAT_USER, HYDROSAT_PASSWORD and HYDROWEB_APIKEY (or prompted for)")
+    syncparser.add_argument("--portals",nargs="+",choices=portals,default=portals,help="portals to synchronize")
+    syncparser.add_argument("--products",nargs="+",help="products to synchronize, as product or portal:product (default: "+", ".join(f"{ky}: {' '.join(val)}" for ky,val in defaultproducts.items())+")")
+    syncparser.add_argument("--aoi",help="file with the area of interest (any OGR readable vector file)")
+    syncparser.add_argument("--workers",type=int,default=4,help="number of concurrent downloads per portal")
+    syncparser.add_argument("--rate",type=float,help="maximum number of requests per second per portal")
+    syncparser.add_argument("--cachedir",default="pyaltim_cache",help="directory for the inventories and the synchronization queues")
+    syncparser.add_argument("--sink",choices=["files","db"],default="files",help="write netcdf files to --outdir or upsert into the geoslurp database")
+    syncparser.add_argument("--outdir",default="pyaltim_data",help="output directory of the files sink")
+    syncparser.add_argument("--maxage",type=float,default=30,help="refresh unchanged stations after this many days (files sink)")
+    syncparser.add_argument("--maxtargets",type=int,help="maximum number of stations per product in this run")
+    syncparser.add_argument("--metrics",help="write the collected metrics to this json file")
+    syncparser.add_argument("--debug",action="store_true",help="verbose logging")
+    syncparser.set_defaults(func=sync)
+
+    args=parser.parse_args(argv)
+    if getattr(args,"debug",False):
+        setDebugLevel()
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
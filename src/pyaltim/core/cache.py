@@ -0,0 +1,107 @@
+## In-process LRU cache of decoded station series, bounded by memory size
+
+import os
+import sys
+import threading
+from collections import OrderedDict
+from pyaltim.core.logging import altlogger, altmetrics
+
+
+def resultSize(result):
+    """Approximate memory size (bytes) of an (info,dataset) tuple"""
+    info,ds=result
+    return int(ds.nbytes)+sys.getsizeof(str(info))
+
+def fileFingerprint(path):
+    """Fingerprint of a local source file (changes when the file is rewritten)"""
+    stat=os.stat(path)
+    return f"{stat.st_mtime_ns}:{stat.st_size}"
+
+
+class StationCache:
+    """Least recently used cache of decoded (info,dataset) results
+    Entries are keyed by (portal, station, product, fingerprint), where the fingerprint identifies the version of the source (e.g. a file mtime or an upstream checksum).
+    Storing a new fingerprint of a station replaces the older one. Results without a fingerprint are not cached, since a stale version could not be detected.
+
+    Parameters
+    ----------
+    maxbytes : upper limit of the (approximate) memory size of the cached datasets
+    """
+    def __init__(self,maxbytes=256e6):
+        self.maxbytes=maxbytes
+        self.nbytes=0
+        self._entries=OrderedDict()
+        self._lock=threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self,portal,station,product,fingerprint=None):
+        """Return a cached (info,dataset) tuple or None"""
+        if fingerprint is None:
+            return None
+        with self._lock:
+            entry=self._entries.get((portal,station,product))
+            if entry is None or entry[0] != fingerprint:
+                altmetrics.count(f"{portal}.memcache_misses")
+                return None
+            self._entries.move_to_end((portal,station,product))
+            altmetrics.count(f"{portal}.memcache_hits")
+            info,ds=entry[1]
+        #shallow copies so callers can add variables and attributes without altering the cache
+        return dict(info),ds.copy(deep=False)
+
+    def put(self,portal,station,product,fingerprint,result):
+        """Store an (info,dataset) tuple, evicting the least recently used entries when the size limit is exceeded"""
+        if fingerprint is None:
+            return
+        nbytes=resultSize(result)
+        with self._lock:
+            self._remove((portal,station,product))
+            if nbytes > self.maxbytes:
+                return
+            self._entries[(portal,station,product)]=(fingerprint,result,nbytes)
+            self.nbytes+=nbytes
+            self._evict()
+
+    def _remove(self,key):
+        entry=self._entries.pop(key,None)
+        if entry is not None:
+            self.nbytes-=entry[2]
+
+    def _evict(self):
+        while self.nbytes > self.maxbytes and self._entries:
+            key,entry=self._entries.popitem(last=False)
+            self.nbytes-=entry[2]
+            altmetrics.count(f"{key[0]}.memcache_evictions")
+
+    def invalidate(self,portal=None,station=None,product=None):
+        """Remove the entries matching the given portal, station and product (None matches everything)
+        returns:
+            the number of removed entries
+        """
+        with self._lock:
+            keys=[key for key in self._entries if all(sel is None or sel == val for sel,val in zip((portal,station,product),key))]
+            for key in keys:
+                self._remove(key)
+        altlogger.debug(f"Invalidated {len(keys)} cached station series")
+        return len(keys)
+
+    def clear(self):
+        return self.invalidate()
+
+    def resize(self,maxbytes):
+        """Change the size limit (evicting entries when shrinking)"""
+        with self._lock:
+            self.maxbytes=maxbytes
+            self._evict()
+
+
+#cache shared by the connectors
+stationcache=StationCache(float(os.environ.get("PYALTIM_CACHEBYTES",256e6)))
+
+def connectorCache(cache):
+    """Resolve the cache argument of a connector: None uses the shared cache, False disables caching"""
+    if cache is None:
+        return stationcache
+    return None if cache is False else cache
@@ -0,0 +1,114 @@
+## Per portal circuit breakers: pause and probe a failing portal instead of hammering it (or giving up on the first error)
+
+import threading
+import time
+from pyaltim.core.logging import altlogger, altmetrics
+from pyaltim.portals.api import APITransientError,APIPortalDown
+
+
+class CircuitBreaker:
+    """Guard the requests to a portal
+    closed: requests pass, consecutive transient errors are counted
+    open: after threshold consecutive transient errors, requests wait for a pause
+    halfopen: after the pause one request probes the portal, success closes the circuit, failure opens it again with a doubled pause
+    down: after maxprobes failed probes, requests raise APIPortalDown
+
+    Parameters
+    ----------
+    name : portal name (used in log messages and metrics)
+    threshold : number of consecutive transient errors which opens the circuit
+    pause : seconds to wait before the first probe
+    maxpause : upper limit of the (doubling) pause
+    maxprobes : number of failed probes after which the portal is considered down
+    """
+    def __init__(self,name,threshold=5,pause=30,maxpause=600,maxprobes=5):
+        self.name=name
+        self.threshold=threshold
+        self.pause=pause
+        self.maxpause=maxpause
+        self.maxprobes=maxprobes
+        self._cond=threading.Condition()
+        self.reset()
+
+    def reset(self):
+        with self._cond:
+            self.state="closed"
+            self.failures=0
+            self.nprobes=0
+            self._openuntil=0.0
+            self._cond.notify_all()
+
+    def _acquire(self):
+        """Wait until a request is allowed"""
+        with self._cond:
+            while True:
+                if self.state == "closed":
+                    return
+                elif self.state == "down":
+                    raise APIPortalDown(f"{self.name} is down after {self.nprobes} failed probes")
+                elif self.state == "open":
+                    wait=self._openuntil-time.monotonic()
+                    if wait <= 0:
+                        #this request probes the portal
+                        self.state="halfopen"
+                        return
+                    self._cond.wait(wait)
+                else:
+                    #wait for the outcome of the probe
+                    self._cond.wait()
+
+    def _open(self):
+        pause=min(self.pause*2**self.nprobes,self.maxpause)
+        self._openuntil=time.monotonic()+pause
+        self.state="open"
+        altmetrics.count(f"{self.name}.circuit_open")
+        altlogger.warning(f"{self.name}: {self.failures} consecutive transient errors, pausing for {pause:.0f} s before probing")
+
+    def _failure(self):
+        with self._cond:
+            self.failures+=1
+            if self.state == "halfopen":
+                self.nprobes+=1
+                if self.nprobes >= self.maxprobes:
+                    self.state="down"
+                    altlogger.error(f"{self.name}: giving up after {self.nprobes} failed probes")
+                else:
+                    self._open()
+            elif self.state == "closed" and self.failures >= self.threshold:
+                self._open()
+            self._cond.notify_all()
+
+    def _success(self):
+        with self._cond:
+            if self.state != "closed":
+                altlogger.info(f"{self.name}: portal responds again, resuming")
+            self.state="closed"
+            self.failures=0
+            self.nprobes=0
+            self._cond.notify_all()
+
+    def call(self,func,*args,**kwargs):
+        """Call func through the breaker, only APITransientError counts as a failure (other errors show that the portal responds)"""
+        self._acquire()
+        try:
+            result=func(*args,**kwargs)
+        except APITransientError:
+            self._failure()
+            raise
+        except Exception:
+            self._success()
+            raise
+        self._success()
+        return result
+
+
+#circuit breakers per portal (dahiti, hydrosat, hydroweb)
+circuitbreakers={}
+_lock=threading.Lock()
+
+def circuitBreaker(portal,**kwargs):
+    """Return the circuit breaker of a portal (created with kwargs on first use)"""
+    with _lock:
+        if portal not in circuitbreakers:
+            circuitbreakers[portal]=CircuitBreaker(portal,**kwargs)
+        return circuitbreakers[portal]
@@ -0,0 +1,51 @@
+## Geodetic helpers to match points to nearby features
+
+import numpy as np
+import shapely
+
+#approximate length of a degree latitude in meter
+deg2m=111320.0
+earthradius=6371008.8
+
+def haversine(lon1,lat1,lon2,lat2):
+    """Great circle distance in meter between (arrays of) points in degrees"""
+    lon1,lat1,lon2,lat2=map(np.radians,(lon1,lat1,lon2,lat2))
+    hav=np.sin((lat2-lat1)/2)**2+np.cos(lat1)*np.cos(lat2)*np.sin((lon2-lon1)/2)**2
+    return 2*earthradius*np.arcsin(np.sqrt(hav))
+
+def degreeRadius(lat,tol):
+    """Search radius in degrees which covers a distance tol (meter) in all directions around points at latitudes lat"""
+    return tol/(deg2m*np.maximum(np.cos(np.radians(lat)),0.01))
+
+def nearestFeatures(points,geoms,tol):
+    """Find the nearest feature of each point within a distance using a spatial index
+    The candidates within a (conservative) radius in degrees are compared in a local equirectangular projection around each point, so the nearest feature is found in meters rather than in degrees
+    Parameters
+    ----------
+    points : array of shapely points (lon,lat)
+    geoms : array of shapely geometries (e.g. SWORD nodes or reaches)
+    tol : maximum distance in meter
+
+    returns:
+        indices of the points, indices of the matched features and the distance in meter
+    """
+    lon=shapely.get_x(points)
+    lat=shapely.get_y(points)
+    tree=shapely.STRtree(geoms)
+    ipnt,igeom=tree.query(points,predicate="dwithin",distance=degreeRadius(lat,tol))
+    #shrink the longitudes of the candidates with the cosine of the latitude of their point
+    coslat=np.maximum(np.cos(np.radians(lat[ipnt])),0.01)
+    cand=geoms[igeom]
+    coords,icoord=shapely.get_coordinates(cand,return_index=True)
+    coords[:,0]*=coslat[icoord]
+    cand=shapely.set_coordinates(cand,coords)
+    lines=shapely.shortest_line(shapely.points(lon[ipnt]*coslat,lat[ipnt]),cand)
+    p1=shapely.get_coordinates(shapely.get_point(lines,1))
+    #distance in meter to the closest location on the feature
+    dist=haversine(lon[ipnt],lat[ipnt],p1[:,0]/coslat,p1[:,1])
+    #keep the closest candidate of each point
+    order=np.lexsort((dist,ipnt))
+    order=order[dist[order] <= tol]
+    ipnt,first=np.unique(ipnt[order],return_index=True)
+    order=order[first]
+    return ipnt,igeom[order],dist[order]
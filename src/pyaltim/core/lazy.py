@@ -0,0 +1,86 @@
+## Lazily evaluated multi-station loading backed by dask (an optional dependency, only needed by openStations)
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+from pandas.tseries.frequencies import to_offset
+from pyaltim.core.logging import altlogger
+from pyaltim.portals.api import APIDataNotFound
+
+
+def timeBins(tstart,tend,freq="D"):
+    """Return the left bin edges and all bin edges of a regular time grid"""
+    bins=pd.date_range(tstart,tend,freq=freq)
+    edges=bins.append(pd.DatetimeIndex([bins[-1]+to_offset(freq)]))
+    return bins,edges
+
+def binSeries(ds,variables,edges):
+    """Average the observations of a station dataset onto time bins (nan for empty bins)"""
+    out=np.full((len(variables),len(edges)-1),np.nan)
+    time=pd.to_datetime(ds.time.values).values
+    ibin=np.searchsorted(edges.values,time,side="right")-1
+    inside=(ibin >= 0) & (ibin < len(edges)-1)
+    for iv,var in enumerate(variables):
+        if var not in ds:
+            continue
+        vals=ds[var].values.astype(float)
+        valid=inside & np.isfinite(vals)
+        count=np.bincount(ibin[valid],minlength=len(edges)-1)
+        with np.errstate(invalid="ignore",divide="ignore"):
+            out[iv,:]=np.bincount(ibin[valid],weights=vals[valid],minlength=len(edges)-1)/count
+    return out
+
+def _loadChunk(fetchchunk,stations,variables,edges):
+    """Fetch and bin a chunk of stations into an array of shape (nvariables,nstations,ntime)"""
+    out=np.full((len(variables),len(stations),len(edges)-1),np.nan)
+    for ist,ds in fetchchunk(stations):
+        if ds is not None:
+            out[:,ist,:]=binSeries(ds,variables,edges)
+    return out
+
+def singleFetcher(getfunc):
+    """Wrap a function getfunc(station) -> (info,dataset) into a chunk fetcher"""
+    def fetchchunk(stations):
+        for ist,station in enumerate(stations):
+            try:
+                info,ds=getfunc(station)
+            except APIDataNotFound:
+                altlogger.warning(f"No data found for {station}, leaving empty")
+                continue
+            yield ist,ds
+    return fetchchunk
+
+def openStations(fetchchunk,stations,variables,tstart,tend,freq="D",chunksize=100,lon=None,lat=None,attrs=None):
+    """Open the series of many stations as a lazily evaluated, dask-chunked dataset on a regular time grid
+    Parameters
+    ----------
+    fetchchunk : function(stations) which yields (index in chunk, xarray dataset) tuples for a list of stations
+    stations : list of station identifiers
+    variables : variables to load from the station datasets
+    tstart,tend,freq : time grid onto which the observations are averaged
+    chunksize : number of stations which are fetched and decoded together
+    lon,lat : optional station coordinates (allows regional selection without fetching data)
+
+    returns:
+        A xarray dataset with dimensions (station,time). Data is only fetched when (parts of) it are computed
+    """
+    import dask
+    import dask.array as da
+    bins,edges=timeBins(tstart,tend,freq)
+    variables=list(variables)
+    stations=np.asarray(stations)
+    chunks=[]
+    for i0 in range(0,stations.size,chunksize):
+        chunkst=stations[i0:i0+chunksize]
+        delayed=dask.delayed(_loadChunk)(fetchchunk,list(chunkst),variables,edges)
+        chunks.append(da.from_delayed(delayed,shape=(len(variables),len(chunkst),len(bins)),dtype=float))
+    if chunks:
+        stack=da.concatenate(chunks,axis=1)
+    else:
+        stack=da.empty((len(variables),0,len(bins)),dtype=float)
+    coords=dict(station=("station",stations),time=("time",bins.values))
+    if lon is not None:
+        coords['lon']=("station",np.asarray(lon))
+    if lat is not None:
+        coords['lat']=("station",np.asarray(lat))
+    return xr.Dataset({var:(("station","time"),stack[iv]) for iv,var in enumerate(variables)},coords=coords,attrs={} if attrs is None else attrs)
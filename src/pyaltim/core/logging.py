@@ -1,9 +1,13 @@
 
 
 import logging
+from pyaltim.core.metrics import Metrics
 # pyaltim wide logger
 altlogger=logging.getLogger("pyaltim")
 
+# pyaltim wide metrics (request counts, latencies, bytes, cache hits,...)
+altmetrics=Metrics()
+
 ch = logging.StreamHandler()
 
 # create formatter
@@ -36,4 +40,11 @@ def setErrorLevel():
     """Set logging level for both python and c++ to WARNING severity"""
     altlogger.setLevel(logging.ERROR)
 
+def logMetrics(jsonfile=None):
+    """Log a summary of the collected metrics and optionally export them to a json file"""
+    for line in altmetrics.summary().splitlines():
+        altlogger.info(line)
+    if jsonfile is not None:
+        altmetrics.to_json(jsonfile)
+
 setInfoLevel()
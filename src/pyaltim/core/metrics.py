@@ -0,0 +1,132 @@
+## Lightweight counters, histograms and timers to find out where the time of a run is spent
+
+import json
+import math
+import threading
+import time
+from functools import wraps
+
+
+class Histogram:
+    """Histogram with logarithmically spaced buckets (factor 2 apart)"""
+    def __init__(self):
+        self.count=0
+        self.sum=0.0
+        self.min=math.inf
+        self.max=-math.inf
+        self.buckets={}
+
+    def record(self,value):
+        self.count+=1
+        self.sum+=value
+        self.min=min(self.min,value)
+        self.max=max(self.max,value)
+        ibucket=math.ceil(math.log2(value)) if value > 0 else None
+        self.buckets[ibucket]=self.buckets.get(ibucket,0)+1
+
+    def quantile(self,q):
+        """Approximate quantile (upper edge of the bucket)"""
+        if self.count == 0:
+            return math.nan
+        target=q*self.count
+        ncum=0
+        for ibucket in sorted(self.buckets,key=lambda ib: -math.inf if ib is None else ib):
+            ncum+=self.buckets[ibucket]
+            if ncum >= target:
+                return 0.0 if ibucket is None else min(2.0**ibucket,self.max)
+        return self.max
+
+    def to_dict(self):
+        mean=self.sum/self.count if self.count else math.nan
+        return dict(count=self.count,sum=self.sum,mean=mean,min=self.min,max=self.max,p50=self.quantile(0.5),p90=self.quantile(0.9),p99=self.quantile(0.99),
+                buckets={("0" if ib is None else f"{2.0**ib:g}"):n for ib,n in sorted(self.buckets.items(),key=lambda kv: -math.inf if kv[0] is None else kv[0])})
+
+
+class Timer:
+    """Context manager and decorator which records the elapsed time in a histogram"""
+    def __init__(self,metrics,name):
+        self.metrics=metrics
+        self.name=name
+
+    def __enter__(self):
+        self.t0=time.perf_counter()
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.elapsed=time.perf_counter()-self.t0
+        self.metrics.observe(self.name,self.elapsed)
+        return False
+
+    def __call__(self,func):
+        @wraps(func)
+        def wrapper(*args,**kwargs):
+            with Timer(self.metrics,self.name):
+                return func(*args,**kwargs)
+        return wrapper
+
+
+class Metrics:
+    """Thread-safe registry of counters and histograms
+
+    Usage:
+        altmetrics.count("dahiti.requests")
+        with altmetrics.timer("db.write"):
+            ...
+        @altmetrics.timer("hydrosat.parse")
+        def parse(...):
+    """
+    def __init__(self):
+        self._lock=threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters={}
+            self.histograms={}
+            self.t0=time.time()
+
+    def count(self,name,n=1):
+        with self._lock:
+            self.counters[name]=self.counters.get(name,0)+n
+
+    def observe(self,name,value):
+        with self._lock:
+            if name not in self.histograms:
+                self.histograms[name]=Histogram()
+            self.histograms[name].record(value)
+
+    def timer(self,name):
+        return Timer(self,name)
+
+    def response(self,prefix,resp):
+        """Record request count, latency, bytes, retries and rate limiting of a requests.Response"""
+        self.count(f"{prefix}.requests")
+        self.observe(f"{prefix}.latency",resp.elapsed.total_seconds())
+        self.count(f"{prefix}.bytes",len(resp.content))
+        retries=getattr(resp.raw,"retries",None)
+        if retries is not None and retries.history:
+            self.count(f"{prefix}.retries",len(retries.history))
+        if resp.status_code == 429:
+            self.count(f"{prefix}.ratelimited")
+
+    def to_dict(self):
+        with self._lock:
+            return dict(elapsed=time.time()-self.t0,counters=dict(self.counters),histograms={ky:hist.to_dict() for ky,hist in self.histograms.items()})
+
+    def to_json(self,jsonfile=None):
+        """Return the metrics as a json string and optionally write them to a file"""
+        jsonstr=json.dumps(self.to_dict(),indent=2)
+        if jsonfile is not None:
+            with open(jsonfile,"w") as fid:
+                fid.write(jsonstr)
+        return jsonstr
+
+    def summary(self):
+        """Return a human readable summary of the metrics"""
+        mdict=self.to_dict()
+        lines=[f"Metrics summary after {mdict['elapsed']:.1f} s"]
+        for ky,val in sorted(mdict['counters'].items()):
+            lines.append(f"  {ky:<30s} {val:>12g}")
+        for ky,hist in sorted(mdict['histograms'].items()):
+            lines.append(f"  {ky:<30s} n={hist['count']:<8d} total={hist['sum']:.3f}s mean={hist['mean']:.4f}s p50={hist['p50']:.4f}s p90={hist['p90']:.4f}s max={hist['max']:.4f}s")
+        return "\n".join(lines)
@@ -0,0 +1,187 @@
+## Staged fetch-parse-write pipeline with bounded queues
+
+import queue
+import threading
+from pyaltim.core.logging import altlogger, altmetrics
+from pyaltim.portals.api import APILimitReached,APIDataNotFound,APITransientError,APIPortalDown
+from pyaltim.core.circuitbreaker import circuitBreaker
+
+#marks the end of a stage
+_sentinel=object()
+
+class StagedPipeline:
+    """Overlap downloading, parsing and writing of stations
+    The fetch and parse stages run in worker threads, while the write stage runs in the calling thread (so database sessions stay in one thread).
+    The bounded queues between the stages provide backpressure.
+    When a stage raises APILimitReached, no new items are fetched, but everything which was already fetched is still parsed and written (flushed).
+    Fetches go through the circuit breaker of the portal: APITransientError retries the item (the breaker pauses and probes a failing portal), when the breaker gives up (APIPortalDown) the pipeline is flushed and stopped as well.
+    Errors of a single item in the fetch and parse stages (APIDataNotFound, APIOtherError, items which keep failing transiently, or parse errors such as a KeyError on malformed data) skip the item.
+    Exceptions in the write stage (e.g. database errors) cancel the pipeline and are re-raised after the workers have stopped.
+
+    Parameters
+    ----------
+    fetch : function(item) -> raw data
+    parse : function(item,raw) -> parsed result
+    write : function(item,result)
+    nfetch : number of fetching threads
+    nparse : number of parsing threads
+    maxqueue : maximum number of items waiting between two stages
+    name : name used in log messages and metrics
+    onerror : optional function(item,exc) which is called for items which are skipped
+    breaker : circuit breaker guarding the fetches (default the one of the portal called name)
+    retries : number of retries of an item after a transient error
+    """
+    def __init__(self,fetch,parse,write,nfetch=4,nparse=1,maxqueue=16,name="pipeline",onerror=None,breaker=None,retries=2):
+        self.fetch=fetch
+        self.parse=parse
+        self.write=write
+        self.nfetch=nfetch
+        self.nparse=nparse
+        self.maxqueue=maxqueue
+        self.name=name
+        self.onerror=onerror
+        self.breaker=circuitBreaker(name) if breaker is None else breaker
+        self.retries=retries
+
+    def _put(self,q,obj):
+        #keep trying so that a cancelled pipeline never blocks on a full queue
+        while not self._abort.is_set():
+            try:
+                q.put(obj,timeout=0.2)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _fail(self,exc):
+        with self._lock:
+            if self._error is None:
+                self._error=exc
+        self._stop.set()
+        self._abort.set()
+
+    def _skip(self,item,exc,counter):
+        altlogger.warning(f"Skipping {item}: {getattr(exc,'message',None) or repr(exc)}, continuing")
+        altmetrics.count(f"{self.name}.{counter}")
+        if self.onerror is not None:
+            self.onerror(item,exc)
+
+    def _timedfetch(self,item):
+        with altmetrics.timer(f"{self.name}.fetch"):
+            return self.fetch(item)
+
+    def _fetch(self,item):
+        for attempt in range(self.retries+1):
+            try:
+                return self.breaker.call(self._timedfetch,item)
+            except APITransientError as exc:
+                if attempt == self.retries:
+                    raise
+                altlogger.debug(f"Retrying {item} after: {exc.message}")
+
+    def _fetchworker(self):
+        while not self._stop.is_set():
+            with self._lock:
+                item=next(self._items,_sentinel)
+            if item is _sentinel:
+                break
+            try:
+                raw=self._fetch(item)
+            except APIDataNotFound as exc:
+                self._skip(item,exc,"notfound")
+                continue
+            except APITransientError as exc:
+                self._skip(item,exc,"transient")
+                continue
+            except (APILimitReached,APIPortalDown) as exc:
+                altlogger.warning(f"{exc.message}, stopping after flushing the pipeline")
+                self.stopped=True
+                self._stop.set()
+                break
+            except Exception as exc:
+                self._skip(item,exc,"failed")
+                continue
+            if not self._put(self._parseq,(item,raw)):
+                break
+
+    def _parseworker(self):
+        while True:
+            entry=self._parseq.get()
+            if entry is _sentinel:
+                break
+            if self._abort.is_set():
+                continue
+            item,raw=entry
+            try:
+                with altmetrics.timer(f"{self.name}.parse"):
+                    result=self.parse(item,raw)
+            except APIDataNotFound as exc:
+                self._skip(item,exc,"notfound")
+                continue
+            except APITransientError as exc:
+                self._skip(item,exc,"transient")
+                continue
+            except APILimitReached as exc:
+                altlogger.warning(f"{exc.message}, stopping after flushing the pipeline")
+                self.stopped=True
+                self._stop.set()
+                continue
+            except Exception as exc:
+                self._skip(item,exc,"failed")
+                continue
+            self._put(self._writeq,(item,result))
+
+    def _closestage(self,workers,q,nsentinel):
+        """Wait for the workers of a stage and signal the end to the next stage"""
+        for worker in workers:
+            worker.join()
+        for i in range(nsentinel):
+            q.put(_sentinel)
+
+    def run(self,items):
+        """Push items through the pipeline
+        returns:
+            the number of written items
+        """
+        self._items=iter(items)
+        self._lock=threading.Lock()
+        self._stop=threading.Event()
+        self._abort=threading.Event()
+        self._error=None
+        self.stopped=False
+        if self.breaker.state == "down":
+            #a new run probes the portal again
+            self.breaker.reset()
+        #the queues hold one extra slot for each end marker
+        self._parseq=queue.Queue(maxsize=self.maxqueue+self.nparse)
+        self._writeq=queue.Queue(maxsize=self.maxqueue+1)
+
+        fetchers=[threading.Thread(target=self._fetchworker,daemon=True) for i in range(self.nfetch)]
+        parsers=[threading.Thread(target=self._parseworker,daemon=True) for i in range(self.nparse)]
+        closers=[threading.Thread(target=self._closestage,args=(fetchers,self._parseq,self.nparse),daemon=True),
+                threading.Thread(target=self._closestage,args=(parsers,self._writeq,1),daemon=True)]
+        for thrd in fetchers+parsers+closers:
+            thrd.start()
+
+        nwritten=0
+        while True:
+            entry=self._writeq.get()
+            if entry is _sentinel:
+                break
+            if self._abort.is_set():
+                #drain the queue
+                continue
+            item,result=entry
+            try:
+                with altmetrics.timer(f"{self.name}.write"):
+                    self.write(item,result)
+                nwritten+=1
+            except Exception as exc:
+                self._fail(exc)
+
+        for thrd in closers:
+            thrd.join()
+        altlogger.info(f"{self.name}: wrote {nwritten} items")
+        if self._error is not None:
+            raise self._error
+        return nwritten
@@ -0,0 +1,222 @@
+## Container for the time series of many stations, stored as a CF contiguous ragged array
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+from pyaltim.core.logging import altlogger
+from pyaltim.portals.api import APIDataNotFound
+
+
+def groupReduce(groups,vals,ngroups,how="mean"):
+    """Reduce values per group without a python loop over the groups
+    Parameters
+    ----------
+    groups : integer array with the (sorted) group index of each value
+    vals : array of values (nan's are ignored)
+    ngroups : total number of groups
+    how : one of 'count','sum','mean','std','min','max','median'
+
+    returns:
+        An array of length ngroups (nan for groups without valid values, 0 for count and sum)
+    """
+    valid=np.isfinite(vals)
+    count=np.bincount(groups[valid],minlength=ngroups)
+    if how == "count":
+        return count
+    with np.errstate(invalid="ignore",divide="ignore"):
+        if how == "sum":
+            return np.bincount(groups[valid],weights=vals[valid],minlength=ngroups)
+        elif how == "mean":
+            return np.bincount(groups[valid],weights=vals[valid],minlength=ngroups)/count
+        elif how == "std":
+            mean=np.bincount(groups[valid],weights=vals[valid],minlength=ngroups)/count
+            res=vals[valid]-mean[groups[valid]]
+            return np.sqrt(np.bincount(groups[valid],weights=res**2,minlength=ngroups)/count)
+        elif how in ["min","max"]:
+            out=np.full(ngroups,np.nan)
+            ufunc=np.fmin if how == "min" else np.fmax
+            ufunc.at(out,groups[valid],vals[valid])
+            return out
+        elif how == "median":
+            #sort values within each group and pick the middle value(s)
+            gvalid=groups[valid]
+            srt=np.lexsort((vals[valid],gvalid))
+            svals=vals[valid][srt]
+            start=np.concatenate([[0],np.cumsum(count)[:-1]])
+            out=np.full(ngroups,np.nan)
+            has=count > 0
+            lo=start[has]+(count[has]-1)//2
+            hi=start[has]+count[has]//2
+            out[has]=0.5*(svals[lo]+svals[hi])
+            return out
+        else:
+            raise ValueError(f"Unknown reduction {how}")
+
+
+class RaggedStations:
+    """Time series of many stations stored in contiguous value and time buffers
+    The observations of station i are stored in obs[offsets[i]:offsets[i+1]] (CF contiguous ragged array convention)
+
+    Attributes
+    ----------
+    stations : array with station identifiers
+    time : datetime64 array of all observations
+    data : dictionary with an array per variable, aligned with time
+    rowsize : number of observations per station
+    offsets : start index of each station (length nstations+1)
+    info : pandas dataframe with per-station metadata
+    """
+    def __init__(self,stations,time,data,rowsize,info=None,attrs=None):
+        self.stations=np.asarray(stations)
+        self.time=np.asarray(time,dtype="datetime64[ns]")
+        self.data={ky:np.asarray(val) for ky,val in data.items()}
+        self.rowsize=np.asarray(rowsize,dtype=np.int64)
+        self.offsets=np.concatenate([[0],np.cumsum(self.rowsize)])
+        if self.offsets[-1] != self.time.size:
+            raise ValueError("Sum of the rowsizes does not match the number of observations")
+        self.info=info
+        self.attrs={} if attrs is None else attrs
+
+    @property
+    def nstations(self):
+        return self.stations.size
+
+    @property
+    def nobs(self):
+        return self.time.size
+
+    @property
+    def stationindex(self):
+        """Station index of each observation"""
+        return np.repeat(np.arange(self.nstations),self.rowsize)
+
+    def __len__(self):
+        return self.nstations
+
+    def __getitem__(self,station):
+        """Return the series of a single station as a xarray dataset"""
+        ix=np.flatnonzero(self.stations == station)
+        if ix.size == 0:
+            raise KeyError(f"Station {station} not found")
+        sl=slice(self.offsets[ix[0]],self.offsets[ix[0]+1])
+        return xr.Dataset({ky:("time",val[sl]) for ky,val in self.data.items()},coords=dict(time=("time",self.time[sl])))
+
+    @classmethod
+    def from_datasets(cls,stations,datasets,variables=None,infos=None):
+        """Build the container from a list of per-station xarray datasets (as returned by the connectors)"""
+        if variables is None:
+            #no variables when no station has data
+            variables=[ky for ky,var in datasets[0].data_vars.items() if var.dims == ("time",) and np.issubdtype(var.dtype,np.number)] if datasets else []
+        rowsize=np.array([ds.sizes["time"] for ds in datasets],dtype=np.int64)
+        time=np.concatenate([pd.to_datetime(ds.time.values).values for ds in datasets]) if datasets else np.array([],dtype="datetime64[ns]")
+        data={}
+        for var in variables:
+            data[var]=np.concatenate([ds[var].values.astype(float) if var in ds else np.full(ds.sizes["time"],np.nan) for ds in datasets]) if datasets else np.array([])
+        info=pd.DataFrame(infos,index=stations) if infos is not None else None
+        return cls(stations,time,data,rowsize,info=info)
+
+    @classmethod
+    def from_connector(cls,getfunc,stations,variables=None):
+        """Build the container by calling getfunc(station) -> (info,dataset) for each station
+        Stations for which no data is found are skipped
+        """
+        ids=[]
+        dsets=[]
+        infos=[]
+        for station in stations:
+            try:
+                info,ds=getfunc(station)
+            except APIDataNotFound:
+                altlogger.warning(f"No data found for {station}, skipping")
+                continue
+            #make sure the series are sorted in time
+            ds['time']=pd.to_datetime(ds.time.values)
+            ids.append(station)
+            dsets.append(ds.sortby("time"))
+            infos.append(info)
+        return cls.from_datasets(ids,dsets,variables=variables,infos=infos)
+
+    @classmethod
+    def from_dahiti(cls,dahcon,dahiti_ids,prodname="water_level_altimetry",variables=None):
+        """Build the container from DAHITI targets using a DahitiConnect instance"""
+        return cls.from_connector(lambda dah_id: dahcon.get_by_product(dah_id,prodname),dahiti_ids,variables)
+
+    @classmethod
+    def from_hydrosat(cls,hysatcon,hyd_nos,prodname="WL",variables=None):
+        """Build the container from Hydrosat targets using a HydrosatConnect instance"""
+        return cls.from_connector(lambda hyd_no: hysatcon.get_by_product(hyd_no,prodname),hyd_nos,variables)
+
+    @classmethod
+    def from_hydroweb(cls,hywconn,item_ids,variables=None):
+        """Build the container from Hydroweb items using a HydrowebConnect instance"""
+        return cls.from_connector(hywconn.get_asset,item_ids,variables)
+
+    @classmethod
+    def from_xarray(cls,ds,obsdim="obs"):
+        """Build the container from a CF contiguous ragged array dataset"""
+        rowvar=next(ky for ky,var in ds.variables.items() if var.attrs.get("sample_dimension") == obsdim)
+        data={ky:var.values for ky,var in ds.data_vars.items() if var.dims == (obsdim,) and ky != "time"}
+        return cls(ds.station.values,ds.time.values,data,ds[rowvar].values,attrs=dict(ds.attrs))
+
+    def to_xarray(self):
+        """Export to a CF contiguous ragged array dataset"""
+        ds=xr.Dataset({ky:("obs",val) for ky,val in self.data.items()},coords=dict(station=("station",self.stations),time=("obs",self.time)),attrs=dict(self.attrs,featureType="timeSeries"))
+        ds["rowsize"]=("station",self.rowsize,dict(long_name="number of observations per station",sample_dimension="obs"))
+        ds.station.attrs["cf_role"]="timeseries_id"
+        return ds
+
+    def reduce(self,var,how="mean"):
+        """Reduce a variable per station (count, sum, mean, std, min, max, median) and return a DataArray"""
+        return xr.DataArray(groupReduce(self.stationindex,self.data[var].astype(float),self.nstations,how),coords=dict(station=self.stations),dims="station",name=f"{var}_{how}")
+
+    def trend(self,var):
+        """Least squares trend of a variable per station in units per year"""
+        sidx=self.stationindex
+        vals=self.data[var].astype(float)
+        valid=np.isfinite(vals)
+        tyr=(self.time-(self.time.min() if self.nobs > 0 else np.datetime64(0,"ns"))).astype("timedelta64[s]").astype(float)/(365.25*86400)
+        #center the time and values per station
+        tres=tyr-groupReduce(sidx,np.where(valid,tyr,np.nan),self.nstations,"mean")[sidx]
+        vres=vals-groupReduce(sidx,vals,self.nstations,"mean")[sidx]
+        with np.errstate(invalid="ignore",divide="ignore"):
+            slope=np.bincount(sidx[valid],weights=(tres*vres)[valid],minlength=self.nstations)/np.bincount(sidx[valid],weights=(tres**2)[valid],minlength=self.nstations)
+        return xr.DataArray(slope,coords=dict(station=self.stations),dims="station",name=f"{var}_trend")
+
+    def anomalies(self,var,climatology=None):
+        """Compute anomalies of a variable with respect to the station mean
+        Parameters
+        ----------
+        var : variable name
+        climatology : None (remove the station mean) or 'month' (remove the mean seasonal cycle of each station)
+
+        returns:
+            A new RaggedStations instance with the anomalies
+        """
+        vals=self.data[var].astype(float)
+        sidx=self.stationindex
+        if climatology is None:
+            ref=groupReduce(sidx,vals,self.nstations,"mean")[sidx]
+        elif climatology == "month":
+            month=pd.DatetimeIndex(self.time).month.values-1
+            groups=sidx*12+month
+            ref=groupReduce(groups,vals,self.nstations*12,"mean")[groups]
+        else:
+            raise ValueError(f"Unknown climatology {climatology}")
+        return RaggedStations(self.stations,self.time,{var:vals-ref},self.rowsize,info=self.info,attrs=self.attrs)
+
+    def resample(self,freq="M",how="mean",variables=None):
+        """Resample all station series to a fixed frequency (a pandas period alias such as 'D','W','M','Y')
+        returns:
+            A new RaggedStations instance with one observation per occupied period
+        """
+        if variables is None:
+            variables=list(self.data.keys())
+        sidx=self.stationindex
+        tbin=pd.DatetimeIndex(self.time).to_period(freq).to_timestamp().values
+        bincodes,binvals=pd.factorize(tbin,sort=True)
+        #combined station-period groups remain sorted by station and time
+        groups,inverse=np.unique(sidx*len(binvals)+bincodes,return_inverse=True)
+        ngroups=groups.size
+        data={var:groupReduce(inverse,self.data[var].astype(float),ngroups,how) for var in variables}
+        rowsize=np.bincount(groups//max(len(binvals),1),minlength=self.nstations)
+        return RaggedStations(self.stations,binvals[groups%max(len(binvals),1)],data,rowsize,info=self.info,attrs=self.attrs)
@@ -0,0 +1,42 @@
+## Per portal request-rate ceilings, shared by all connector instances and threads
+
+import threading
+import time
+
+
+class RateLimiter:
+    """Space out calls so that at most rate calls per second are made
+    Parameters
+    ----------
+    rate : maximum number of calls per second
+    """
+    def __init__(self,rate):
+        self.interval=1.0/rate
+        self._lock=threading.Lock()
+        self._next=time.monotonic()
+
+    def wait(self):
+        """Block until the next call is allowed"""
+        with self._lock:
+            now=time.monotonic()
+            tcall=max(now,self._next)
+            self._next=tcall+self.interval
+        if tcall > now:
+            time.sleep(tcall-now)
+
+
+#active rate limiters per portal (dahiti, hydrosat, hydroweb)
+ratelimiters={}
+
+def setRateLimit(portal,rate):
+    """Limit the request rate (calls per second) to a portal, None removes the limit"""
+    if rate is None:
+        ratelimiters.pop(portal,None)
+    else:
+        ratelimiters[portal]=RateLimiter(rate)
+
+def throttle(portal):
+    """Wait until a request to the portal is allowed (returns immediately when no limit is set)"""
+    limiter=ratelimiters.get(portal)
+    if limiter is not None:
+        limiter.wait()
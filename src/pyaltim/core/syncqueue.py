@@ -0,0 +1,202 @@
+## Persistent, prioritized queue of stations which need to be (re)synchronized
+
+import os
+import sqlite3
+import threading
+from datetime import datetime,date,timedelta,timezone
+import pandas as pd
+from pyaltim.core.logging import altlogger
+
+queueschema="""
+CREATE TABLE IF NOT EXISTS queue (
+    target PRIMARY KEY,
+    upstream_tend TEXT,
+    tendchanged TEXT,
+    lastsync TEXT,
+    lastattempt TEXT,
+    attempts INTEGER DEFAULT 0,
+    failures INTEGER DEFAULT 0,
+    lasterror TEXT,
+    pending INTEGER DEFAULT 1
+);
+CREATE INDEX IF NOT EXISTS queue_pending_idx ON queue(pending,lastsync);
+CREATE TABLE IF NOT EXISTS budget (
+    day TEXT PRIMARY KEY,
+    used INTEGER DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value
+);
+"""
+
+#all times are stored as naive UTC in a fixed width format, so they compare correctly as strings
+_timefmt="%Y-%m-%dT%H:%M:%S.%f"
+
+def _isostr(val):
+    """Normalize a time to a UTC string (naive times are interpreted as local time)"""
+    if val is None or pd.isnull(val):
+        return None
+    return pd.Timestamp(val).to_pydatetime().astimezone(timezone.utc).strftime(_timefmt)
+
+def _now():
+    return datetime.now(timezone.utc).strftime(_timefmt)
+
+def _pyval(val):
+    """Convert numpy scalars to python types which sqlite understands"""
+    return val.item() if hasattr(val,"item") else val
+
+
+class SyncQueue:
+    """Persistent work queue of a product, stored in a SQLite file
+    Pending targets are returned with the following priority:
+        1. targets which were never synchronized
+        2. targets whose upstream end time changed after the last synchronization (most recent change first)
+        3. the stalest targets (oldest synchronization first)
+    Targets which failed maxfailures times in a row are parked: they are retried when their upstream end time changes, when their last attempt is older than stalebefore (see update) or after the cool-off period.
+
+    Parameters
+    ----------
+    queuefile : path to the SQLite file
+    dailybudget : maximum number of targets to process per day (None for unlimited), shared across runs
+    maxfailures : number of consecutive failures after which a target is parked
+    cooloff : period after the last attempt after which a parked target is retried
+    """
+    def __init__(self,queuefile,dailybudget=None,maxfailures=3,cooloff=timedelta(days=7)):
+        dirn=os.path.dirname(queuefile)
+        if dirn and not os.path.exists(dirn):
+            os.makedirs(dirn)
+        self.queuefile=queuefile
+        self.dailybudget=dailybudget
+        self.maxfailures=maxfailures
+        self.cooloff=cooloff
+        self._lock=threading.Lock()
+        #the queue is also updated from pipeline worker threads
+        self.conn=sqlite3.connect(queuefile,check_same_thread=False)
+        self.conn.executescript(queueschema)
+        self._normalizetimes()
+
+    def _normalizetimes(self):
+        """Convert the times of queue files written by older versions (mixed local/tz-aware iso strings) to UTC"""
+        with self._lock,self.conn:
+            res=self.conn.execute("SELECT value FROM meta WHERE key = 'timeformat'").fetchone()
+            if res is not None:
+                return
+            timecols=["upstream_tend","tendchanged","lastsync","lastattempt"]
+            rows=self.conn.execute(f"SELECT target,{','.join(timecols)} FROM queue").fetchall()
+            self.conn.executemany(f"UPDATE queue SET {', '.join(f'{col}=?' for col in timecols)} WHERE target = ?",[tuple(_isostr(val) for val in row[1:])+(row[0],) for row in rows])
+            self.conn.execute("INSERT INTO meta (key,value) VALUES ('timeformat','utc')")
+
+    def close(self):
+        self.conn.close()
+
+    def update(self,targets,tends=None,lastsyncs=None,stalebefore=None):
+        """Synchronize the queue with the current list of upstream targets
+        Parameters
+        ----------
+        targets : list of target identifiers
+        tends : optional list with the upstream end time of each target
+        lastsyncs : optional list with the time of an earlier synchronization (used to initialize targets which are new to the queue)
+        stalebefore : targets which were last synchronized before this time become pending again, parked targets which were last attempted before this time are retried
+        """
+        if tends is None:
+            tends=[None]*len(targets)
+        if lastsyncs is None:
+            lastsyncs=[None]*len(targets)
+        now=_now()
+        with self._lock,self.conn:
+            for target,tend,lastsync in zip(targets,tends,lastsyncs):
+                tend=_isostr(tend)
+                lastsync=_isostr(lastsync)
+                pending=int(lastsync is None or (tend is not None and tend > lastsync))
+                #new targets use the upstream end time as time of change
+                self.conn.execute("INSERT INTO queue (target,upstream_tend,tendchanged,lastsync,pending) VALUES (?,?,?,?,?) ON CONFLICT(target) DO UPDATE SET tendchanged=?, upstream_tend=excluded.upstream_tend, pending=1, failures=0 WHERE excluded.upstream_tend IS NOT NULL AND excluded.upstream_tend IS NOT upstream_tend",(_pyval(target),tend,tend,lastsync,pending,now))
+            if stalebefore is not None:
+                stalebefore=_isostr(stalebefore)
+                self.conn.execute("UPDATE queue SET pending=1 WHERE lastsync < ?",(stalebefore,))
+                self.conn.execute("UPDATE queue SET failures=0 WHERE failures >= ? AND lastattempt < ?",(self.maxfailures,stalebefore))
+            #remove targets which disappeared upstream
+            self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS current (target PRIMARY KEY)")
+            self.conn.execute("DELETE FROM current")
+            self.conn.executemany("INSERT OR IGNORE INTO current (target) VALUES (?)",[(_pyval(target),) for target in targets])
+            self.conn.execute("DELETE FROM queue WHERE target NOT IN (SELECT target FROM current)")
+
+    def remaining(self):
+        """Remaining budget for today (None when unlimited)"""
+        if self.dailybudget is None:
+            return None
+        res=self.conn.execute("SELECT used FROM budget WHERE day = ?",(date.today().isoformat(),)).fetchone()
+        return max(self.dailybudget-(0 if res is None else res[0]),0)
+
+    def next(self,n=None,subset=None):
+        """Return up to n pending targets in order of priority (limited by the remaining daily budget)
+        subset: optionally only consider these targets
+        """
+        remaining=self.remaining()
+        if remaining is not None:
+            n=remaining if n is None else min(n,remaining)
+        #parked targets are retried after the cool-off period
+        qry="SELECT target FROM queue WHERE pending = 1 AND (failures < ? OR lastattempt < ?)"
+        if subset is not None:
+            with self._lock,self.conn:
+                self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS subset (target PRIMARY KEY)")
+                self.conn.execute("DELETE FROM subset")
+                self.conn.executemany("INSERT OR IGNORE INTO subset (target) VALUES (?)",[(_pyval(target),) for target in subset])
+            qry+=" AND target IN (SELECT target FROM subset)"
+        qry+="""
+            ORDER BY lastsync IS NOT NULL,
+            (tendchanged IS NOT NULL AND (lastsync IS NULL OR tendchanged > lastsync)) DESC,
+            tendchanged DESC, lastsync ASC, target"""
+        args=[self.maxfailures,_isostr(datetime.now(timezone.utc)-self.cooloff)]
+        if n is not None:
+            qry+=" LIMIT ?"
+            args.append(n)
+        with self._lock:
+            targets=[row[0] for row in self.conn.execute(qry,args)]
+        altlogger.info(f"{len(targets)} targets selected from the sync queue {os.path.basename(self.queuefile)}")
+        return targets
+
+    def _consume(self):
+        self.conn.execute("INSERT INTO budget (day,used) VALUES (?,1) ON CONFLICT(day) DO UPDATE SET used=used+1",(date.today().isoformat(),))
+
+    def markdone(self,target):
+        """Mark a target as successfully synchronized"""
+        now=_now()
+        with self._lock,self.conn:
+            self.conn.execute("UPDATE queue SET pending=0, lastsync=?, lastattempt=?, attempts=attempts+1, failures=0, lasterror=NULL WHERE target = ?",(now,now,_pyval(target)))
+            self._consume()
+
+    def markfailed(self,target,error=None):
+        """Record a failed attempt of a target (it stays pending)"""
+        with self._lock,self.conn:
+            self.conn.execute("UPDATE queue SET lastattempt=?, attempts=attempts+1, failures=failures+1, lasterror=? WHERE target = ?",(_now(),None if error is None else str(error),_pyval(target)))
+            self._consume()
+
+    def invalidate(self,targets):
+        """Mark targets as changed upstream, so they are synchronized with priority"""
+        now=_now()
+        with self._lock,self.conn:
+            self.conn.executemany("UPDATE queue SET pending=1, failures=0, tendchanged=? WHERE target = ?",[(now,_pyval(target)) for target in targets])
+
+    def applydiff(self,targets,stamp):
+        """Invalidate the added/changed targets of an inventory difference, unless a difference with this stamp (e.g. file modification time) was already applied
+        returns:
+            True when the difference was applied
+        """
+        res=self.conn.execute("SELECT value FROM meta WHERE key = 'diffstamp'").fetchone()
+        if res is not None and res[0] >= stamp:
+            return False
+        self.invalidate(targets)
+        with self._lock,self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO meta (key,value) VALUES ('diffstamp',?)",(stamp,))
+        altlogger.info(f"Invalidated {len(targets)} changed targets in the sync queue")
+        return True
+
+    def skip(self,targets):
+        """Mark targets as up to date without downloading them (e.g. when the upstream checksum did not change)"""
+        with self._lock,self.conn:
+            self.conn.executemany("UPDATE queue SET pending=0 WHERE target = ?",[(_pyval(target),) for target in targets])
+
+    def status(self):
+        """Return a dataframe with the state of all targets in the queue"""
+        return pd.read_sql_query("SELECT * FROM queue",self.conn)
@@ -2,28 +2,33 @@
 
 from geoslurp.dataset.pandasbase import PandasBase
 from geoslurp.dataset.dataSetBase import DataSet
-from pyaltim.core.logging import altlogger
+from pyaltim.core.logging import altlogger, altmetrics, logMetrics
 from pyaltim.portals.dahiti import DahitiConnect
 from glob import glob
 import geopandas as gpd
 import os
 import numpy as np
-from datetime import datetime
+import pandas as pd
+from datetime import datetime,timedelta
 from sqlalchemy import Column, Integer,String
 from sqlalchemy.dialects.postgresql import TIMESTAMP,JSONB
 from sqlalchemy.ext.declarative import declared_attr, as_declarative
 from sqlalchemy import MetaData
-from geoslurp.types.json import DataArrayJSONType
+from pyaltim.geoslurp.types import dataColumnType,setTableEncoding
 from pyaltim.portals.api import APILimitReached,APIDataNotFound
+from pyaltim.core.pipeline import StagedPipeline
+from pyaltim.core.syncqueue import SyncQueue
+from pyaltim.portals.inventory import diffInventory,saveDiff,loadDiff,inventoryFile,existingInventory,saveInventory,loadInventory
 
 schema="pyaltim"
 
 class DahitiTargets(PandasBase):
     schema=schema
-    ftype="GPKG" 
+    #format of the cached holdings ('parquet' or 'gpkg')
+    invformat="parquet"
     def __init__(self,dbconn):
         super().__init__(dbconn)
-        self.pdfile=os.path.join(self.cacheDir(),'Dahiti_holdings.gpkg') 
+        self.pdfile=inventoryFile(self.cacheDir(),'Dahiti_holdings',self.invformat)
     
     def pull(self):
         #retrieve apikey and output directory to replace in the configuration
@@ -34,8 +39,17 @@ class DahitiTargets(PandasBase):
         #retrieve the complete catalogue first
         altlogger.info("Downloading current Dahiti holdings")
         gdfdahiti=dahcon.list_targets()
-        #save to a cached GPKG file
-        gdfdahiti.to_file(self.pdfile,driver="GPKG")
+        #compare with the previous holdings and store the difference
+        previnvent=existingInventory(self.pdfile)
+        gdfprevious=loadInventory(previnvent) if previnvent is not None else None
+        diff=diffInventory(gdfprevious,gdfdahiti,['dahiti_id','data_access'])
+        altlogger.info(f"Dahiti holdings: {diff.change.value_counts().to_dict()}")
+        saveDiff(diff,self.pdfile)
+        saveInventory(gdfdahiti,self.pdfile)
+
+    def register(self):
+        #the cached holdings are read by pyaltim, so both GeoParquet and GeoPackage are supported
+        super().register(df=loadInventory(self.pdfile))
 
 
 @as_declarative(metadata=MetaData(schema=schema))
@@ -49,14 +63,23 @@ class DahitiTBase(object):
     lastupdate=Column(TIMESTAMP)
     tstart=Column(TIMESTAMP,index=True)
     tend=Column(TIMESTAMP,index=True)
-    data=Column(DataArrayJSONType) 
+    #json or arrow encoded series (see pyaltim.geoslurp.types)
+    data=Column(dataColumnType())
 
 class DahitiBase(DataSet):
     product=None
     schema=schema
+    #maximum number of stations to download per day (None is unlimited)
+    dailybudget=None
+    #unchanged stations are refreshed after this period
+    maxage=timedelta(days=30)
+    #encoding of the series in a new table (json or arrow, None for PYALTIM_DATAENCODING), existing tables keep their encoding
+    dataencoding=None
     def __init__(self,dbconn):
         if self.product is None:
             raise RuntimeError("class product member needs to be described in derived class")
+        #match the column type with the encoding of an existing table (before geoslurp possibly creates it)
+        self.dataencoding=setTableEncoding(dbconn.dbeng,self.table.__table__,self.dataencoding)
         super().__init__(dbconn)
         self.dahtargets=DahitiTargets(dbconn)
         
@@ -67,40 +90,68 @@ class DahitiBase(DataSet):
         self.dahtargets.pull()
         self.dahtargets.register()
 
-    def register(self,geom=None):
+    def syncqueue(self):
+        """Persistent queue which keeps track of the synchronization state of the targets"""
+        return SyncQueue(os.path.join(self.cacheDir(),f"{self.__class__.__name__}_syncqueue.sqlite"),dailybudget=self.dailybudget)
+
+    def register(self,geom=None,nfetch=4,maxtargets=None):
         if self.db.tableExists(self.stname()):
-            lastupdate=self.dahtargets._dbinvent.lastupdate.isoformat()
-            # only select stations which require updating (lastupdate < catalogue update)
-            qry=f"SELECT comb.dahiti_id, comb.lastupdate,comb.data_access,comb.geometry FROM (SELECT targets.dahiti_id, prod.lastupdate,targets.data_access, targets.geometry FROM {schema}.dahititargets as targets LEFT JOIN {self.stname()} as prod ON targets.dahiti_id = prod.dahiti_id) AS comb WHERE comb.lastupdate IS NULL OR comb.lastupdate < '{lastupdate}'"
+            qry=f"SELECT targets.dahiti_id, prod.lastupdate,targets.data_access, targets.geometry FROM {schema}.dahititargets as targets LEFT JOIN {self.stname()} as prod ON targets.dahiti_id = prod.dahiti_id"
         else:
-            qry=f"SELECT * from {schema}.dahititargets"
+            qry=f"SELECT dahiti_id, NULL AS lastupdate, data_access, geometry from {schema}.dahititargets"
         dftargets=gpd.read_postgis(qry,self.db.dbeng,geom_col="geometry")
-        if geom is not None:
-            #select only a subset of the data to download
-            dftargets=dftargets[dftargets.within(geom)]        
         #select only relevant products
         dftargets=dftargets[dftargets.data_access == f"{self.product}:public"]
-        if len(dftargets) == 0:
+        
+        syncq=self.syncqueue()
+        diff,diffstamp=loadDiff(self.dahtargets.pdfile)
+        if diff is None:
+            # stations which were updated before the catalogue update need updating
+            stalebefore=self.dahtargets._dbinvent.lastupdate
+        else:
+            stalebefore=datetime.now()-self.maxage
+        syncq.update(dftargets.dahiti_id.tolist(),lastsyncs=dftargets.lastupdate.tolist(),stalebefore=stalebefore)
+        if diff is not None:
+            #only revisit the targets which were added or changed in the last catalogue update
+            diff=diff[(diff.change != "removed") & (diff.data_access == f"{self.product}:public")]
+            syncq.applydiff(diff.dahiti_id.tolist(),diffstamp)
+        subset=None
+        if geom is not None:
+            #select only a subset of the data to download
+            subset=dftargets[dftargets.within(geom)].dahiti_id.tolist()
+        #stalest targets first, resuming where a previous run stopped
+        targets=syncq.next(maxtargets,subset=subset)
+        if len(targets) == 0:
             altlogger.info("nothing to update/register")
-        ncount=0
         cred=self.conf.authCred("dahitiv2",qryfields=["apikey"])
         dahcon=DahitiConnect(cred.apikey)
-        for ix,darow in dftargets.iterrows():
-            altlogger.info(f"getting {self.product} for {darow['dahiti_id']}")
-            try:
-                target, dsprod=dahcon.get_by_product(darow['dahiti_id'],self.product)
-            except APIDataNotFound as exc:
-                altlogger.warning(f"No data found for {darow['dahiti_id']},continuing")
-                continue
-            except APILimitReached:
-                altlogger.warning(f"APILimitReached, stopping")
-                break
 
+        def fetch(dah_id):
+            altlogger.info(f"getting {self.product} for {dah_id}")
+            return dahcon.fetch_waterlevel(dah_id)
+
+        def parse(dah_id,raw):
+            return dahcon.parse_waterlevel(raw,dah_id)
+
+        def write(dah_id,result):
+            target,dsprod=result
             #create a dictionary to upsert in the table
-            proddict=dict(dahiti_id=darow['dahiti_id'],tstart=dsprod.time.min().item(), tend=dsprod.time.max().item(),data=dsprod,lastupdate=datetime.now())
+            tstart,tend=pd.to_datetime([dsprod.time.values.min(),dsprod.time.values.max()]).to_pydatetime()
+            if self.dataencoding == "json":
+                #json can not hold datetime64, store the times as strings
+                dsprod=dsprod.assign_coords(time=pd.DatetimeIndex(dsprod.time.values).strftime("%Y-%m-%d %H:%M:%S").to_numpy(dtype=object))
+            proddict=dict(dahiti_id=dah_id,tstart=tstart,tend=tend,data=dsprod,lastupdate=datetime.now())
             
-            self.upsertEntry(proddict,index_elements=['dahiti_id'])
-            ncount+=1
+            with altmetrics.timer("db.write"):
+                self.upsertEntry(proddict,index_elements=['dahiti_id'])
+            syncq.markdone(dah_id)
+
+        #download, parse and upsert concurrently
+        pipeline=StagedPipeline(fetch,parse,write,nfetch=nfetch,name="dahiti",onerror=syncq.markfailed)
+        ncount=pipeline.run(targets)
+        if pipeline.stopped:
+            altmetrics.count("dahiti.ratelimited")
+        logMetrics()
 
 
 def getDahitiDsets(conf):
@@ -3,19 +3,22 @@
 from geoslurp.dataset.pandasbase import PandasBase
 from geoslurp.dataset.dataSetBase import DataSet
 from sqlalchemy.sql.sqltypes import BigInteger
-from pyaltim.core.logging import altlogger
+from pyaltim.core.logging import altlogger, altmetrics, logMetrics
 from pyaltim.portals.hydrosat import HydrosatConnect
 from glob import glob
 import geopandas as gpd
 import os
 import numpy as np
-from datetime import datetime
+from datetime import datetime,timedelta
 from sqlalchemy import Column, Integer,BigInteger
 from sqlalchemy.dialects.postgresql import TIMESTAMP,JSONB
 from sqlalchemy.ext.declarative import declared_attr, as_declarative
 from sqlalchemy import MetaData
-from geoslurp.types.json import DataArrayJSONType
+from pyaltim.geoslurp.types import dataColumnType,setTableEncoding
 from pyaltim.portals.api import APILimitReached,APIDataNotFound
+from pyaltim.core.pipeline import StagedPipeline
+from pyaltim.core.syncqueue import SyncQueue
+from pyaltim.portals.inventory import loadDiff,inventoryFile,loadInventory
 from geoslurp.view.viewBase import TView 
 
 
@@ -23,26 +26,31 @@ schema="pyaltim"
 
 class HydrosatTargets(PandasBase):
     schema=schema
-    ftype="GPKG" 
+    #format of the cached holdings ('parquet' or 'gpkg')
+    invformat="parquet"
     def __init__(self,dbconn):
         super().__init__(dbconn)
         #overwrite cachedir
         self.setCacheDir(self.conf.getCacheDir(self.schema,'HydroSat'))
-        self.pdfile=os.path.join(self.cacheDir(),'Hydrosat_holdings.gpkg') 
+        self.pdfile=inventoryFile(self.cacheDir(),'Hydrosat_holdings',self.invformat)
     
     def pull(self):
         #retrieve apikey and output directory to replace in the configuration
         
         cred=self.conf.authCred("hydrosat",qryfields=["user","passw"])
-        hysatcon=HydrosatConnect(cred.user,cred.passw,cachedir=self.cacheDir())
+        hysatcon=HydrosatConnect(cred.user,cred.passw,cachedir=self.cacheDir(),invformat=self.invformat)
         
         #retrieve the complete catalogue first
         altlogger.info("Downloading current Hydrosat holdings")
         gdfhysat=hysatcon.refresh_inventory()
 
-        #save current holdings to a cached GPKG file
+        #save current holdings to the cached inventory file
         hysatcon.save_inventory()
 
+    def register(self):
+        #the cached holdings are read by pyaltim, so both GeoParquet and GeoPackage are supported
+        super().register(df=loadInventory(self.pdfile))
+
 
 
 @as_declarative(metadata=MetaData(schema=schema))
@@ -58,14 +66,23 @@ class HydrosatTBase(object):
     tend=Column(TIMESTAMP,index=True)
     source_id=Column(Integer)
     header=Column(JSONB)
-    data=Column(DataArrayJSONType)
+    #json or arrow encoded series (see pyaltim.geoslurp.types)
+    data=Column(dataColumnType())
 
 class HydrosatBase(DataSet):
     product=None
     schema=schema
+    #maximum number of stations to download per day (None is unlimited)
+    dailybudget=None
+    #unchanged stations are refreshed after this period
+    maxage=timedelta(days=30)
+    #encoding of the series in a new table (json or arrow, None for PYALTIM_DATAENCODING), existing tables keep their encoding
+    dataencoding=None
     def __init__(self,dbconn):
         if self.product is None:
             raise RuntimeError("class product member needs to be described in derived class")
+        #match the column type with the encoding of an existing table (before geoslurp possibly creates it)
+        self.dataencoding=setTableEncoding(dbconn.dbeng,self.table.__table__,self.dataencoding)
         super().__init__(dbconn)
         #use the same cache directory as the inventory
         self.setCacheDir(self.conf.getCacheDir(self.schema,'HydroSat'))
@@ -77,41 +94,66 @@ class HydrosatBase(DataSet):
         self.hydrosat_targets.pull()
         self.hydrosat_targets.register()
 
-    def register(self,geom=None):
+    def syncqueue(self):
+        """Persistent queue which keeps track of the synchronization state of the targets"""
+        return SyncQueue(os.path.join(self.cacheDir(),f"{self.__class__.__name__}_syncqueue.sqlite"),dailybudget=self.dailybudget)
+
+    def register(self,geom=None,nfetch=4,maxtargets=None):
         if self.db.tableExists(self.stname()):
-            lastupdate=self.hydrosat_targets._dbinvent.lastupdate.isoformat()
-            # only select stations which require updating (lastupdate < catalogue update)
-            qry=f"SELECT comb.hyd_no, comb.lastupdate,comb.data_type,comb.source_id, comb.geometry FROM (SELECT targets.hyd_no, prod.lastupdate, targets.data_type, targets.source_id, targets.geometry FROM {schema}.hydrosattargets as targets LEFT JOIN {self.stname()} as prod ON targets.hyd_no = prod.hyd_no) AS comb WHERE comb.lastupdate IS NULL OR comb.lastupdate < '{lastupdate}'"
+            qry=f"SELECT targets.hyd_no, prod.lastupdate, targets.data_type, targets.source_id, targets.geometry FROM {schema}.hydrosattargets as targets LEFT JOIN {self.stname()} as prod ON targets.hyd_no = prod.hyd_no"
         else:
-            qry=f"SELECT * from {schema}.hydrosattargets"
+            qry=f"SELECT hyd_no, NULL AS lastupdate, data_type, source_id, geometry from {schema}.hydrosattargets"
         dftargets=gpd.read_postgis(qry,self.db.dbeng,geom_col="geometry")
-        if geom is not None:
-            #select only a subset of the data to download
-            dftargets=dftargets[dftargets.within(geom)]        
         #select only relevant products
         dftargets=dftargets[dftargets.data_type == f"{self.product}"]
-        if len(dftargets) == 0:
+
+        syncq=self.syncqueue()
+        diff,diffstamp=loadDiff(self.hydrosat_targets.pdfile)
+        if diff is None:
+            # stations which were updated before the catalogue update need updating
+            stalebefore=self.hydrosat_targets._dbinvent.lastupdate
+        else:
+            stalebefore=datetime.now()-self.maxage
+        syncq.update(dftargets.hyd_no.tolist(),lastsyncs=dftargets.lastupdate.tolist(),stalebefore=stalebefore)
+        if diff is not None:
+            #only revisit the targets which were added or changed in the last inventory refresh
+            diff=diff[(diff.change != "removed") & (diff.data_type == self.product)]
+            syncq.applydiff(diff.hyd_no.tolist(),diffstamp)
+        subset=None
+        if geom is not None:
+            #select only a subset of the data to download
+            subset=dftargets[dftargets.within(geom)].hyd_no.tolist()
+        #stalest targets first, resuming where a previous run stopped
+        targets=syncq.next(maxtargets,subset=subset)
+        if len(targets) == 0:
             altlogger.info("nothing to update/register")
-        ncount=0
         cred=self.conf.authCred("hydrosat",qryfields=["user","passw"])
-        hysatcon=HydrosatConnect(cred.user,cred.passw,cachedir=self.cacheDir())
-        for ix,hysatrow in dftargets.iterrows():
-            altlogger.info(f"getting {self.product} for {hysatrow['hyd_no']}")
-            try:
-                header, dsprod=hysatcon.get_by_product(hysatrow['hyd_no'],self.product)
-            except APIDataNotFound as exc:
-                altlogger.warning(f"No data found for {hysatrow['hyd_no']},continuing")
-                continue
-            except APILimitReached:
-                altlogger.warning(f"APILimitReached, stopping")
-                break
+        hysatcon=HydrosatConnect(cred.user,cred.passw,cachedir=self.cacheDir(),invformat=self.hydrosat_targets.invformat)
 
-            #create a dictionary to upsert in the table
+        sourceids=dict(zip(dftargets.hyd_no,dftargets.source_id))
 
-            proddict=dict(hyd_no=hysatrow['hyd_no'],tstart=dsprod.time.min().item(), tend=dsprod.time.max().item(),source_id=hysatrow['source_id'],header=header,data=dsprod,lastupdate=datetime.now())
+        def fetch(hyd_no):
+            altlogger.info(f"getting {self.product} for {hyd_no}")
+            return hysatcon.download_by_product(hyd_no,self.product)
+
+        def parse(hyd_no,fout):
+            return hysatcon.parse_hydrosat_txt(fout)
+
+        def write(hyd_no,result):
+            header,dsprod=result
+            #create a dictionary to upsert in the table
+            proddict=dict(hyd_no=hyd_no,tstart=dsprod.time.min().item(), tend=dsprod.time.max().item(),source_id=sourceids[hyd_no],header=header,data=dsprod,lastupdate=datetime.now())
             
-            self.upsertEntry(proddict,index_elements=['hyd_no'])
-            ncount+=1
+            with altmetrics.timer("db.write"):
+                self.upsertEntry(proddict,index_elements=['hyd_no'])
+            syncq.markdone(hyd_no)
+
+        #download, parse and upsert concurrently
+        pipeline=StagedPipeline(fetch,parse,write,nfetch=nfetch,name="hydrosat",onerror=syncq.markfailed)
+        ncount=pipeline.run(targets)
+        if pipeline.stopped:
+            altmetrics.count("hydrosat.ratelimited")
+        logMetrics()
 
 class hydrosat_wl_targets(TView):
     schema=schema
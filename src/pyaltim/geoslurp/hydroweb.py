@@ -1,39 +1,64 @@
 ## Entry point to store and manage hydroweb data in a geoslurp enabled database 
 
 from geoslurp.dataset import DataSet
-from pyaltim.core.logging import altlogger 
+from pyaltim.core.logging import altlogger, altmetrics, logMetrics
 from pyaltim.portals.hydroweb import HydrowebConnect
 from geoslurp.dataset.pandasbase import PandasBase
 from glob import glob
 import os
+import time
 import numpy as np
 
 from sqlalchemy import Column, Integer,String
 from sqlalchemy.dialects.postgresql import TIMESTAMP,JSONB
 from sqlalchemy.ext.declarative import declared_attr, as_declarative
 from sqlalchemy import MetaData
-from geoslurp.types.json import DataArrayJSONType
+from pyaltim.geoslurp.types import dataColumnType,setTableEncoding
 from pyaltim.portals.api import APILimitReached,APIDataNotFound
+from pyaltim.core.pipeline import StagedPipeline
+from pyaltim.core.syncqueue import SyncQueue
+from pyaltim.portals.inventory import inventoryFile,saveInventory,loadInventory
+import io
 schema="pyaltim"
 import geopandas as gpd 
+import pandas as pd
 import xarray as xr
 
+#items of all Hydroweb products from the last enumeration (time of enumeration, geopandas dataframe)
+_allholdings={}
+
+def hydrowebHoldings(apikey,maxage=3600):
+    """Enumerate the items of all Hydroweb products in one pass, the result is reused by the products which are pulled within maxage seconds"""
+    tenum,gdf=_allholdings.get(apikey,(None,None))
+    if tenum is None or time.monotonic()-tenum > maxage:
+        hywconn=HydrowebConnect(collection_id=HydrowebConnect.products[0],apikey=apikey)
+        altlogger.info(f"Cataloging items of {', '.join(HydrowebConnect.products)}")
+        gdf=hywconn.get_items(collections=HydrowebConnect.products)
+        _allholdings[apikey]=(time.monotonic(),gdf)
+    return gdf
+
 class HydrowebBase(PandasBase):
     schema=schema
     product=None
-    ftype="GPKG" 
+    #format of the cached holdings ('parquet' or 'gpkg')
+    invformat="parquet"
     def __init__(self,dbconn):
         super().__init__(dbconn)
-        self.pdfile=os.path.join(self.cacheDir(),"Hydroweb_holdings.gpkg")
+        self.pdfile=inventoryFile(self.cacheDir(),"Hydroweb_holdings",self.invformat)
 
     def pull(self,geom=None):
         if self.product is None:
             raise RuntimeError("Derived type of Hydrowebbase needs the prdouct member to be set")
         cred=self.conf.authCred("hydroweb_next",qryfields=["apikey"])
-        hywconn=HydrowebConnect(collection_id=self.product,apikey=cred.apikey)
-        altlogger.info(f"Cataloging items for {self.product}" )
-        gdfhyweb=hywconn.get_items() 
-        gdfhyweb.to_file(self.pdfile,driver="GPKG")
+        #all products are enumerated together, this product takes its share
+        gdfhyweb=hydrowebHoldings(cred.apikey)
+        gdfhyweb=gdfhyweb[gdfhyweb.collection == self.product].reset_index(drop=True)
+        altlogger.info(f"Found {len(gdfhyweb)} items for {self.product}")
+        saveInventory(gdfhyweb,self.pdfile)
+
+    def register(self):
+        #the cached holdings are read by pyaltim, so both GeoParquet and GeoPackage are supported
+        super().register(df=loadInventory(self.pdfile))
     
 
 @as_declarative(metadata=MetaData(schema=schema))
@@ -47,16 +72,26 @@ class HydrowebTBase(object):
     lastupdate=Column(TIMESTAMP)
     tstart=Column(TIMESTAMP,index=True)
     tend=Column(TIMESTAMP,index=True)
-    data=Column(DataArrayJSONType)
+    #upstream asset metadata at the time of download
+    assetupdated=Column(TIMESTAMP)
+    checksum=Column(String)
+    #json or arrow encoded series (see pyaltim.geoslurp.types)
+    data=Column(dataColumnType())
 
 
 class HydrowebAssetBase(DataSet):
     product=None
     schema=schema
     holdingcls=None
+    #maximum number of assets to download per day (None is unlimited)
+    dailybudget=None
+    #encoding of the series in a new table (json or arrow, None for PYALTIM_DATAENCODING), existing tables keep their encoding
+    dataencoding=None
     def __init__(self,dbconn):
         if self.product is None:
             raise RuntimeError("class product member needs to be described in derived class")
+        #match the column type with the encoding of an existing table (before geoslurp possibly creates it)
+        self.dataencoding=setTableEncoding(dbconn.dbeng,self.table.__table__,self.dataencoding)
         super().__init__(dbconn)
         self.holdings=self.holdingcls(dbconn)
 
@@ -65,42 +100,72 @@ class HydrowebAssetBase(DataSet):
         self.holdings.pull()
         self.holdings.register()
 
-    def register(self,geom=None):
+    def syncqueue(self):
+        """Persistent queue which keeps track of the synchronization state of the items"""
+        return SyncQueue(os.path.join(self.cacheDir(),f"{self.__class__.__name__}_syncqueue.sqlite"),dailybudget=self.dailybudget)
+
+    def register(self,geom=None,nfetch=4,maxtargets=None):
         if self.db.tableExists(self.stname()):
-            # lastupdate=self.dahtargets._dbinvent.lastupdate.isoformat()
-            # only select stations which require updating (lastupdate < catalogue update)
-            qry=f"SELECT comb.item_id,comb.geometry FROM (SELECT targets.*, prod.lastupdate FROM {self.holdingcls.stname()} as targets LEFT JOIN {self.stname()} as prod ON targets.item_id = prod.item_id) AS comb WHERE comb.lastupdate IS NULL OR comb.lastupdate < comb.tend"
+            #add the asset metadata columns to tables created by older versions
+            self.db.execute(f"ALTER TABLE {self.stname()} ADD COLUMN IF NOT EXISTS assetupdated TIMESTAMP, ADD COLUMN IF NOT EXISTS checksum VARCHAR")
+            qry=f"SELECT targets.*, prod.lastupdate AS prodlastupdate, prod.assetupdated AS prodassetupdated, prod.checksum AS prodchecksum FROM {self.holdingcls.stname()} as targets LEFT JOIN {self.stname()} as prod ON targets.item_id = prod.item_id"
         else:
-            qry=f"SELECT * from {self.holdingcls.stname()}"
+            qry=f"SELECT targets.*, NULL AS prodlastupdate, NULL AS prodassetupdated, NULL AS prodchecksum from {self.holdingcls.stname()} as targets"
         dftargets=gpd.read_postgis(qry,self.db.dbeng,geom_col="geometry")
+        for col in ["asset_href","updated","checksum"]:
+            if col not in dftargets.columns:
+                #holdings from older versions don't have the asset metadata yet
+                dftargets[col]=None
+        asseturls=dict(zip(dftargets.item_id,dftargets.asset_href))
+        assetmeta=dict(zip(dftargets.item_id,zip(dftargets.updated,dftargets.checksum)))
+
+        # items need updating when the upstream asset was updated (or the end time moved) after the last download
+        syncq=self.syncqueue()
+        syncq.update(dftargets.item_id.tolist(),tends=dftargets.updated.fillna(dftargets.tend).tolist(),lastsyncs=dftargets.prodassetupdated.fillna(dftargets.prodlastupdate).tolist())
+        #items with an unchanged checksum don't need to be downloaded again
+        unchanged=dftargets.checksum.notna() & (dftargets.checksum == dftargets.prodchecksum)
+        syncq.skip(dftargets[unchanged].item_id.tolist())
+        subset=None
         if geom is not None:
             #select only a subset of the data to download
-            dftargets=dftargets[dftargets.within(geom)]        
-        
-        if len(dftargets) == 0:
+            subset=dftargets[dftargets.within(geom)].item_id.tolist()
+        #stalest items first, resuming where a previous run stopped
+        targets=syncq.next(maxtargets,subset=subset)
+        if len(targets) == 0:
             altlogger.info("nothing to update/register")
 
         cred=self.conf.authCred("hydroweb_next",qryfields=["apikey"])
         hywconn=HydrowebConnect(collection_id=self.product,apikey=cred.apikey)
         altlogger.info(f"retrieving assets for {self.product}" )
-        nfail=0
-        for ix,darow in dftargets.iterrows():
-            altlogger.info(f"getting {self.product} for {darow['item_id']}")
-            try:
-                info,dsprod=hywconn.get_asset(darow['item_id'])
-            except APIDataNotFound as exc:
-                altlogger.warning(f"No data found for {item_id},continuing")
-                continue
-            except APILimitReached as exc:
-                altlogger.warning(f"{exc.message}, stopping")
-                break
 
+        def fetch(item_id):
+            altlogger.info(f"getting {self.product} for {item_id}")
+            asseturl=asseturls.get(item_id)
+            return hywconn.download_asset(item_id,None if pd.isnull(asseturl) else asseturl)
+
+        def parse(item_id,text):
+            return hywconn.readasset(io.StringIO(text))
+
+        def write(item_id,result):
+            info,dsprod=result
             proddict={ky:val for ky,val in info.items() if ky in ["lastupdate","tstart","tend"]}
-            proddict["item_id"]=darow['item_id']
+            proddict["item_id"]=item_id
             proddict['data']=dsprod
+            updated,checksum=assetmeta[item_id]
+            proddict['assetupdated']=None if pd.isnull(updated) else updated
+            proddict['checksum']=None if pd.isnull(checksum) else checksum
             #create a dictionary to upsert in the table
             
-            self.upsertEntry(proddict,index_elements=['item_id'])
+            with altmetrics.timer("db.write"):
+                self.upsertEntry(proddict,index_elements=['item_id'])
+            syncq.markdone(item_id)
+
+        #download, parse and upsert concurrently
+        pipeline=StagedPipeline(fetch,parse,write,nfetch=nfetch,name="hydroweb",onerror=syncq.markfailed)
+        pipeline.run(targets)
+        if pipeline.stopped:
+            altmetrics.count("hydroweb.ratelimited")
+        logMetrics()
 
 
 
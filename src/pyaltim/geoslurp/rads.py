@@ -19,22 +19,27 @@ from geoslurp.dataset import DataSet
 from geoslurp.dbfunc.dbfunc import DBFunc
 from geoalchemy2.elements import WKBElement
 from geoalchemy2.types import Geography
-from sqlalchemy import Column,Integer,String, Boolean
+from sqlalchemy import Column,Integer,String, Boolean, SmallInteger, Index, text
 from sqlalchemy.dialects.postgresql import TIMESTAMP, JSONB
 from sqlalchemy import MetaData
 from geoslurp.datapull import UriFile
 from geoslurp.datapull.rsync import Crawler as rsync
-from geoslurp.datapull.uri import findFiles
 import os
 from sqlalchemy.ext.declarative import declared_attr, as_declarative,declarative_base
 from netCDF4 import Dataset as ncDset
-from osgeo import ogr
+import numpy as np
+import shapely
 from datetime import datetime,timedelta
 from glob import glob
 from geoslurp.config.slurplogger import slurplogger
 import re
 from geoslurp.db.settings import getCreateDir
 from geoslurp.config.catalogue import DatasetCatalogue
+from pyaltim.core.logging import altmetrics, logMetrics
+from pyaltim.rads.passindex import PassIndex,passIndexFile
+from pyaltim.rads.manifest import RadsManifest,manifestFile,scanPhase
+from pyaltim.rads.flags import RadsFlags,flagSegments
+from pyaltim.rads.coverage import coveragetable,coveragecellsize,updateCoverage,missionTable
 
 geotracktype = Geography(geometry_type="MULTILINESTRINGZ", srid='4326', spatial_index=True, dimension=3,from_text="ST_GeogfromWKB")
 
@@ -59,18 +64,32 @@ class RadsTBase(object):
     data=Column(JSONB)
     geom=Column(geotracktype)
 
-def is_set(x,n):
-    """Check if the nth bit of x is set to True"""
-    return x & 1 << n != 0
-
-def flag4_isonLand(x):
-    return is_set(x,4)
+@as_declarative(metadata=MetaData(schema=schema))
+class RadsSegTBase(object):
+    """Child table with one row per track segment of a pass (indexed on land and time)"""
+    @declared_attr
+    def __tablename__(cls):
+        #strip of the 'Table' from the class name
+        return cls.__name__[:-5].lower()
+    @declared_attr
+    def __table_args__(cls):
+        return (Index(f"ix_{cls.__tablename__}_land_time","land","tstart","tend"),)
+    id = Column(Integer, primary_key=True)
+    #id of the pass in the parent table
+    passid=Column(Integer,index=True)
+    cycle=Column(Integer)
+    apass=Column(Integer)
+    iseg=Column(SmallInteger)
+    tstart=Column(TIMESTAMP)
+    tend=Column(TIMESTAMP)
+    istart=Column(Integer)
+    iend=Column(Integer)
+    land=Column(Boolean)
 
 def radsMetaDataExtractor(uri):
     """Extract a dictionary with rads entries for the database"""
     slurplogger().info("extracting data from %s"%(uri.url))
     ncrads=ncDset(uri.url)
-    track=ogr.Geometry(ogr.wkbMultiLineString)
     data={"segments":[]}
    
 
@@ -80,63 +99,31 @@ def radsMetaDataExtractor(uri):
     #reference time 
     t0=datetime(1985,1,1)
     
-    # We need to compare some values fromt he previous loop which we store in the follwoing variables 
-    lonprev=ncrads["lon"][0]
-    if lonprev > 180:
-        lonprev-=360
-    
-    tprev=ncrads["time"][0]
-    onlandprev=flag4_isonLand(ncrads["flags"][0])
-   
-   #initiate first linestring segment 
-    trackseg=ogr.Geometry(ogr.wkbLineString)
-    #we also store some bookkeeping information on each track segment
-    segment={"tstart":(t0+timedelta(seconds=float(tprev))).isoformat(),"tend":None,"istart":0,"iend":0,"land":int(flag4_isonLand(ncrads["flags"][0]))}
-   
-    
-    for i,(t,lon,lat,flag) in enumerate(zip(ncrads["time"][:],ncrads["lon"][:],ncrads["lat"][:],ncrads['flags'][:])):
-        dt=t0+timedelta(seconds=float(t))
-        onland=flag4_isonLand(flag)
-        if lon > 180:
-            #make sure longitude goes from -180 to 180
-            lon-=360
-            #create a new segment when: (a) crossing the 180 d line, (b) or when ocean/land flag changes
-        if abs(lonprev-lon) > 180 or (onlandprev != onland):
-            #start a new segment upon crossing the 180 line or when a time gap occurredi, or when crossing from land to ocean or lake
-            #Segments which have more than a single point will be added:
-            if trackseg.GetPointCount() > 1:
-                #gather some end bookkeeping on the previous segment
-                segment["tend"]=dt.isoformat()
-                segment["iend"]=i
+    #decode the complete track at once
+    times=ncrads["time"][:]
+    lon=np.ma.filled(ncrads["lon"][:].astype(float),np.nan)
+    #make sure longitude goes from -180 to 180
+    lon=np.where(lon > 180,lon-360,lon)
+    lat=np.ma.filled(ncrads["lat"][:].astype(float),np.nan)
+    onland=RadsFlags(ncrads["flags"][:]).land
+    nobs=lon.size
    
-                #append segment and bookkeeping data
-                data["segments"].append(segment.copy())
-                # import pdb;pdb.set_trace()
-                track.AddGeometry(trackseg)
-            #initialize new segment
-            segment["tstart"]=dt.isoformat()
-            segment["istart"]=i
-            segment["land"]=int(onland)
-            trackseg=ogr.Geometry(ogr.wkbLineString)
-        
-        trackseg.AddPoint(float(lon),float(lat),0)
-        lonprev=lon
-        tprev=t
-        onlandprev=onland
-    
-    #also add the last segment
-    if trackseg.GetPointCount() > 1:
-        #gather some end bookkeeping on the previous segment
-        segment["tend"]=dt.isoformat()
-        segment["iend"]=i
-
-        #append segment and bookkeeping data
+    #create a new segment when: (a) crossing the 180 d line, (b) or when ocean/land flag changes
+    tracksegs=[]
+    for istart,iend in zip(*flagSegments(lon,onland)):
+        #Segments which have more than a single point will be added:
+        if iend-istart < 2:
+            continue
+        #the last segment ends at the last point of the track
+        ilast=min(iend,nobs-1)
+        segment={"tstart":(t0+timedelta(seconds=float(times[istart]))).isoformat(),"tend":(t0+timedelta(seconds=float(times[ilast]))).isoformat(),"istart":int(istart),"iend":int(ilast),"land":int(onland[istart])}
         data["segments"].append(segment)
-        track.AddGeometry(trackseg)
+        tracksegs.append(shapely.linestrings(np.column_stack([lon[istart:iend],lat[istart:iend],np.zeros(iend-istart)])))
    
     if not data["segments"]:
        #return an empty dict when no segments are found
        return {}
+    track=shapely.multilinestrings(tracksegs)
 
     #reference time for rads
     mtch=re.search("p([0-9]+)c([0-9]+).nc",uri.url)
@@ -147,7 +134,7 @@ def radsMetaDataExtractor(uri):
           "apass":int(mtch.group(1)),
           "uri":uri.url,
           "data":data,
-          "geom":track.ExportToIsoWkb()
+          "geom":shapely.to_wkb(track,flavor="iso",output_dimension=3)
           }
 
     return meta
@@ -158,6 +145,7 @@ class RadsBase(DataSet):
     """Base class for a satellite + phase in the rads database
     """
     table=None
+    segtable=None
     sat=None
     phase=None
     schema=schema
@@ -173,6 +161,73 @@ class RadsBase(DataSet):
             self.updateInvent(False)
         #initialize postgreslq table
         self.table.__table__.create(self.db.dbeng,checkfirst=True)
+        self.segtable.__table__.create(self.db.dbeng,checkfirst=True)
+
+    def segstname(self):
+        return f"{self.schema}.{self.segtable.__tablename__}"
+
+    def addPass(self,meta):
+        """Add a pass and its segments to the dataset session (they are committed together)
+        The segments go to the child table, so they can be filtered with indexed columns
+        """
+        passmeta={**meta,"data":{"nsegments":len(meta["data"]["segments"])}}
+        self.addEntry(passmeta)
+        #flush to obtain the id of the new pass (addEntry possibly generalized the uri in passmeta)
+        self._ses.flush()
+        passid=self._ses.query(self.table.id).filter(self.table.uri == passmeta["uri"]).scalar()
+        #segments which are left from an earlier pass with the same id
+        self._ses.query(self.segtable).filter(self.segtable.passid == passid).delete()
+        self._ses.add_all([self.segtable(passid=passid,cycle=meta["cycle"],apass=meta["apass"],iseg=iseg,tstart=datetime.fromisoformat(seg["tstart"]),tend=datetime.fromisoformat(seg["tend"]),
+            istart=seg["istart"],iend=seg["iend"],land=bool(seg["land"])) for iseg,seg in enumerate(meta["data"]["segments"])])
+
+    def removeOrphanSegments(self):
+        """Delete the segments of passes which are no longer in the pass table (e.g. replaced by a re-registration)"""
+        self._ses.execute(text(f"DELETE FROM {self.segstname()} AS s WHERE NOT EXISTS (SELECT 1 FROM {self.stname()} AS t WHERE t.id = s.passid)"))
+        self._ses.commit()
+
+    def migrate_segments(self,strip=True):
+        """Fill the segment table from the JSON segment lists of passes registered by older versions
+        :param strip: remove the segment lists from the data column afterwards
+        """
+        qry=f"""
+            INSERT INTO {self.segstname()} (passid,cycle,apass,iseg,tstart,tend,istart,iend,land)
+            SELECT t.id, t.cycle, t.apass, s.ord-1, (s.seg->>'tstart')::timestamp, (s.seg->>'tend')::timestamp,
+            (s.seg->>'istart')::int, (s.seg->>'iend')::int, (s.seg->>'land')::int::boolean
+            FROM {self.stname()} AS t CROSS JOIN LATERAL jsonb_array_elements(t.data->'segments') WITH ORDINALITY AS s(seg,ord)
+            WHERE t.data ? 'segments' AND NOT EXISTS (SELECT 1 FROM {self.segstname()} AS x WHERE x.passid = t.id)
+            """
+        with self.db.dbeng.begin() as conn:
+            nseg=conn.execute(text(qry)).rowcount
+            if strip:
+                conn.execute(text(f"UPDATE {self.stname()} SET data=jsonb_build_object('nsegments',jsonb_array_length(data->'segments')) WHERE data ? 'segments'"))
+        slurplogger().info(f"Migrated {nseg} segments to {self.segstname()}")
+        return nseg
+
+    def passindexfile(self):
+        return passIndexFile(self._dbinvent.datadir,self.sat,self.phase)
+
+    def rebuild_passindex(self,cycle=None):
+        """(Re)build the local pass index from the pass files on disk, e.g. for passes which were registered before the index existed
+        :param cycle: only rebuild the entries of these cycle(s), default the complete index
+        """
+        cycles=None
+        if cycle:
+            cycles=cycle if isinstance(cycle,list) else [cycle]
+        dfscan=scanPhase(os.path.join(self._dbinvent.datadir,self.sat,self.phase),cycles=cycles)
+        pindex=PassIndex(self.passindexfile(),self.sat,self.phase)
+        if cycles is None:
+            pindex.clear()
+        for path in dfscan.path:
+            if not path.endswith("nc"):
+                continue
+            with altmetrics.timer("rads.extract"):
+                meta=radsMetaDataExtractor(UriFile(path))
+            if meta:
+                pindex.add(meta)
+            else:
+                pindex.remove([path])
+        pindex.write()
+        logMetrics()
 
     def pull(self, cycle=None,passes=None):
         """Pulls the data from the rads server
@@ -214,36 +269,59 @@ class RadsBase(DataSet):
     def register(self,cycle=None,since=None):
         if since:
            since=datetime.strptime(since,"%Y-%m-%d")
-        else:
-           since=self._dbinvent.lastupdate
+        #compare the files on disk with the manifest, so only new or changed files are looked up in the database
+        manifest=RadsManifest(manifestFile(self._dbinvent.datadir,self.sat,self.phase))
+        cycles=None
+        if cycle:
+            cycles=cycle if isinstance(cycle,list) else [cycle]
+        with altmetrics.timer("rads.scan"):
+            dfscan=scanPhase(os.path.join(self._dbinvent.datadir,self.sat,self.phase),cycles=cycles)
+        todo,removed=manifest.update(dfscan,cycles=cycles)
+        if since:
+            mtimes=dict(zip(dfscan.path,dfscan.mtime))
+            todo=[path for path in todo if mtimes[path] >= since.timestamp()]
         #create a list of files which need to be (re)registered
+        paths=set(todo)
         if self.updated:
-            files=[f for f in self.updated if f.url.endswith("nc")]
-        else:
-            slurplogger().info("Listing files to process (this can take a while)...")
-
-            if cycle:
-                files=[UriFile(file) for file in findFiles(os.path.join(self._dbinvent.datadir,self.sat,self.phase,"c%03d"%(cycle)),'.*.nc$',since=since)]
-            else:
-                files=[UriFile(file) for file in findFiles(os.path.join(self._dbinvent.datadir,self.sat,self.phase),'.*.nc$',since=since)]
+            paths.update(f.url for f in self.updated if f.url.endswith("nc"))
+        files=[UriFile(path) for path in sorted(paths)]
+
+        #also keep a local sidecar index of the passes, which can be queried without the database
+        pindex=PassIndex(self.passindexfile(),self.sat,self.phase)
+        if self.exists and not os.path.exists(self.passindexfile()):
+            slurplogger().warning(f"No pass index found for {self.sat}{self.phase}, use rebuild_passindex to include the passes which were registered before")
+        pindex.remove(removed)
         if not files:
-           slurplogger().info("No updated files found")
-           return
-
-        newfiles=self.retainnewUris(files)
-        if not newfiles:
-            slurplogger().info("Nothing to update")
-            return
+            slurplogger().info("No updated files found")
+            newfiles=[]
+        else:
+            newfiles=self.retainnewUris(files)
+            if not newfiles:
+                slurplogger().info("Nothing to update")
 
         for uri in newfiles:
-            meta=radsMetaDataExtractor(uri)
+            with altmetrics.timer("rads.extract"):
+                meta=radsMetaDataExtractor(uri)
             if not meta:
                #don't register empty entries
                continue
 
-            self.addEntry(meta)
+            with altmetrics.timer("db.write"):
+                self.addPass(meta)
+            pindex.add(meta)
 
-        self.updateInvent()
+        #files which were already in the database are also registered
+        manifest.markregistered([f.url for f in files])
+        manifest.save()
+        pindex.write()
+        if newfiles:
+            self.updateInvent()
+            self.removeOrphanSegments()
+            if self.db.tableExists(coveragetable):
+                #only the new passes are added to the coverage index
+                with altmetrics.timer("rads.coverage"):
+                    updateCoverage(self.db.dbeng,self.sat+self.phase)
+        logMetrics()
 
 
 
@@ -327,7 +405,8 @@ class RadsCycles(DataSet):
 def radsclassFactory(clnm):
     dum,sat,phase=clnm.split("_")
     table=type(clnm+"Table",(RadsTBase,),{})
-    return type(clnm, (RadsBase,), {"sat":sat,"phase":phase,"table":table})
+    segtable=type(clnm+"_segmentsTable",(RadsSegTBase,),{})
+    return type(clnm, (RadsBase,), {"sat":sat,"phase":phase,"table":table,"segtable":segtable})
 
 
 #### RADS REFERENCE ORBITS (DEPENDS ON ABOVE dataset classes) ####
@@ -423,12 +502,64 @@ class RadsRefOrbits(DataSet):
       self.updateInvent(updateTime=False)
 
 
-def getRadsDsets(conf):
-    radsclasses=[RadsCycles,RadsRefOrbits]
+#### RADS COVERAGE INDEX (DEPENDS ON THE PASS TABLES ABOVE) ####
+RadsCoverageTBase=declarative_base(metadata=MetaData(schema=schema))
+class RadsCoverageT(RadsCoverageTBase):
+    __tablename__=coveragetable.split(".")[1]
+    __table_args__=(Index("ix_radscoverage_cell","i","j"),Index("ix_radscoverage_pass","mission","passid"))
+    id = Column(Integer, primary_key=True)
+    #indices of the grid cell (see pyaltim.rads.coverage.coverageCells)
+    i=Column(Integer)
+    j=Column(Integer)
+    mission=Column(String)
+    passid=Column(Integer)
+    cycle=Column(Integer)
+    apass=Column(Integer)
+    iseg=Column(SmallInteger)
 
-    satnph=["n1c","pna","g1a","j2b","3b3","c2a","e1b","gsb","e2a","e1e","3b2","j2c","6aa","e1f","j3a","j2a","j1b","j1c","gsa","3b5","3bb","3b0","txn","j1a","e1a","3b4","3aa","j2d","e1g","gsd","6a1","saa","txb","3b1","sab","3ba","n1b","e1c","e1d","txa"]
 
-    for sat in satnph:
+class RadsCoverage(DataSet):
+   """Grid index which maps cells of a global grid to the pass segments of all registered missions crossing them
+   Once created, the registration of a mission also adds its new passes
+   """
+   table=RadsCoverageT
+   schema=schema
+   #cell size of a new index, an existing index keeps the cell size stored in its inventory entry
+   cellsize=coveragecellsize
+   def __init__(self,dbconn):
+      super().__init__(dbconn)
+      self.table.__table__.create(self.db.dbeng,checkfirst=True)
+      stored=self._dbinvent.data.get("cellsize")
+      if stored is None:
+         #updateCoverage and coverageLookup read the cell size from the inventory
+         self._dbinvent.data["cellsize"]=self.cellsize
+         self.updateInvent(updateTime=False)
+      elif stored != self.cellsize:
+         slurplogger().warning(f"The coverage index uses cells of {stored} degree, rebuild it to use cells of {self.cellsize} degree")
+         self.cellsize=stored
+
+   def pull(self):
+      """Nothing to download, the index is derived from the pass tables"""
+      pass
+
+   def register(self,missionRegex=None):
+      for mission in radsmissions:
+         if missionRegex and not re.search(missionRegex,mission):
+            continue
+         if not self.db.tableExists(missionTable(mission)):
+            continue
+         with altmetrics.timer("rads.coverage"):
+            updateCoverage(self.db.dbeng,mission,self.cellsize)
+      self.updateInvent()
+
+
+#mission/phase identifiers of the rads tables
+radsmissions=["n1c","pna","g1a","j2b","3b3","c2a","e1b","gsb","e2a","e1e","3b2","j2c","6aa","e1f","j3a","j2a","j1b","j1c","gsa","3b5","3bb","3b0","txn","j1a","e1a","3b4","3aa","j2d","e1g","gsd","6a1","saa","txb","3b1","sab","3ba","n1b","e1c","e1d","txa"]
+
+def getRadsDsets(conf):
+    radsclasses=[RadsCycles,RadsRefOrbits,RadsCoverage]
+
+    for sat in radsmissions:
        clname="rads_"+sat[0:2]+"_"+sat[2:3]
        radsclasses.append(radsclassFactory(clname))
     return radsclasses
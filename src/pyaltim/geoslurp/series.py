@@ -0,0 +1,207 @@
+## Read back station series which are stored in the geoslurp tables
+
+from sqlalchemy import select,text,bindparam
+import numpy as np
+import pandas as pd
+import xarray as xr
+from pyaltim.core.lazy import openStations
+from pyaltim.core.logging import altmetrics
+from pyaltim.geoslurp.types import isArrowEncoded,setTableEncoding
+
+#columns which identify the stations in the different product tables
+idcolumns=["dahiti_id","hyd_no","item_id"]
+
+def stationIdColumn(table):
+    """Return the name of the station identifier column of a product table"""
+    for col in idcolumns:
+        if col in table.c:
+            return col
+    raise KeyError(f"No station identifier column found in {table.name}")
+
+def tableFetcher(dbeng,table):
+    """Return a chunk fetcher which retrieves the series of a list of stations in a single query"""
+    idcol=stationIdColumn(table)
+    def fetchchunk(stations):
+        #convert possible numpy scalars to python types
+        stations=[station.item() if hasattr(station,"item") else station for station in stations]
+        ist={station:i for i,station in enumerate(stations)}
+        qry=select(table.c[idcol],table.c.data).where(table.c[idcol].in_(stations))
+        with dbeng.connect() as conn:
+            for stid,ds in conn.execute(qry):
+                yield ist[stid],ds
+    return fetchchunk
+
+def productTable(dsetcls):
+    """Return the sqlalchemy table of a geoslurp dataset class (or of its table class)"""
+    return dsetcls.table.__table__ if hasattr(dsetcls,"table") else dsetcls.__table__
+
+def filteredQuery(table,stations,variables,tstart=None,tend=None,filters=None):
+    """Build a query which unpacks the stored series in the database and only returns the requested observations
+    The time window and value filters are evaluated by PostgreSQL on the JSON arrays, so only the matching samples are transferred
+    Parameters
+    ----------
+    table : sqlalchemy table of a product
+    stations : station identifiers (None for all stations)
+    variables : data variables to return
+    tstart,tend : optional time window
+    filters : optional dictionary with variable:(vmin,vmax) ranges (None for an open bound)
+
+    returns:
+        a sqlalchemy text query with bound parameters
+    """
+    idcol=stationIdColumn(table)
+    params={}
+    cols=[f"p.{idcol} AS station","(t.val #>> '{}')::timestamp AS time"]
+    def varexpr(ivar,var):
+        params[f"var{ivar}"]=var
+        return f"(p.data::jsonb->'data_vars'->:var{ivar}->'data'->>(t.ord::int-1))::float8"
+    for ivar,var in enumerate(variables):
+        cols.append(f"{varexpr(ivar,var)} AS v{ivar}")
+    where=[]
+    if stations is not None:
+        where.append(f"p.{idcol} IN :stations")
+        params["stations"]=[station.item() if hasattr(station,"item") else station for station in stations]
+    if tstart is not None:
+        #use the indexed columns to discard complete series first
+        where.append("p.tend >= :tstart AND (t.val #>> '{}')::timestamp >= :tstart")
+        params["tstart"]=pd.Timestamp(tstart).to_pydatetime()
+    if tend is not None:
+        where.append("p.tstart <= :tend AND (t.val #>> '{}')::timestamp <= :tend")
+        params["tend"]=pd.Timestamp(tend).to_pydatetime()
+    if filters is not None:
+        for ifilt,(var,(vmin,vmax)) in enumerate(filters.items()):
+            expr=varexpr(len(variables)+ifilt,var)
+            if vmin is not None:
+                where.append(f"{expr} >= :vmin{ifilt}")
+                params[f"vmin{ifilt}"]=float(vmin)
+            if vmax is not None:
+                where.append(f"{expr} <= :vmax{ifilt}")
+                params[f"vmax{ifilt}"]=float(vmax)
+    qry=f"SELECT {', '.join(cols)} FROM {table.fullname} AS p CROSS JOIN LATERAL jsonb_array_elements(p.data::jsonb->'coords'->'time'->'data') WITH ORDINALITY AS t(val,ord)"
+    if where:
+        qry+=" WHERE "+" AND ".join(where)
+    qry+=" ORDER BY station, time"
+    qry=text(qry)
+    if stations is not None:
+        qry=qry.bindparams(bindparam("stations",expanding=True))
+    return qry.bindparams(**params)
+
+def seriesFrame(station,ds,variables,tstart=None,tend=None,filters=None):
+    """Convert a decoded station series into a long format dataframe with the matching observations"""
+    df=pd.DataFrame({"time":pd.to_datetime(ds.time.values)})
+    for var in list(variables)+[var for var in (filters or {}) if var not in variables]:
+        df[var]=ds[var].values.astype(float) if var in ds else np.nan
+    keep=np.ones(len(df),dtype=bool)
+    if tstart is not None:
+        keep&=(df.time >= pd.Timestamp(tstart)).values
+    if tend is not None:
+        keep&=(df.time <= pd.Timestamp(tend)).values
+    for var,(vmin,vmax) in (filters or {}).items():
+        if vmin is not None:
+            keep&=(df[var] >= vmin).values
+        if vmax is not None:
+            keep&=(df[var] <= vmax).values
+    df=df.loc[keep,["time"]+list(variables)]
+    df.insert(0,"station",station)
+    return df
+
+def _streamDecoded(dbeng,table,stations,variables,tstart,tend,filters,chunksize):
+    """Stream the observations of binary encoded series, which are filtered after decoding them on the client"""
+    idcol=stationIdColumn(table)
+    qry=select(table.c[idcol],table.c.data)
+    if stations is not None:
+        qry=qry.where(table.c[idcol].in_([station.item() if hasattr(station,"item") else station for station in stations]))
+    #use the indexed columns to discard complete series first
+    if tstart is not None:
+        qry=qry.where(table.c.tend >= pd.Timestamp(tstart).to_pydatetime())
+    if tend is not None:
+        qry=qry.where(table.c.tstart <= pd.Timestamp(tend).to_pydatetime())
+    dfs=[]
+    nrows=0
+    with dbeng.connect() as conn:
+        res=conn.execution_options(stream_results=True,yield_per=100).execute(qry.order_by(table.c[idcol]))
+        for stid,ds in res:
+            df=seriesFrame(stid,ds,variables,tstart,tend,filters)
+            dfs.append(df)
+            nrows+=len(df)
+            if nrows >= chunksize:
+                altmetrics.count("db.rows",nrows)
+                yield pd.concat(dfs,ignore_index=True)
+                dfs=[]
+                nrows=0
+    if dfs:
+        altmetrics.count("db.rows",nrows)
+        yield pd.concat(dfs,ignore_index=True)
+
+def streamStationTable(dbeng,dsetcls,stations,variables,tstart=None,tend=None,filters=None,chunksize=100000):
+    """Stream the filtered observations of stations from a geoslurp product table
+    A server side cursor is used, so large results are not materialized in one go
+    JSON encoded series are unpacked and filtered by PostgreSQL, Arrow encoded series are decoded and filtered on the client
+    Parameters
+    ----------
+    see readStationTable, chunksize is the number of observations per yielded dataframe
+
+    returns:
+        A generator of dataframes with the columns station, time and the variables (long format)
+    """
+    table=productTable(dsetcls)
+    setTableEncoding(dbeng,table)
+    if isArrowEncoded(table):
+        yield from _streamDecoded(dbeng,table,stations,variables,tstart,tend,filters,chunksize)
+        return
+    qry=filteredQuery(table,stations,variables,tstart,tend,filters)
+    colnames=["station","time"]+list(variables)
+    with dbeng.connect() as conn:
+        res=conn.execution_options(stream_results=True,yield_per=chunksize).execute(qry)
+        for rows in res.partitions(chunksize):
+            altmetrics.count("db.rows",len(rows))
+            yield pd.DataFrame.from_records(rows,columns=colnames)
+
+def readStationTable(dbeng,dsetcls,stations,variables,tstart=None,tend=None,filters=None,chunksize=100000):
+    """Read the filtered observations of many stations from a geoslurp product table
+    Parameters
+    ----------
+    dbeng : sqlalchemy engine to the geoslurp database
+    dsetcls : geoslurp dataset class of the product (e.g. as returned by getDahitiDsets), or its table class
+    stations : station identifiers (dahiti_id, hyd_no or item_id), None for all stations
+    variables : variables to load (e.g. ['water_level'])
+    tstart,tend : optional time window
+    filters : optional dictionary with variable:(vmin,vmax) value ranges, e.g. {'wl_err':(None,0.5)}
+    chunksize : number of observations which are fetched at once from the server
+
+    returns:
+        An xarray dataset with dimensions (station,time) holding the variables (nan where a station has no observation)
+    """
+    table=productTable(dsetcls)
+    with altmetrics.timer("db.read"):
+        chunks=list(streamStationTable(dbeng,dsetcls,stations,variables,tstart,tend,filters,chunksize))
+    if len(chunks) == 0:
+        df=pd.DataFrame(columns=["station","time"]+list(variables))
+    else:
+        df=pd.concat(chunks,ignore_index=True)
+    #average possible duplicate epochs of a station
+    df=df.groupby(["station","time"]).mean()
+    ds=xr.Dataset.from_dataframe(df)
+    if stations is not None:
+        #keep the requested station order (also for stations without observations)
+        ds=ds.reindex(station=[station.item() if hasattr(station,"item") else station for station in stations])
+    ds.attrs["source"]=table.fullname
+    return ds
+
+def openStationTable(dbeng,dsetcls,stations,variables,tstart,tend,freq="D",chunksize=100):
+    """Lazily open the stored series of many stations from a geoslurp product table
+    Parameters
+    ----------
+    dbeng : sqlalchemy engine to the geoslurp database
+    dsetcls : geoslurp dataset class of the product (e.g. as returned by getDahitiDsets), or its table class
+    stations : station identifiers (dahiti_id, hyd_no or item_id)
+    variables : variables to load
+    tstart,tend,freq : regular time grid (see pyaltim.core.lazy.openStations)
+    chunksize : number of stations which are queried together
+
+    returns:
+        A dask backed xarray dataset with dimensions (station,time)
+    """
+    table=productTable(dsetcls)
+    setTableEncoding(dbeng,table)
+    return openStations(tableFetcher(dbeng,table),stations,variables,tstart,tend,freq=freq,chunksize=chunksize,attrs=dict(source=table.fullname))
@@ -21,6 +21,9 @@ from geoslurp.datapull.http import Uri as http
 from datetime import datetime
 import os
 from zipfile import ZipFile
+from hashlib import md5
+from osgeo import ogr
+from shapely import box
 from pyaltim.core.logging import altlogger
 
 schema="pyaltim"
@@ -36,6 +39,11 @@ class SwordBase(OGRBase):
     cont=None
     swordtype=None
     
+    #read the layers directly from the zip archive instead of extracting the continental geopackage
+    vsizip=False
+    #optional area of interest (bounding box tuple, shapely geometry or WKT in EPSG:4326) to restrict the loaded features
+    aoi=None
+    
     def __init__(self,dbconn):
         super().__init__(dbconn)
         self.gtype='GEOMETRY'
@@ -43,24 +51,74 @@ class SwordBase(OGRBase):
         self.ogrfile=self.getogrfile()
         self.swapxy = True
         
-    def pull(self):
-        """Pulls the geojson data from the url and unpacks it in the cache directory"""
+    def pull(self,aoi=None,vsizip=None):
+        """Pulls the geopackage data from the url and makes the layer available in the cache directory
+        :param aoi: only load the features intersecting this area of interest (bounding box tuple, shapely geometry or WKT)
+        :param vsizip: read the layer directly from the zip archive without extracting it
+        """
         uri=http(self.url,lastmod=datetime(2023,6,28))
         altlogger.info("Downloading SWORD data")
         uri.download(direc=self.cacheDir(),outfile=self.path,check=True)
-        if not os.path.exists(self.ogrfile):
-            #extract from zip
-            member=f"gpkg/{os.path.basename(self.ogrfile)}"
-            altlogger.info(f"extracting {self.ogrfile}")
-            path_to_zip_file = os.path.join(self.cacheDir(), self.path)
-            with ZipFile(path_to_zip_file, 'r') as zip_ref:
-                zip_ref.extract(member,self.cacheDir())
+        if aoi is None:
+            aoi=self.aoi
+        if vsizip is None:
+            vsizip=self.vsizip
+
+        if aoi is not None:
+            self.ogrfile=self.extractaoi(aoi)
+        elif vsizip:
+            altlogger.info(f"Reading {self.zipmember()} without extracting")
+            self.ogrfile=self.zipmember()
         else:
-            altlogger.info("Already extracted geopackage member")
+            self.ogrfile=self.gpkgfile()
+            if not os.path.exists(self.ogrfile):
+                #extract from zip
+                member=f"gpkg/{os.path.basename(self.ogrfile)}"
+                altlogger.info(f"extracting {self.ogrfile}")
+                path_to_zip_file = os.path.join(self.cacheDir(), self.path)
+                with ZipFile(path_to_zip_file, 'r') as zip_ref:
+                    zip_ref.extract(member,self.cacheDir())
+            else:
+                altlogger.info("Already extracted geopackage member")
+        #remember which file is used, so a later register uses the same layer
+        self._dbinvent.data={**(self._dbinvent.data or {}),"ogrfile":self.ogrfile}
+        self.updateInvent(False)
         
-    def getogrfile(self):
+    def gpkgfile(self):
         return os.path.join(self.cacheDir("gpkg"),self.cont+"_sword_"+self.swordtype+"_v15.gpkg")
 
+    def zipmember(self):
+        """GDAL virtual file system path of the layer inside the zip archive"""
+        return f"/vsizip/{os.path.join(self.cacheDir(),self.path)}/gpkg/{os.path.basename(self.gpkgfile())}"
+
+    def extractaoi(self,aoi):
+        """Copy only the features which intersect the area of interest from the zip archive to a small geopackage"""
+        if isinstance(aoi,str):
+            aoigeom=ogr.CreateGeometryFromWkt(aoi)
+        elif isinstance(aoi,(tuple,list)):
+            aoigeom=ogr.CreateGeometryFromWkt(box(*aoi).wkt)
+        else:
+            aoigeom=ogr.CreateGeometryFromWkt(aoi.wkt)
+        aoitag=md5(aoigeom.ExportToWkt().encode()).hexdigest()[0:8]
+        aoifile=self.gpkgfile().replace(".gpkg",f"_aoi{aoitag}.gpkg")
+        if os.path.exists(aoifile):
+            altlogger.info(f"Already extracted area of interest {aoifile}")
+            return aoifile
+        altlogger.info(f"Extracting area of interest from {self.zipmember()} to {aoifile}")
+        dsin=ogr.Open(self.zipmember())
+        lyr=dsin.GetLayer(0)
+        lyr.SetSpatialFilter(aoigeom)
+        dsout=ogr.GetDriverByName("GPKG").CreateDataSource(aoifile)
+        dsout.CopyLayer(lyr,lyr.GetName())
+        altlogger.info(f"Copied {dsout.GetLayer(0).GetFeatureCount()} features")
+        dsout=None
+        dsin=None
+        return aoifile
+
+    def getogrfile(self):
+        data=self._dbinvent.data or {}
+        return data.get("ogrfile",self.gpkgfile())
+
 def SwordClassFactory(clsName,val):
     return type(clsName, (SwordBase,), {"cont":val["cont"], "swordtype":val["swordtype"]})
 
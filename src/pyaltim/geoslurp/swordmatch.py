@@ -0,0 +1,226 @@
+## Match altimetry river targets (virtual stations) to the nearest SWORD nodes and reaches
+
+from geoslurp.dataset import DataSet
+from sqlalchemy import Column,Integer,BigInteger,String,Float
+from sqlalchemy.dialects.postgresql import TIMESTAMP
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy import MetaData,text,bindparam
+from pyaltim.core.logging import altlogger, altmetrics, logMetrics
+from pyaltim.core.geo import degreeRadius,nearestFeatures
+from pyaltim.geoslurp.sword import SwordClassFactory
+from pyaltim.geoslurp.dahiti import DahitiTargets
+from pyaltim.geoslurp.hydrosat import HydrosatTargets
+from pyaltim.geoslurp.hydroweb import HydrowebBase
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+import pyogrio
+
+schema="pyaltim"
+
+continents=["eu","af","sa","oc","as","na"]
+
+def matchSwordFile(points,swordfile,idcolumns,tol=1000,chunksize=50000):
+    """Match points to the nearest features of a (large) SWORD file, which is read in chunks to bound memory
+    Parameters
+    ----------
+    points : array of shapely points (EPSG:4326)
+    swordfile : OGR readable SWORD layer (e.g. as_sword_nodes_v15.gpkg)
+    idcolumns : SWORD attributes to return for the matched features (e.g. ['node_id','reach_id'])
+    tol : maximum distance in meter
+    chunksize : number of features which are loaded at once
+
+    returns:
+        A dataframe (indexed as points) with the idcolumns and 'dist' of the nearest features (NaN when nothing is within tol)
+    """
+    match=pd.DataFrame({col:pd.Series(np.full(len(points),pd.NA),dtype="Int64") for col in idcolumns})
+    match["dist"]=np.inf
+    info=pyogrio.read_info(swordfile,force_total_bounds=True)
+    lon=shapely.get_x(points)
+    lat=shapely.get_y(points)
+    #search radius in degrees of each target
+    maxdeg=degreeRadius(lat,tol)
+    xmin,ymin,xmax,ymax=info["total_bounds"]
+    inside=np.flatnonzero((lon >= xmin-maxdeg) & (lon <= xmax+maxdeg) & (lat >= ymin-maxdeg) & (lat <= ymax+maxdeg))
+    if len(inside) == 0:
+        match["dist"]=np.nan
+        return match
+
+    for skip in range(0,info["features"],chunksize):
+        with altmetrics.timer("sword.read"):
+            gdfchunk=pyogrio.read_dataframe(swordfile,columns=idcolumns,skip_features=skip,max_features=chunksize)
+        xmin,ymin,xmax,ymax=gdfchunk.total_bounds
+        #only consider the targets near this chunk
+        isub=inside[(lon[inside] >= xmin-maxdeg[inside]) & (lon[inside] <= xmax+maxdeg[inside]) & (lat[inside] >= ymin-maxdeg[inside]) & (lat[inside] <= ymax+maxdeg[inside])]
+        if len(isub) == 0:
+            continue
+        with altmetrics.timer("sword.match"):
+            ipnt,igeom,dist=nearestFeatures(points[isub],gdfchunk.geometry.values,tol)
+        ipnt=isub[ipnt]
+        better=dist < match["dist"].values[ipnt]
+        ipnt=ipnt[better]
+        igeom=igeom[better]
+        match.loc[ipnt,"dist"]=dist[better]
+        for col in idcolumns:
+            match.loc[ipnt,col]=gdfchunk[col].values[igeom]
+
+    match.loc[np.isinf(match["dist"]),"dist"]=np.nan
+    return match
+
+def matchSword(gdftargets,swordfiles,tol=1000,chunksize=50000):
+    """Assign targets to their nearest SWORD node and the reach of that node
+    Targets without a node within tol are assigned to the nearest reach instead
+    Parameters
+    ----------
+    gdftargets : geopandas dataframe with the target locations
+    swordfiles : dictionary with continent:(nodefile,reachfile) entries
+    tol : maximum distance in meter
+    chunksize : number of SWORD features which are loaded at once
+
+    returns:
+        A dataframe (indexed as gdftargets) with the columns cont, node_id, node_dist, reach_id and reach_dist
+        (reach_dist is the distance to the nearest reach, which is NaN when the reach of the node is not the nearest one)
+    """
+    points=gdftargets.to_crs(4326).geometry.values if gdftargets.crs is not None else gdftargets.geometry.values
+    out=pd.DataFrame(dict(cont=pd.Series([None]*len(points),dtype=object),node_id=pd.Series(pd.NA,index=range(len(points)),dtype="Int64"),node_dist=np.nan,reach_id=pd.Series(pd.NA,index=range(len(points)),dtype="Int64"),reach_dist=np.nan))
+    for cont,(nodefile,reachfile) in swordfiles.items():
+        altlogger.info(f"Matching {len(points)} targets to SWORD nodes and reaches of {cont}")
+        nodes=matchSwordFile(points,nodefile,["node_id","reach_id"],tol=tol,chunksize=chunksize)
+        reaches=matchSwordFile(points,reachfile,["reach_id"],tol=tol,chunksize=chunksize)
+        #continents overlap at their borders, so keep the closest match
+        better=nodes.dist.notna().values & ~(nodes.dist.values >= out.node_dist.values)
+        out.loc[better,"node_id"]=nodes.node_id[better]
+        out.loc[better,"node_dist"]=nodes.dist[better]
+        #the reach of the node (the nearest reach can be a tributary close to the confluence)
+        out.loc[better,"reach_id"]=nodes.reach_id[better]
+        samereach=(reaches.reach_id == nodes.reach_id).fillna(False).values
+        out.loc[better,"reach_dist"]=np.where(samereach,reaches.dist.values,np.nan)[better]
+        out.loc[better,"cont"]=cont
+        #fall back to the nearest reach for targets without a node
+        better=out.node_id.isna().values & reaches.dist.notna().values & ~(reaches.dist.values >= out.reach_dist.values)
+        out.loc[better,"reach_id"]=reaches.reach_id[better]
+        out.loc[better,"reach_dist"]=reaches.dist[better]
+        out.loc[better,"cont"]=cont
+    out.index=gdftargets.index
+    return out
+
+
+SwordMatchTBase=declarative_base(metadata=MetaData(schema=schema))
+class SwordMatchT(SwordMatchTBase):
+    __tablename__="sword_matches"
+    id=Column(Integer,primary_key=True)
+    lastupdate=Column(TIMESTAMP)
+    source=Column(String,index=True)
+    product=Column(String)
+    target_id=Column(String,index=True)
+    cont=Column(String)
+    node_id=Column(BigInteger,index=True)
+    node_dist=Column(Float)
+    reach_id=Column(BigInteger,index=True)
+    reach_dist=Column(Float)
+
+
+class SwordMatches(DataSet):
+    """Lookup table which links the DAHITI, Hydrosat and Hydroweb river targets to the nearest SWORD node and reach
+    The SWORD datasets (e.g. eu_sword_nodes, eu_sword_reaches) need to be pulled first
+    """
+    table=SwordMatchT
+    schema=schema
+    #maximum distance in meter between a target and a SWORD node/reach
+    tolerance=1000
+    #number of SWORD features which are loaded at once
+    chunksize=50000
+    def __init__(self,dbconn):
+        super().__init__(dbconn)
+        self.table.__table__.create(self.db.dbeng,checkfirst=True)
+
+    def pull(self):
+        """Nothing to download, the matching uses the SWORD and target datasets"""
+        pass
+
+    def swordfiles(self):
+        files={}
+        for cont in continents:
+            nodefile=SwordClassFactory(f"{cont}_sword_nodes",{"cont":cont,"swordtype":"nodes"})(self.db).ogrfile
+            reachfile=SwordClassFactory(f"{cont}_sword_reaches",{"cont":cont,"swordtype":"reaches"})(self.db).ogrfile
+            try:
+                pyogrio.read_info(nodefile)
+                pyogrio.read_info(reachfile)
+            except Exception:
+                altlogger.warning(f"SWORD files for {cont} are not available, skipping")
+                continue
+            files[cont]=(nodefile,reachfile)
+        return files
+
+    def targets(self):
+        """Gather the river targets of the different portals from the database"""
+        gdfs=[]
+        dahtable=DahitiTargets(self.db).stname()
+        if self.db.tableExists(dahtable):
+            gdf=gpd.read_postgis(f"SELECT DISTINCT ON (dahiti_id) * FROM {dahtable}",self.db.dbeng,geom_col="geometry")
+            if "type" in gdf.columns:
+                #lakes and reservoirs are not matched
+                gdf=gdf[gdf["type"].astype(str).str.lower().str.contains("river")]
+            gdfs.append(gpd.GeoDataFrame(dict(source="dahiti",product=None,target_id=gdf.dahiti_id.astype(str).values),geometry=gdf.geometry.values,crs=gdf.crs))
+
+        hydtable=HydrosatTargets(self.db).stname()
+        if self.db.tableExists(hydtable):
+            gdf=gpd.read_postgis(f"SELECT * FROM {hydtable} WHERE data_type = 'WL'",self.db.dbeng,geom_col="geometry")
+            gdfs.append(gpd.GeoDataFrame(dict(source="hydrosat",product="WL",target_id=gdf.hyd_no.astype(str).values),geometry=gdf.geometry.values,crs=gdf.crs))
+
+        for product in ["HYDROWEB_RIVERS_OPE","HYDROWEB_RIVERS_RESEARCH"]:
+            hywtable=type(product.lower(),(HydrowebBase,),{"product":product})(self.db).stname()
+            if self.db.tableExists(hywtable):
+                gdf=gpd.read_postgis(f"SELECT * FROM {hywtable}",self.db.dbeng,geom_col="geometry")
+                gdfs.append(gpd.GeoDataFrame(dict(source="hydroweb",product=product,target_id=gdf.item_id.astype(str).values),geometry=gdf.geometry.values,crs=gdf.crs))
+        if len(gdfs) == 0:
+            return None
+        return pd.concat(gdfs,ignore_index=True)
+
+    def register(self):
+        gdftargets=self.targets()
+        if gdftargets is None:
+            altlogger.info("No target tables found to match")
+            return
+        swordfiles=self.swordfiles()
+        if len(swordfiles) == 0:
+            altlogger.info("No SWORD files available, pull the SWORD datasets first")
+            return
+        #only keep the point locations
+        gdftargets=gdftargets[gdftargets.geom_type == "Point"].reset_index(drop=True)
+        match=matchSword(gdftargets,swordfiles,tol=self.tolerance,chunksize=self.chunksize)
+        match=pd.concat([gdftargets[["source","product","target_id"]],match],axis=1)
+        match=match[match.node_id.notna() | match.reach_id.notna()]
+        altlogger.info(f"Matched {len(match)} out of {len(gdftargets)} targets to SWORD")
+        match["lastupdate"]=datetime.now()
+        entries=[{ky:(None if pd.isnull(val) else val) for ky,val in entry.items()} for entry in match.astype(object).to_dict(orient="records")]
+        self.truncateTable()
+        with altmetrics.timer("db.write"):
+            self.bulkInsert(entries)
+        self.updateInvent()
+        logMetrics()
+
+
+def targetsOnReach(dbeng,reach_ids,source=None):
+    """Return the targets which are matched to the given SWORD reaches
+    Parameters
+    ----------
+    dbeng : sqlalchemy engine to the geoslurp database
+    reach_ids : SWORD reach identifier or list of reach identifiers
+    source : optionally restrict to 'dahiti', 'hydrosat' or 'hydroweb'
+    """
+    if np.isscalar(reach_ids):
+        reach_ids=[reach_ids]
+    qry=f"SELECT source,product,target_id,cont,node_id,node_dist,reach_id,reach_dist FROM {schema}.{SwordMatchT.__tablename__} WHERE reach_id IN :reach_ids"
+    params=dict(reach_ids=[int(reach_id) for reach_id in reach_ids])
+    if source is not None:
+        qry+=" AND source = :source"
+        params["source"]=source
+    qry=text(qry).bindparams(bindparam("reach_ids",expanding=True))
+    with dbeng.connect() as conn:
+        return pd.read_sql_query(qry,conn,params=params)
+
+def getSwordMatchDsets(conf):
+    return [SwordMatches]
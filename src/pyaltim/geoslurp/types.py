@@ -0,0 +1,170 @@
+## Column types to store station series (xarray datasets) in the geoslurp tables
+
+import json
+import os
+import numpy as np
+import xarray as xr
+import pyarrow as pa
+from sqlalchemy import text,bindparam
+from sqlalchemy.types import TypeDecorator,LargeBinary
+from geoslurp.types.json import DataArrayJSONType
+from pyaltim.core.logging import altlogger
+
+#key of the Arrow schema metadata which holds the dimension, attributes and scalar variables
+_metakey=b"pyaltim"
+
+def _jsonable(val):
+    if isinstance(val,(np.generic,np.ndarray)):
+        return val.tolist()
+    return str(val)
+
+def ds2arrow(ds,compression="zstd"):
+    """Encode a one dimensional dataset (e.g. a station series along time) as compressed Arrow IPC bytes
+    The variables along the dimension become columns, attributes and scalar variables are kept in the schema metadata
+    """
+    if len(ds.dims) != 1:
+        raise ValueError(f"Only datasets with a single dimension can be encoded, found {dict(ds.sizes)}")
+    dim=next(iter(ds.dims))
+    meta=dict(dim=dim,attrs=ds.attrs,vars={},scalars={})
+    columns={}
+    for name,var in ds.variables.items():
+        vmeta=dict(attrs=var.attrs,coord=name in ds.coords)
+        if var.dims == (dim,):
+            columns[name]=pa.array(var.values)
+            meta["vars"][name]=vmeta
+        elif var.dims == ():
+            vmeta["value"]=var.values.item() if var.dtype.kind != "M" else str(var.values)
+            vmeta["dtype"]=var.dtype.str
+            meta["scalars"][name]=vmeta
+        else:
+            raise ValueError(f"Variable {name} with dimensions {var.dims} can not be encoded")
+    table=pa.table(columns).replace_schema_metadata({_metakey:json.dumps(meta,default=_jsonable)})
+    sink=pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink,table.schema,options=pa.ipc.IpcWriteOptions(compression=compression)) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+def arrow2ds(blob):
+    """Decode Arrow IPC bytes (from ds2arrow) back into an xarray dataset"""
+    table=pa.ipc.open_stream(pa.py_buffer(blob)).read_all()
+    meta=json.loads(table.schema.metadata[_metakey])
+    dim=meta["dim"]
+    coords={}
+    data_vars={}
+    for name,vmeta in meta["vars"].items():
+        var=xr.Variable(dim,table.column(name).to_numpy(),attrs=vmeta["attrs"])
+        (coords if vmeta["coord"] else data_vars)[name]=var
+    for name,vmeta in meta["scalars"].items():
+        var=xr.Variable((),np.array(vmeta["value"],dtype=np.dtype(vmeta["dtype"])),attrs=vmeta["attrs"])
+        (coords if vmeta["coord"] else data_vars)[name]=var
+    return xr.Dataset(data_vars,coords=coords,attrs=meta["attrs"])
+
+
+class DataArrayArrowType(TypeDecorator):
+    """Store an xarray dataset as compressed Arrow IPC bytes (bytea), a compact alternative to DataArrayJSONType"""
+    impl=LargeBinary
+    cache_ok=True
+
+    def process_bind_param(self,value,dialect):
+        if value is None:
+            return None
+        return ds2arrow(value)
+
+    def process_result_value(self,value,dialect):
+        if value is None:
+            return None
+        return arrow2ds(bytes(value))
+
+
+#available encodings of the data column
+dataencodings={"json":DataArrayJSONType,"arrow":DataArrayArrowType}
+
+def dataEncoding():
+    """Default encoding of the series in new tables, set by the PYALTIM_DATAENCODING environment variable (json (default) or arrow)
+    Existing tables keep the encoding of their stored column (see setTableEncoding)
+    """
+    encoding=os.environ.get("PYALTIM_DATAENCODING","json").lower()
+    if encoding not in dataencodings:
+        raise ValueError(f"Unknown PYALTIM_DATAENCODING {encoding}, choose from {list(dataencodings)}")
+    return encoding
+
+def dataColumnType():
+    """Default column type of the data column of the station tables"""
+    return dataencodings[dataEncoding()]
+
+def isArrowEncoded(table):
+    """Whether the data column of a sqlalchemy table uses the Arrow encoding"""
+    return isinstance(table.c.data.type,DataArrayArrowType)
+
+def tableEncoding(dbeng,table):
+    """Encoding of the data column of a table as stored in the database (None when the table does not exist yet)"""
+    qry=text("SELECT data_type FROM information_schema.columns WHERE table_schema = :schema AND table_name = :name AND column_name = 'data'")
+    with dbeng.connect() as conn:
+        dtype=conn.execute(qry,dict(schema=table.schema,name=table.name)).scalar()
+    if dtype is None:
+        return None
+    return "arrow" if dtype == "bytea" else "json"
+
+def setTableEncoding(dbeng,table,encoding=None):
+    """Make the type of the data column of a sqlalchemy table match the encoding in the database
+    Parameters
+    ----------
+    dbeng : sqlalchemy engine to the geoslurp database
+    table : sqlalchemy table of a product
+    encoding : encoding of the table when it does not exist yet (default from PYALTIM_DATAENCODING), existing tables keep their stored encoding
+
+    returns:
+        the encoding of the table
+    """
+    stored=tableEncoding(dbeng,table)
+    if stored is None:
+        stored=dataEncoding() if encoding is None else encoding
+    elif encoding is not None and encoding != stored:
+        altlogger.warning(f"{table.fullname} holds {stored} encoded series, use migrateDataColumn to re-encode them to {encoding}")
+    table.c.data.type=dataencodings[stored]()
+    return stored
+
+
+def migrateDataColumn(dbeng,table,to=None,batchsize=500):
+    """Re-encode the data column of an existing station table in place
+    The series are converted in batches into a new column which replaces the old one at the end, an interrupted migration resumes where it stopped.
+    The column type of the sqlalchemy table is updated to the new encoding afterwards.
+    Parameters
+    ----------
+    dbeng : sqlalchemy engine to the geoslurp database
+    table : sqlalchemy table of a product (e.g. pyaltim.geoslurp.series.productTable(dsetcls))
+    to : target encoding (json or arrow), default the other encoding than the stored one
+    batchsize : number of rows converted per transaction
+
+    returns:
+        the number of converted rows
+    """
+    stored=tableEncoding(dbeng,table)
+    if stored is None:
+        raise ValueError(f"{table.fullname} has no data column")
+    to=("json" if stored == "arrow" else "arrow") if to is None else to
+    fullname=table.fullname
+    if stored == to:
+        altlogger.info(f"{fullname} is already {to} encoded")
+        setTableEncoding(dbeng,table)
+        return 0
+    totype=dataencodings[to]()
+    fromtype=dataencodings[stored]()
+    with dbeng.begin() as conn:
+        conn.execute(text(f"ALTER TABLE {fullname} ADD COLUMN IF NOT EXISTS data_new {totype.compile(dialect=dbeng.dialect)}"))
+    qry=text(f"SELECT id, data FROM {fullname} WHERE data_new IS NULL AND data IS NOT NULL ORDER BY id LIMIT :batchsize").columns(data=fromtype)
+    nconv=0
+    while True:
+        with dbeng.begin() as conn:
+            rows=conn.execute(qry,{"batchsize":batchsize}).fetchall()
+            if len(rows) == 0:
+                break
+            upd=text(f"UPDATE {fullname} SET data_new=:data WHERE id=:id").bindparams(bindparam("data",type_=totype))
+            conn.execute(upd,[{"id":row.id,"data":row.data} for row in rows])
+        nconv+=len(rows)
+        altlogger.info(f"{fullname}: re-encoded {nconv} series to {to}")
+    with dbeng.begin() as conn:
+        conn.execute(text(f"ALTER TABLE {fullname} DROP COLUMN data"))
+        conn.execute(text(f"ALTER TABLE {fullname} RENAME COLUMN data_new TO data"))
+    setTableEncoding(dbeng,table)
+    return nconv
@@ -1,3 +1,5 @@
+import requests
+
 class APILimitReached(Exception):
     """Exception raised iwhen API rates are saturated
 
@@ -31,3 +33,68 @@ class APIOtherError(Exception):
     def __init__(self, message):
         self.message = message
         super().__init__(self.message)
+
+
+class APITransientError(Exception):
+    """Exception raised for errors which are likely to go away when retrying later (server errors, timeouts, dropped connections)
+
+    Attributes:
+        message -- explanation of the error
+    """
+
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
+
+
+class APIPortalDown(Exception):
+    """Exception raised when a portal keeps failing after pausing and probing (see pyaltim.core.circuitbreaker)
+
+    Attributes:
+        message -- explanation of the error
+    """
+
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
+
+
+#network errors which are worth retrying later
+transientexceptions=(requests.exceptions.ConnectionError,requests.exceptions.Timeout,requests.exceptions.RetryError,requests.exceptions.ChunkedEncodingError)
+
+#status codes which are worth retrying later
+transientstatus={408,500,502,503,504,520,521,522,523,524}
+
+def checkResponse(portal,resp,what=""):
+    """Raise the exception matching an unsuccessful http response of a portal
+    404/410: APIDataNotFound (permanent for this station)
+    429: APILimitReached
+    408 and 5xx: APITransientError
+    other: APIOtherError
+    """
+    if resp.status_code == 200:
+        return resp
+    msg=f"{portal} {what} returned status {resp.status_code}: {resp.text[:200]}"
+    if resp.status_code in (404,410):
+        raise APIDataNotFound(msg)
+    elif resp.status_code == 429:
+        raise APILimitReached(msg)
+    elif resp.status_code in transientstatus or resp.status_code >= 500:
+        raise APITransientError(msg)
+    raise APIOtherError(msg)
+
+
+#when set, connectors raise instead of prompting (e.g. for credentials)
+batchmode=False
+
+def setBatchMode(on=True):
+    """Switch the non-interactive batch mode on or off"""
+    global batchmode
+    batchmode=on
+
+def askCredential(prompt,secret=True):
+    """Prompt for a missing credential, or raise APIOtherError in batch mode"""
+    if batchmode:
+        raise APIOtherError(f"Missing credential in batch mode ({prompt})")
+    import getpass
+    return getpass.getpass(prompt) if secret else input(prompt)
@@ -0,0 +1,191 @@
+"""Offline catalogue which merges the target inventories of the DAHITI, Hydroweb and Hydrosat portals into a single SQLite file with a spatial (R*Tree) index.
+The catalogue is refreshed per portal and can be queried on bounding box, polygon and time coverage without network access.
+"""
+
+import os
+import sqlite3
+from datetime import datetime
+import pandas as pd
+import geopandas as gpd
+import shapely
+from pyaltim.core.logging import altlogger
+
+catalogueschema="""
+CREATE TABLE IF NOT EXISTS targets (
+    id INTEGER PRIMARY KEY,
+    source TEXT NOT NULL,
+    product TEXT,
+    target_id TEXT NOT NULL,
+    name TEXT,
+    tstart TEXT,
+    tend TEXT,
+    lastupdate TEXT,
+    geometry BLOB,
+    UNIQUE(source,product,target_id)
+);
+CREATE INDEX IF NOT EXISTS targets_source_idx ON targets(source,product);
+CREATE INDEX IF NOT EXISTS targets_time_idx ON targets(tstart,tend);
+CREATE VIRTUAL TABLE IF NOT EXISTS targets_rtree USING rtree(id,minx,maxx,miny,maxy);
+CREATE TABLE IF NOT EXISTS refreshes (
+    source TEXT PRIMARY KEY,
+    lastrefresh TEXT,
+    ntargets INTEGER
+);
+"""
+
+catcolumns=["source","product","target_id","name","tstart","tend","lastupdate","geometry"]
+
+def _isostr(val):
+    if val is None or pd.isnull(val):
+        return None
+    return pd.Timestamp(val).isoformat()
+
+def _firstcol(gdf,candidates):
+    """Return the first available column out of candidates (or None's)"""
+    for col in candidates:
+        if col in gdf.columns:
+            return gdf[col]
+    return pd.Series([None]*len(gdf),index=gdf.index)
+
+def dahiti2catalogue(gdf):
+    """Convert the output of DahitiConnect.list_targets to the catalogue layout"""
+    return gpd.GeoDataFrame(dict(source="dahiti",
+        product=gdf.data_access.str.split(":").str[0].values,
+        target_id=gdf.dahiti_id.astype(str).values,
+        name=_firstcol(gdf,["target_name","name"]).values,
+        tstart=_firstcol(gdf,["min_date","tstart"]).values,
+        tend=_firstcol(gdf,["max_date","tend"]).values,
+        lastupdate=_firstcol(gdf,["last_update","lastupdate"]).values),geometry=gdf.geometry.values,crs=4326)
+
+def hydroweb2catalogue(gdf,product):
+    """Convert the output of HydrowebConnect.get_items to the catalogue layout"""
+    return gpd.GeoDataFrame(dict(source="hydroweb",
+        product=product,
+        target_id=gdf.item_id.astype(str).values,
+        name=gdf.item_id.astype(str).values,
+        tstart=gdf.tstart.values,
+        tend=gdf.tend.values,
+        lastupdate=_firstcol(gdf,["updated","lastupdate"]).values),geometry=gdf.geometry.values,crs=4326)
+
+def hydrosat2catalogue(gdf):
+    """Convert the Hydrosat inventory to the catalogue layout"""
+    return gpd.GeoDataFrame(dict(source="hydrosat",
+        product=gdf.data_type.values,
+        target_id=gdf.hyd_no.astype(str).values,
+        name=[title.decode('utf-8') if isinstance(title,bytes) else title for title in gdf.title],
+        tstart=None,
+        tend=None,
+        lastupdate=None),geometry=gdf.geometry.values,crs=4326)
+
+
+class TargetCatalogue:
+    """Unified offline catalogue of altimetry targets from several portals
+
+    Attributes
+    ----------
+    dbfile : path to the SQLite catalogue file
+    """
+    def __init__(self,dbfile="pyaltim_catalogue.sqlite"):
+        self.dbfile=dbfile
+        dirn=os.path.dirname(dbfile)
+        if dirn and not os.path.exists(dirn):
+            os.makedirs(dirn)
+        self.conn=sqlite3.connect(dbfile)
+        self.conn.executescript(catalogueschema)
+
+    def close(self):
+        self.conn.close()
+
+    def update(self,source,gdfcat,product=None):
+        """Replace all entries of a portal (and optionally only a single product) with new entries in the catalogue layout"""
+        bounds=shapely.bounds(gdfcat.geometry.values)
+        wkbs=shapely.to_wkb(gdfcat.geometry.values)
+        with self.conn:
+            cond="source = ?"
+            args=[source]
+            if product is not None:
+                cond+=" AND product = ?"
+                args.append(product)
+            self.conn.execute(f"DELETE FROM targets_rtree WHERE id IN (SELECT id FROM targets WHERE {cond})",args)
+            self.conn.execute(f"DELETE FROM targets WHERE {cond}",args)
+            for row,wkb,bnd in zip(gdfcat.itertuples(index=False),wkbs,bounds):
+                #duplicate targets update the existing row, so its id (and R*Tree entry) is kept
+                self.conn.execute("""INSERT INTO targets (source,product,target_id,name,tstart,tend,lastupdate,geometry) VALUES (?,?,?,?,?,?,?,?)
+                        ON CONFLICT(source,product,target_id) DO UPDATE SET name=excluded.name, tstart=excluded.tstart, tend=excluded.tend, lastupdate=excluded.lastupdate, geometry=excluded.geometry""",
+                        (source,row.product,row.target_id,row.name,_isostr(row.tstart),_isostr(row.tend),_isostr(row.lastupdate),wkb))
+                rowid=self.conn.execute("SELECT id FROM targets WHERE source = ? AND product IS ? AND target_id = ? ORDER BY id DESC LIMIT 1",(source,row.product,row.target_id)).fetchone()[0]
+                self.conn.execute("INSERT OR REPLACE INTO targets_rtree (id,minx,maxx,miny,maxy) VALUES (?,?,?,?,?)",(rowid,bnd[0],bnd[2],bnd[1],bnd[3]))
+            #entries left behind by catalogues written by older versions
+            self.conn.execute("DELETE FROM targets_rtree WHERE id NOT IN (SELECT id FROM targets)")
+            ntargets=self.conn.execute("SELECT COUNT(*) FROM targets WHERE source = ?",(source,)).fetchone()[0]
+            self.conn.execute("INSERT OR REPLACE INTO refreshes (source,lastrefresh,ntargets) VALUES (?,?,?)",(source,datetime.now().isoformat(),ntargets))
+        altlogger.info(f"Catalogue now holds {ntargets} {source} targets")
+
+    def refresh_dahiti(self,dahcon):
+        """Refresh the DAHITI entries using a DahitiConnect instance"""
+        altlogger.info("Refreshing DAHITI targets in the catalogue")
+        self.update("dahiti",dahiti2catalogue(dahcon.list_targets()))
+
+    def refresh_hydroweb(self,apikey,products=None,tiles=None):
+        """Refresh the Hydroweb entries (all products by default, enumerated in one pass)"""
+        from pyaltim.portals.hydroweb import HydrowebConnect
+        if products is None:
+            products=HydrowebConnect.products
+        altlogger.info(f"Refreshing Hydroweb items of {products} in the catalogue")
+        hywconn=HydrowebConnect(products[0],apikey=apikey)
+        gdfitems=hywconn.get_items(collections=products,tiles=tiles)
+        for product in products:
+            self.update("hydroweb",hydroweb2catalogue(gdfitems[gdfitems.collection == product],product),product=product)
+
+    def refresh_hydrosat(self,hysatcon):
+        """Refresh the Hydrosat entries using a HydrosatConnect instance"""
+        altlogger.info("Refreshing Hydrosat targets in the catalogue")
+        self.update("hydrosat",hydrosat2catalogue(hysatcon.refresh_inventory()))
+
+    def lastrefresh(self,source):
+        """Return the time of the last refresh of a portal (or None)"""
+        res=self.conn.execute("SELECT lastrefresh FROM refreshes WHERE source = ?",(source,)).fetchone()
+        return None if res is None else datetime.fromisoformat(res[0])
+
+    def query(self,bbox=None,geom=None,tstart=None,tend=None,source=None,product=None):
+        """Query the catalogue offline
+        Parameters
+        ----------
+        bbox : (minlon,minlat,maxlon,maxlat) tuple
+        geom : shapely geometry, targets need to intersect with it
+        tstart,tend : only return targets which have data within this time window (targets with unknown coverage are retained)
+        source : restrict to a portal ('dahiti','hydroweb','hydrosat')
+        product : restrict to a product
+
+        returns:
+            A geopandas dataframe with the selected targets
+        """
+        qry="SELECT t.source,t.product,t.target_id,t.name,t.tstart,t.tend,t.lastupdate,t.geometry FROM targets AS t"
+        where=[]
+        args=[]
+        if geom is not None and bbox is None:
+            bbox=geom.bounds
+        if bbox is not None:
+            qry+=" JOIN targets_rtree AS r ON t.id = r.id"
+            where.append("r.maxx >= ? AND r.minx <= ? AND r.maxy >= ? AND r.miny <= ?")
+            args.extend([bbox[0],bbox[2],bbox[1],bbox[3]])
+        if tstart is not None:
+            where.append("(t.tend IS NULL OR t.tend >= ?)")
+            args.append(_isostr(tstart))
+        if tend is not None:
+            where.append("(t.tstart IS NULL OR t.tstart <= ?)")
+            args.append(_isostr(tend))
+        if source is not None:
+            where.append("t.source = ?")
+            args.append(source)
+        if product is not None:
+            where.append("t.product = ?")
+            args.append(product)
+        if where:
+            qry+=" WHERE "+" AND ".join(where)
+
+        df=pd.read_sql_query(qry,self.conn,params=args)
+        gdf=gpd.GeoDataFrame(df.drop(columns="geometry"),geometry=shapely.from_wkb(df.geometry.values),crs=4326)
+        if geom is not None:
+            gdf=gdf[gdf.intersects(geom)]
+        return gdf
@@ -6,21 +6,143 @@ import geopandas as gpd
 import pandas as pd
 import os
 import json
+import io
+try:
+    from netCDF4 import Dataset as ncDset
+except ImportError:
+    #netcdf downloads are only used when netCDF4 is available
+    ncDset=None
 import requests
-from pyaltim.core.logging import altlogger as log
+from pyaltim.core.logging import altlogger as log, altmetrics
 from shapely import Point
+import shapely
+import threading
 import numpy as np
 import xarray as xr
 from datetime import datetime
-from pyaltim.portals.api import APILimitReached,APIDataNotFound,APIOtherError
-import getpass
+from pyaltim.portals.api import APILimitReached,APIDataNotFound,APIOtherError,APITransientError,transientexceptions,checkResponse,askCredential
+from pyaltim.core.lazy import openStations,singleFetcher
+from pyaltim.core.ratelimit import throttle
+from pyaltim.core.cache import connectorCache
+
+#columns of an empty target catalogue
+emptytargetcolumns={'dahiti_id':'int64','data_access':'object'}
+
+def dahitiTargets2gdf(targets,geom=None):
+    """Build the target catalogue from the list-targets response in a columnar way
+    Parameters
+    ----------
+    targets : list of target dictionaries (with longitude, latitude and a data_access dictionary)
+    geom : optional shapely geometry to select the targets within
+
+    returns:
+        A geopandas dataframe with one row per target and public data_access product ('<product>:<access>')
+    """
+    df=pd.DataFrame.from_records(targets)
+    if len(df) == 0:
+        return gpd.GeoDataFrame({col:pd.Series(dtype=dtype) for col,dtype in emptytargetcolumns.items()},geometry=gpd.points_from_xy([],[]),crs='EPSG:4326')
+    lon=df.pop('longitude').to_numpy(dtype=float)
+    lat=df.pop('latitude').to_numpy(dtype=float)
+    access=df.pop('data_access').to_numpy()
+    if geom is not None:
+        #bounding box prefilter on the coordinate arrays, followed by the exact test
+        xmin,ymin,xmax,ymax=geom.bounds
+        keep=np.flatnonzero((lon >= xmin) & (lon <= xmax) & (lat >= ymin) & (lat <= ymax))
+        keep=keep[shapely.contains_xy(geom,lon[keep],lat[keep])]
+        df=df.iloc[keep]
+        lon=lon[keep]
+        lat=lat[keep]
+        access=access[keep]
+
+    #flatten the data_access dictionaries into (target,product:access) pairs, without exploding lists
+    dfacc=pd.DataFrame.from_records([da if isinstance(da,dict) else {} for da in access],index=range(len(access)))
+    vals=dfacc.to_numpy(dtype=object)
+    valid=pd.notna(vals)
+    irow,icol=np.nonzero(valid)
+    daccess=dfacc.columns.to_numpy(dtype=object)[icol]+":"+vals[irow,icol].astype(str)
+    #targets without any data access product are kept with a missing entry
+    noaccess=np.flatnonzero(~valid.any(axis=1))
+    irow=np.concatenate([irow,noaccess])
+    daccess=np.concatenate([daccess,np.full(len(noaccess),np.nan,dtype=object)])
+    order=np.argsort(irow,kind="stable")
+    irow=irow[order]
+
+    gdftargets=gpd.GeoDataFrame(df.iloc[irow].reset_index(drop=True),geometry=gpd.points_from_xy(lon,lat).take(irow),crs='EPSG:4326')
+    gdftargets.insert(len(df.columns),'data_access',daccess[order])
+    return gdftargets
+
+def _wlDataset(time,water_level,error):
+    #all decoders return datetime64 times
+    return xr.Dataset(dict(water_level=('time',water_level),wl_err=('time',error)),coords=dict(time=('time',pd.to_datetime(time).values.astype('datetime64[ns]'))))
+
+def decodeJsonWaterlevel(waterlevel,dah_id=None):
+    """Decode a json water level response into the target info and a dataset"""
+    data=waterlevel['data']
+    if len(data) == 0:
+        raise APIDataNotFound(f"No data found for {dah_id}")
+    df=pd.DataFrame.from_records(data,columns=['datetime','water_level','error'])
+    return waterlevel['info'],_wlDataset(df.datetime,df.water_level.to_numpy(dtype=float),df.error.to_numpy(dtype=float))
+
+def _findcolumn(columns,candidates):
+    for col in columns:
+        if col.strip().lower() in candidates:
+            return col
+    raise KeyError(f"None of the columns {list(columns)} matches {candidates}")
+
+def decodeCsvWaterlevel(content,dah_id=None):
+    """Decode a csv (or ascii) water level download, with '#' header lines holding the target info"""
+    text=content.decode('utf-8') if isinstance(content,bytes) else content
+    info={}
+    for line in text.splitlines():
+        if not line.startswith('#'):
+            continue
+        kyval=line[1:].split(':',1)
+        if len(kyval) == 2 and kyval[0].strip() != '':
+            info[kyval[0].strip()]=kyval[1].strip()
+    #detect the delimiter from the column header
+    header=next(line for line in text.splitlines() if line.strip() != '' and not line.startswith('#'))
+    sep=max([',',';','\t'],key=header.count)
+    df=pd.read_csv(io.StringIO(text),comment='#',sep=sep,skipinitialspace=True)
+    if len(df) == 0:
+        raise APIDataNotFound(f"No data found for {dah_id}")
+    tcol=_findcolumn(df.columns,("datetime","date","time"))
+    hcol=_findcolumn(df.columns,("water_level","height","wse"))
+    ecol=_findcolumn(df.columns,("error","water_level_error","wl_err","uncertainty"))
+    return info,_wlDataset(df[tcol],df[hcol].to_numpy(dtype=float),df[ecol].to_numpy(dtype=float))
+
+def decodeNetcdfWaterlevel(content,dah_id=None):
+    """Decode a netcdf water level download (read from memory)"""
+    with ncDset("dahiti.nc",memory=content) as nc:
+        ds=xr.open_dataset(xr.backends.NetCDF4DataStore(nc)).load()
+    if ds.sizes.get('time',0) == 0:
+        raise APIDataNotFound(f"No data found for {dah_id}")
+    hvar=_findcolumn(ds.data_vars,("water_level","height","wse"))
+    evar=_findcolumn(ds.data_vars,("error","water_level_error","wl_err","uncertainty"))
+    info={ky:(val.item() if hasattr(val,"item") else val) for ky,val in ds.attrs.items()}
+    return info,_wlDataset(ds.time.values,ds[hvar].values.astype(float),ds[evar].values.astype(float))
+
+#available decoders of the download-water-level formats
+wldecoders={"csv":decodeCsvWaterlevel,"json":decodeJsonWaterlevel}
+if ncDset is not None:
+    wldecoders["netcdf"]=decodeNetcdfWaterlevel
 
 class DahitiConnect:
     rooturl="https://dahiti.dgfi.tum.de/api/v2/"
-    def __init__(self,apikey=None):
+    #download formats in order of preference (json is always the last resort)
+    wlformats=["netcdf","csv","json"]
+    def __init__(self,apikey=None,wlformats=None,cache=None):
         if apikey is None:
-            apikey=getpass.getpass("Please input your Dahiti v2 API v2 key")
+            apikey=askCredential("Please input your Dahiti v2 API v2 key")
         self.argsbase=dict(api_key=apikey)
+        self.wlformats=[wlformat for wlformat in (self.wlformats if wlformats is None else wlformats) if wlformat in wldecoders]
+        if "json" not in self.wlformats:
+            self.wlformats.append("json")
+        #the formats are dropped from (dask or pipeline) worker threads
+        self._formatlock=threading.Lock()
+        #in-memory cache of decoded series (None: shared pyaltim.core.cache.stationcache, False: no caching)
+        self.cache=connectorCache(cache)
+        #versions of the targets (last update from list_targets), series are only cached when their version is known
+        self.fingerprints={}
 
     def list_targets(self,geom=None):
     
@@ -36,35 +158,74 @@ class DahitiConnect:
             args={ky:geom.bounds[i] for i,ky in enumerate(['min_lon','min_lat','max_lon','max_lat'])}
         
         targets=self._handle_resp("list-targets",args)['data']
-        exportkeys=[ky for ky in targets[0].keys() if ky not in ['longitude','latitude','data_access']]
-
-
-        dfdict={colky:[val[colky] for val in targets] for colky in exportkeys}
-        # only keep valid data_access prodcuts
-        dfdict['data_access']=[[f"{ky}:{da}" for ky,da in target['data_access'].items() if da is not None] for target in targets]
-        # make shapely points for the locations
-        targetpoints=[Point(data['longitude'],data['latitude']) for data in targets] 
-
-        gdftargets= gpd.GeoDataFrame(dfdict,geometry=targetpoints)
-        # get rid of entries which have no data_access product
-        # gdftargets=gdftargets[gdftargets.data_access != []]
-        if geom is not None:
-            #apply a second selection criteria (within the actual geometry not just the bounding box
-            gdftargets=gdftargets[gdftargets.within(geom)]
-        gdftargets=gdftargets.explode('data_access')
-        gdftargets.set_crs('EPSG:4326',inplace=True)
-        return gdftargets
+        gdf=dahitiTargets2gdf(targets,geom)
+        if 'last_update' in gdf.columns:
+            valid=gdf.last_update.notna()
+            self.fingerprints.update(zip(gdf.dahiti_id[valid],gdf.last_update[valid].astype(str)))
+        return gdf
    
-    def get_waterlevel(self,dah_id):
-        args={"format":"json","dahiti_id":dah_id}
-        waterlevel=self._handle_resp("download-water-level",args)
-        if len(waterlevel['data']) == 0:
-            raise APIDataNotFound(f"No data found for {dah_id}")
-        
-        ds=xr.Dataset(dict(water_level=('time',[val['water_level'] for val in waterlevel['data']]),wl_err=('time',[val['error'] for val in waterlevel['data']])),coords=dict(time=('time',[val['datetime'] for val in waterlevel['data']])))
-        return waterlevel['info'],ds
-        # df=pd.DataFrame(dict(time=[np.datetime64(val['datetime']) for val in waterlevel['data']],water_level=[val['water_level'] for val in waterlevel['data']],wl_err=[val['error'] for val in waterlevel['data']]))
-        # return waterlevel['info'],df
+    def get_waterlevel(self,dah_id,fingerprint=None):
+        """Download and decode the water levels of a target, repeated calls are served from the in-memory cache
+        The fingerprint (e.g. the upstream last update) distinguishes versions of the series, it defaults to the last update of the target from list_targets.
+        Without a known version the series is not cached
+        """
+        if fingerprint is None:
+            fingerprint=self.fingerprints.get(dah_id)
+        if self.cache is not None:
+            result=self.cache.get("dahiti",dah_id,"water_level_altimetry",fingerprint)
+            if result is not None:
+                return result
+        result=self.parse_waterlevel(self.fetch_waterlevel(dah_id),dah_id)
+        if self.cache is not None:
+            self.cache.put("dahiti",dah_id,"water_level_altimetry",fingerprint,result)
+        return result
+
+    def invalidate_cache(self,dah_id=None):
+        """Remove cached series (of one or all targets) from the in-memory cache"""
+        if self.cache is not None:
+            return self.cache.invalidate("dahiti",dah_id)
+        return 0
+
+    def fetch_waterlevel(self,dah_id):
+        """Download the raw water level response (without decoding it into a dataset)
+        The formats are tried in order of preference, formats which the API refuses are not tried again
+        returns:
+            (format, payload) tuple, where the payload are the decoded json or the raw bytes of the other formats
+        """
+        with self._formatlock:
+            wlformats=list(self.wlformats)
+        for wlformat in wlformats:
+            args={"format":wlformat,"dahiti_id":dah_id}
+            try:
+                return wlformat,self._handle_resp("download-water-level",args,raw=(wlformat != "json"))
+            except APIOtherError as exc:
+                if wlformat == "json":
+                    raise
+                self._dropformat(wlformat,exc.message)
+        raise APIOtherError("No usable Dahiti download format left")
+
+    def parse_waterlevel(self,waterlevel,dah_id=None):
+        """Decode a raw water level response into the target info and a dataset"""
+        if isinstance(waterlevel,dict):
+            #plain json response
+            waterlevel=("json",waterlevel)
+        wlformat,payload=waterlevel
+        try:
+            with altmetrics.timer("dahiti.parse"):
+                return wldecoders[wlformat](payload,dah_id)
+        except (ValueError,KeyError,OSError) as exc:
+            if wlformat == "json":
+                raise
+            #fall back to json for this and following downloads
+            self._dropformat(wlformat,str(exc))
+            return self.parse_waterlevel(("json",self._handle_resp("download-water-level",{"format":"json","dahiti_id":dah_id})),dah_id)
+
+    def _dropformat(self,wlformat,reason):
+        with self._formatlock:
+            if wlformat in self.wlformats:
+                log.warning(f"Dahiti download format {wlformat} is not usable ({reason}), falling back to {self.wlformats[self.wlformats.index(wlformat)+1]}")
+                #replace rather than modify the list, so concurrent readers keep a consistent copy
+                self.wlformats=[fmt for fmt in self.wlformats if fmt != wlformat]
 
     def get_by_product(self,dah_id,prodname):
         if prodname == "water_level_altimetry":
@@ -72,7 +233,12 @@ class DahitiConnect:
         else:
             log.error(f"Dahiti product name {prodname} not implemented")
 
-    def _handle_resp(self,apipath,args):
+    def open_stations(self,dahiti_ids,tstart,tend,freq="D",prodname="water_level_altimetry",variables=("water_level","wl_err"),chunksize=100,lon=None,lat=None):
+        """Lazily open the series of many DAHITI targets as a dask-chunked (station,time) dataset (see pyaltim.core.lazy.openStations)"""
+        fetchchunk=singleFetcher(lambda dah_id: self.get_by_product(dah_id,prodname))
+        return openStations(fetchchunk,dahiti_ids,variables,tstart,tend,freq=freq,chunksize=chunksize,lon=lon,lat=lat,attrs=dict(source="DAHITI",product=prodname))
+
+    def _handle_resp(self,apipath,args,raw=False):
         url=self.rooturl+apipath
         if not apipath.endswith("/"):
             url+="/"
@@ -82,16 +248,16 @@ class DahitiConnect:
         s = requests.Session()
         retries = requests.adapters.Retry(total=3, backoff_factor=0.1, status_forcelist=[502, 503, 504], allowed_methods={'POST','GET'})
         s.mount(url, requests.adapters.HTTPAdapter(max_retries=retries)) 
-        response=s.get(url,json=args)
-
-        if response.status_code == 200:
-            data = json.loads(response.text)
-            # import pdb;pdb.set_trace()
-            return data
-        elif response.status_code == 429:
-            raise APILimitReached(f"Dahiti API rate limit reached {response.text}")
-        else:
-            breakpoint()
-            raise APIOtherError(f"Other API error {response.status_code},{response.text}")
+        throttle("dahiti")
+        try:
+            response=s.get(url,json=args)
+        except transientexceptions as exc:
+            raise APITransientError(f"Dahiti {apipath} failed: {exc}")
+        altmetrics.response("dahiti",response)
+        #raises APIDataNotFound, APILimitReached, APITransientError or APIOtherError for unsuccessful requests
+        checkResponse("Dahiti",response,apipath)
+        if raw:
+            return response.content
+        return json.loads(response.text)
                 
 
@@ -6,17 +6,20 @@ import geopandas as gpd
 import pandas as pd
 import os
 import requests
-from pyaltim.core.logging import altlogger as log
+from pyaltim.core.logging import altlogger as log, altmetrics
 from shapely import Point
 import numpy as np
 import xarray as xr
 from datetime import datetime
-from pyaltim.portals.api import APILimitReached,APIDataNotFound,APIOtherError
-import getpass
+from pyaltim.portals.api import APILimitReached,APIDataNotFound,APIOtherError,APITransientError,transientexceptions,checkResponse,askCredential
 from html.parser import HTMLParser
 from io import StringIO
 from gzip import GzipFile
 import re
+from pyaltim.core.lazy import openStations,singleFetcher
+from pyaltim.core.ratelimit import throttle
+from pyaltim.core.cache import connectorCache,fileFingerprint
+from pyaltim.portals.inventory import diffInventory,saveDiff,inventoryFile,existingInventory,saveInventory,loadInventory
 
 dlookup={'1':"SWE",'2':"WL",'3':"RD",'4':"WSch"}
 #note: png color names do not match actual colors
@@ -102,35 +105,43 @@ class HydrosatConnect:
 
     """
     rooturl="https://hydrosat.gis.uni-stuttgart.de"
-    def __init__(self,user=None,passw=None,cachedir=None):
+    def __init__(self,user=None,passw=None,cachedir=None,invformat="parquet",cache=None):
         if cachedir is None:
             self.cachedir='hydrosat_cache'
         else:
             self.cachedir=cachedir
         
         if user is None:
-            user=input("Please input your Hydrosat username")
+            user=askCredential("Please input your Hydrosat username",secret=False)
         if passw is None:
-            passw=getpass.getpass("Please input your Hydrosat password")
+            passw=askCredential("Please input your Hydrosat password")
         self.user=user
         self.passw=passw
+        #in-memory cache of decoded series (None: shared pyaltim.core.cache.stationcache, False: no caching)
+        self.cache=connectorCache(cache)
 
         self.cookies={}
         if self.user is not None and self.passw is not None:
             self.cookies=self.login()
     
         #possibly load cached inventory
-        self.cacheinvent=os.path.join(self.cachedir,"Hydrosat_holdings.gpkg")
-        if os.path.exists(self.cacheinvent):
-            self.gdfinvent=gpd.read_file(self.cacheinvent)
+        #invformat='parquet' is faster to load and allows partial reading (see read_inventory), 'gpkg' writes a GeoPackage
+        self.cacheinvent=inventoryFile(self.cachedir,"Hydrosat_holdings",invformat)
+        previnvent=existingInventory(self.cacheinvent)
+        if previnvent is not None:
+            self.gdfinvent=loadInventory(previnvent)
         else:
             #empty version 
             self.gdfinvent=None
+        #difference with respect to the previous inventory (set by refresh_inventory)
+        self.inventdiff=None
     
     def login(self):
         """Login to the Hydrosat website"""
         url=self.rooturl+"/php/ajax.php?r=200"
+        throttle("hydrosat")
         resp=requests.post(url,data={"email":self.user,"pass":self.passw},verify=False)
+        altmetrics.response("hydrosat",resp)
         if resp.status_code != 200:
             raise APIOtherError(f"Login failed with status code {resp.status_code}")
         self.cookies=resp.cookies.get_dict() 
@@ -141,7 +152,23 @@ class HydrosatConnect:
             fgpkg=self.cacheinvent
         if self.gdfinvent is None:
             raise RuntimeError("No inventory to save")
-        self.gdfinvent.to_file(fgpkg,driver="GPKG")
+        if self.inventdiff is not None:
+            saveDiff(self.inventdiff,fgpkg)
+            if len(self.inventdiff) == 0 and os.path.exists(fgpkg):
+                #nothing changed, so no need to rewrite the inventory
+                return
+        saveInventory(self.gdfinvent,fgpkg)
+
+    def read_inventory(self,bbox=None,columns=None):
+        """Read a part of the cached inventory without loading the complete table
+        Parameters
+        ----------
+        bbox : optional (minx,miny,maxx,maxy) area of interest
+        columns : optional list of columns to load
+        """
+        if not os.path.exists(self.cacheinvent):
+            self.refresh_inventory()
+        return loadInventory(self.cacheinvent,bbox=bbox,columns=columns)
     
     def refresh_inventory(self,geom=None,save=True):
         """
@@ -165,12 +192,15 @@ class HydrosatConnect:
             renew=True
 
         if renew:
+            throttle("hydrosat")
             resp=requests.get(url,verify=False)
+            altmetrics.response("hydrosat",resp)
             if resp.status_code == 200:
                 with open(fcache,"w") as f:
                     f.write(resp.text)
             hydrosatparser.feed(resp.text)
         else:
+            altmetrics.count("hydrosat.cache_hits")
             with open(fcache,"r") as f:
                 hydrosatparser.feed(f.read())
         
@@ -178,23 +208,30 @@ class HydrosatConnect:
         url_search=self.rooturl+"/php/ajax.php?r=4.2&title="
         if os.path.exists(fcache_search) and os.path.getmtime(fcache_search) > datetime.now().timestamp()-86400:
             #renew catalogue
-            renew=True
-        else:
             renew=False
+        else:
+            renew=True
 
         if renew:
+            throttle("hydrosat")
             resp=requests.get(url_search,verify=False)
+            altmetrics.response("hydrosat",resp)
             if resp.status_code == 200:
                 with open(fcache_search,"w") as f:
                     f.write(resp.text)
             hydrosatparser.feed(resp.text)
         else:
+            altmetrics.count("hydrosat.cache_hits")
             with open(fcache_search,"r") as f:
                 hydrosatparser.feed(f.read())
        
         #join the two dataframes on the current_id
         gdfinvent_combined=pd.merge(hydrosatparser.df_search,hydrosatparser.gdfinvent, on=['current_id','data_type','source_id'],how='inner')
-        self.gdfinvent=gpd.GeoDataFrame(gdfinvent_combined,geometry='geometry',crs=4326)
+        gdfinvent=gpd.GeoDataFrame(gdfinvent_combined,geometry='geometry',crs=4326)
+        #compare with the previous inventory
+        self.inventdiff=diffInventory(self.gdfinvent,gdfinvent,['hyd_no','data_type'])
+        log.info(f"Hydrosat inventory: {self.inventdiff.change.value_counts().to_dict()}")
+        self.gdfinvent=gdfinvent
         if save:
             self.save_inventory()
         return self.gdfinvent
@@ -214,6 +251,7 @@ class HydrosatConnect:
         else:
             return self.gdfinvent[self.gdfinvent.within(geom) & (self.gdfinvent.data_type == data_type)]
 
+    @altmetrics.timer("hydrosat.parse")
     def parse_hydrosat_txt(self,gztxtfile):
         time=[]
         data=[]
@@ -246,6 +284,27 @@ class HydrosatConnect:
         return headerdict,ds
                 
     def get_by_product(self,hyd_no,prodname):
+        fout=self.download_by_product(hyd_no,prodname)
+        #reuse the decoded series as long as the downloaded file is unchanged
+        fingerprint=fileFingerprint(fout)
+        if self.cache is not None:
+            result=self.cache.get("hydrosat",hyd_no,prodname,fingerprint)
+            if result is not None:
+                return result
+        #parse the data into a xarray dataset and metadata
+        header,ds=self.parse_hydrosat_txt(fout)
+        if self.cache is not None:
+            self.cache.put("hydrosat",hyd_no,prodname,fingerprint,(header,ds))
+        return header,ds
+
+    def invalidate_cache(self,hyd_no=None,prodname=None):
+        """Remove cached series from the in-memory cache"""
+        if self.cache is not None:
+            return self.cache.invalidate("hydrosat",hyd_no,prodname)
+        return 0
+
+    def download_by_product(self,hyd_no,prodname):
+        """Download (or reuse a recently cached) data file of a Hydrosat product and return its path"""
         if self.gdfinvent is None:
             self.refresh_inventory()
         
@@ -266,16 +325,26 @@ class HydrosatConnect:
         
         if renew:
             #download data
-            resp=requests.get(url,verify=False,cookies=self.cookies)
-            if resp.status_code == 404:
-                raise APIDataNotFound(f"No data found for {hyd_no}")
-            elif resp.status_code != 200:
-                breakpoint()
-                raise APIOtherError(f"Failed to retrieve data from {url}")
+            throttle("hydrosat")
+            try:
+                resp=requests.get(url,verify=False,cookies=self.cookies)
+            except transientexceptions as exc:
+                raise APITransientError(f"Hydrosat download of {hyd_no} failed: {exc}")
+            altmetrics.response("hydrosat",resp)
+            checkResponse("Hydrosat",resp,f"download of {hyd_no}")
             with GzipFile(fout,"w") as fid:
                 fid.write(resp.content)
-        #parse the data into a xarray dataset and metadata
-        header,ds=self.parse_hydrosat_txt(fout)
-        return header,ds
+        else:
+            altmetrics.count("hydrosat.cache_hits")
+        return fout
 
         
+
+    def open_stations(self,hyd_nos,tstart,tend,freq="D",prodname="WL",variables=("water_level","water_level_err"),chunksize=100):
+        """Lazily open the series of many Hydrosat targets as a dask-chunked (station,time) dataset (see pyaltim.core.lazy.openStations)"""
+        if self.gdfinvent is None:
+            self.refresh_inventory()
+        #take the station locations from the inventory
+        invent=self.gdfinvent[self.gdfinvent.data_type == prodname].drop_duplicates('hyd_no').set_index('hyd_no').reindex(hyd_nos)
+        fetchchunk=singleFetcher(lambda hyd_no: self.get_by_product(hyd_no,prodname))
+        return openStations(fetchchunk,hyd_nos,variables,tstart,tend,freq=freq,chunksize=chunksize,lon=invent.geometry.x.values,lat=invent.geometry.y.values,attrs=dict(source="Hydrosat",product=prodname))
@@ -7,13 +7,16 @@ from shapely import Point, MultiPoint
 import numpy as np
 from pystac_client import Client
 from pystac_client.exceptions import APIError
-from pyaltim.core.logging import altlogger
+from pyaltim.core.logging import altlogger, altmetrics
 import json
 import shapely
 import requests
 import xarray as xr
-from pyaltim.portals.api import APILimitReached
-import getpass
+from pyaltim.portals.api import APILimitReached,APIDataNotFound,APITransientError,transientexceptions,checkResponse,askCredential
+from concurrent.futures import ThreadPoolExecutor
+from pyaltim.core.lazy import openStations,singleFetcher
+from pyaltim.core.ratelimit import throttle
+from pyaltim.core.cache import connectorCache
 
 def decyear2dt(decyear):
     """Convert a decimal year to a datetime object"""
@@ -165,11 +168,18 @@ def readHydroWeb_Rivers(file_obj):
     return hwbdict,dout
 
 
+def geojson2shapely(geometries):
+    """Convert a list of GeoJSON geometry dictionaries to shapely geometries (vectorized when all are points)"""
+    if all(geo['type'] == "Point" for geo in geometries):
+        return shapely.points(np.array([geo['coordinates'][0:2] for geo in geometries]).reshape(-1,2))
+    return [shapely.geometry.shape(geo) for geo in geometries]
+
+
 class HydrowebConnect:
     products=["HYDROWEB_RIVERS_RESEARCH","HYDROWEB_RIVERS_OPE","HYDROWEB_LAKES_RESEARCH","HYDROWEB_LAKES_OPE"]
-    def __init__(self,collection_id,apikey=None):
+    def __init__(self,collection_id,apikey=None,cache=None):
         if apikey is None:
-            apikey=getpass.getpass("Please enter apikey for hydroweb next (theia)")
+            apikey=askCredential("Please enter apikey for hydroweb next (theia)")
         if collection_id not in self.products:
             raise RuntimeError(f"Collection_id must be one of {self.products}")
         self.collection_id=collection_id
@@ -185,12 +195,18 @@ class HydrowebConnect:
         else:
             self.readasset=readHydroWeb_Rivers
         self.apicalls=0
+        #in-memory cache of decoded series (None: shared pyaltim.core.cache.stationcache, False: no caching)
+        self.cache=connectorCache(cache)
+        #versions (checksum or update time) of the items from the last get_items call
+        self.fingerprints={}
 
     @property
     def client(self):
         if self._client is None:
-            self._client=Client.open(self._catalogurl,headers=self.headers)
+            with altmetrics.timer("hydroweb.latency"):
+                self._client=Client.open(self._catalogurl,headers=self.headers)
             self.apicalls+=1
+            altmetrics.count("hydroweb.requests")
         
         return self._client
 
@@ -199,58 +215,152 @@ class HydrowebConnect:
         if self._collection is None:
 
             try:
-                self._collection=self.client.get_collection(self.collection_id)
+                with altmetrics.timer("hydroweb.latency"):
+                    self._collection=self.client.get_collection(self.collection_id)
                 self.apicalls+=1
+                altmetrics.count("hydroweb.requests")
             except APIError:
                 raise APILimitReached(f"Collection {self.collection_id} not found or API limit reached")
         return self._collection
 
 
-    def get_items(self,geom=None):
-        """Get a dataframe of the items in the collection"""
-        geoms=[]
-        item_id=[]
-        tstart=[]
-        tend=[]
-        if geom is None:
-            searchitems=self.collection.get_items()
+    def _search_dicts(self,collections,bbox,pagesize):
+        """Enumerate the raw item dictionaries of a (bbox restricted) search page by page"""
+        features=[]
+        search=self.client.search(collections=collections,bbox=bbox,limit=pagesize)
+        with altmetrics.timer("hydroweb.latency"):
+            for page in search.pages_as_dicts():
+                throttle("hydroweb")
+                self.apicalls+=1
+                altmetrics.count("hydroweb.requests")
+                features.extend(page['features'])
+        return features
+
+    def get_items(self,geom=None,collections=None,pagesize=1000,tiles=None,nworkers=4):
+        """Get a dataframe of the items in the collection
+        Parameters
+        ----------
+        geom : optional geometry to restrict the search to
+        collections : list of collections to enumerate in one pass (defaults to the collection of this instance), e.g. HydrowebConnect.products
+        pagesize : number of items requested per page
+        tiles : optional (nlon,nlat) tuple to split the search bbox in tiles which are queried concurrently
+        nworkers : number of concurrent tile queries
+
+        returns:
+            A geopandas dataframe with the items (and a collection column)
+        """
+        if collections is None:
+            collections=[self.collection_id]
+        # for some reason polygon query does not work so lets stick to bbox restriction
+        bbox=(-180.0,-90.0,180.0,90.0) if geom is None else geom.bounds
+        if tiles is None:
+            bboxes=[None if geom is None else bbox]
         else:
-            # for some reason polygon query does not work so lets stick to bbox restriction
-            searchitems=self.client.search(collections=[self.collection_id],bbox=geom.bounds).items()
-
-            # searchitems=self.client.search(collections=self._collection,intersects=geom).items()
-        for item in searchitems:
-            geoms.append(shapely.from_geojson(json.dumps(item.geometry)))
-            item_id.append(item.id)
-            tstart.append(item.common_metadata.start_datetime)
-            tend.append(item.common_metadata.end_datetime)
-
-        gdf=gpd.GeoDataFrame(dict(tstart=tstart,tend=tend,item_id=item_id),geometry=geoms,crs="EPSG:4326")
+            lonedges=np.linspace(bbox[0],bbox[2],tiles[0]+1)
+            latedges=np.linspace(bbox[1],bbox[3],tiles[1]+1)
+            bboxes=[(lonedges[i],latedges[j],lonedges[i+1],latedges[j+1]) for i in range(tiles[0]) for j in range(tiles[1])]
+        
+        #make sure the client is opened before starting threads
+        self.client
+        with ThreadPoolExecutor(max_workers=nworkers) as executor:
+            tileresults=list(executor.map(lambda tilebbox: self._search_dicts(collections,tilebbox,pagesize),bboxes))
+
+        #remove duplicates (items on tile boundaries)
+        features={}
+        for tilefeatures in tileresults:
+            for feat in tilefeatures:
+                features[(feat.get('collection'),feat['id'])]=feat
+        features=list(features.values())
+        altmetrics.count("hydroweb.items",len(features))
+
+        props=[feat['properties'] for feat in features]
+        #keep the asset metadata so the assets can be downloaded directly later on
+        firstassets=[next(iter(feat.get('assets',{}).values()),{}) for feat in features]
+        gdf=gpd.GeoDataFrame(dict(tstart=pd.to_datetime([prop.get('start_datetime') for prop in props],utc=True),
+            tend=pd.to_datetime([prop.get('end_datetime') for prop in props],utc=True),
+            item_id=[feat['id'] for feat in features],
+            collection=[feat.get('collection') for feat in features],
+            asset_href=[asset.get('href') for asset in firstassets],
+            updated=pd.to_datetime([prop.get('updated') for prop in props],utc=True),
+            checksum=[asset.get('file:checksum') for asset in firstassets]),
+            geometry=geojson2shapely([feat['geometry'] for feat in features]),crs="EPSG:4326")
         if geom is not None:
             gdf=gdf[gdf.geometry.within(geom)]
+        #items without checksum and update time have no known version (and are not cached)
+        fingerprints=gdf.checksum.fillna(gdf.updated.astype(str).where(gdf.updated.notna()))
+        valid=fingerprints.notna()
+        self.fingerprints.update(zip(gdf.item_id[valid],fingerprints[valid]))
 
         return gdf
 
-    def get_asset(self,item_id):
-        #get the first asset (only) and download the data from the url
-        try:
-            firstasset=next(iter(self.collection.get_item(item_id).assets.values()))
-            asseturl=firstasset.href
-
+    def get_asset(self,item_id,asseturl=None,fingerprint=None):
+        """Download and decode an item, repeated calls are served from the in-memory cache
+        The fingerprint defaults to the checksum (or update time) of the item from get_items
+        """
+        if fingerprint is None:
+            fingerprint=self.fingerprints.get(item_id)
+        if self.cache is not None:
+            result=self.cache.get("hydroweb",item_id,self.collection_id,fingerprint)
+            if result is not None:
+                return result
+        text=self.download_asset(item_id,asseturl)
+        with altmetrics.timer("hydroweb.parse"):
+            result=self.readasset(io.StringIO(text))
+        if self.cache is not None:
+            self.cache.put("hydroweb",item_id,self.collection_id,fingerprint,result)
+        return result
+
+    def invalidate_cache(self,item_id=None):
+        """Remove cached series (of one or all items of the collection) from the in-memory cache"""
+        if self.cache is not None:
+            return self.cache.invalidate("hydroweb",item_id,self.collection_id)
+        return 0
+
+    def download_asset(self,item_id,asseturl=None):
+        """Download the text of the (first) asset of an item
+        When the asset url is known (e.g. from the asset_href column of get_items) the item lookup is skipped
+        """
+        if asseturl is None:
+            #get the first asset (only) and download the data from the url
+            throttle("hydroweb")
+            try:
+                with altmetrics.timer("hydroweb.latency"):
+                    item=self.collection.get_item(item_id)
+            except transientexceptions as exc:
+                raise APITransientError(f"Hydroweb lookup of {item_id} failed: {exc}")
+            except APIError as exc:
+                status=getattr(exc,"status_code",None)
+                if status in (404,410):
+                    raise APIDataNotFound(f"Hydroweb item {item_id} not found")
+                elif status == 429:
+                    raise APILimitReached(f"Reached API limit {self.apicalls} for hydroweb-next")
+                raise APITransientError(f"Hydroweb lookup of {item_id} failed: {exc}")
             self.apicalls+=1
-
-            s = requests.Session()
-            retries = requests.adapters.Retry(total=2, backoff_factor=0.1, status_forcelist=[502, 503, 504], allowed_methods={'POST','GET'})
-            s.mount(asseturl, requests.adapters.HTTPAdapter(max_retries=retries)) 
-            
+            altmetrics.count("hydroweb.requests")
+            if item is None or len(item.assets) == 0:
+                raise APIDataNotFound(f"No asset found for {item_id}")
+            asseturl=next(iter(item.assets.values())).href
+
+        s = requests.Session()
+        retries = requests.adapters.Retry(total=2, backoff_factor=0.1, status_forcelist=[502, 503, 504], allowed_methods={'POST','GET'})
+        s.mount(asseturl, requests.adapters.HTTPAdapter(max_retries=retries)) 
+        
+        throttle("hydroweb")
+        try:
             req=s.get(asseturl,headers=self.headers)
-            
-            self.apicalls+=1
-            df=self.readasset(io.StringIO(req.text))
-        except:
-            raise APILimitReached(f"Reached API limit {self.apicalls} for hydroweb-next?")
-
-        return df
+        except transientexceptions as exc:
+            raise APITransientError(f"Hydroweb download of {item_id} failed: {exc}")
+        altmetrics.response("hydroweb",req)
+        self.apicalls+=1
+        #raises APIDataNotFound, APILimitReached, APITransientError or APIOtherError for unsuccessful requests
+        checkResponse("Hydroweb",req,f"download of {item_id}")
+
+        return req.text
+
+    def open_stations(self,item_ids,tstart,tend,freq="D",variables=("water_level","water_level_std"),chunksize=100,lon=None,lat=None):
+        """Lazily open the series of many Hydroweb items as a dask-chunked (station,time) dataset (see pyaltim.core.lazy.openStations)"""
+        fetchchunk=singleFetcher(self.get_asset)
+        return openStations(fetchchunk,item_ids,variables,tstart,tend,freq=freq,chunksize=chunksize,lon=lon,lat=lat,attrs=dict(source="Hydroweb",product=self.collection_id))
 
         
 
@@ -0,0 +1,121 @@
+## Helpers to compare and persist target inventories of the portals
+
+import os
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+#supported cache formats and their file extensions
+invformats={"gpkg":".gpkg","parquet":".parquet"}
+
+def inventoryFile(cachedir,name,invformat="parquet"):
+    """Return the path of a cached inventory in the requested format ('parquet' or 'gpkg')"""
+    if invformat not in invformats:
+        raise ValueError(f"Unknown inventory format {invformat}, choose from {list(invformats)}")
+    return os.path.join(cachedir,name+invformats[invformat])
+
+def existingInventory(invfile):
+    """Return the inventory file, or the same inventory in another format when only that one exists (e.g. a cache written as GeoPackage by an older version), or None"""
+    if os.path.exists(invfile):
+        return invfile
+    base,ext=os.path.splitext(invfile)
+    for other in invformats.values():
+        if os.path.exists(base+other):
+            return base+other
+    return None
+
+def saveInventory(gdf,invfile,rowgroupsize=10000):
+    """Write an inventory, the format follows from the file extension
+    GeoParquet files are written in row groups with a bounding box covering column, so they can be partially read for an area of interest
+    """
+    if os.path.exists(invfile):
+        os.remove(invfile)
+    if invfile.endswith(".parquet"):
+        #spatially sort the targets so the row groups have compact bounding boxes
+        if len(gdf) > 0:
+            gdf=gdf.iloc[np.argsort(gdf.geometry.hilbert_distance())]
+        gdf.to_parquet(invfile,write_covering_bbox=True,row_group_size=rowgroupsize)
+    else:
+        gdf.to_file(invfile,driver="GPKG")
+    return invfile
+
+def loadInventory(invfile,bbox=None,columns=None):
+    """Read a (part of an) inventory
+    Parameters
+    ----------
+    invfile : GeoPackage or GeoParquet file
+    bbox : optional (minx,miny,maxx,maxy) tuple to only load targets in this bounding box
+    columns : optional list of columns to load (the geometry is always loaded)
+
+    returns:
+        A geopandas dataframe
+    """
+    if invfile.endswith(".parquet"):
+        if columns is not None:
+            #make sure the geometry column is also loaded
+            columns=list(columns)+[col for col in ["geometry"] if col not in columns]
+        gdf=gpd.read_parquet(invfile,columns=columns,bbox=bbox)
+        if bbox is not None:
+            #row group filtering is coarse, so remove targets outside of the box
+            gdf=gdf[gdf.intersects(shapely.box(*bbox))]
+        return gdf
+    return gpd.read_file(invfile,bbox=bbox,columns=columns)
+
+
+def diffInventory(gdfold,gdfnew,key):
+    """Compute the difference between a previous and a current inventory
+    Parameters
+    ----------
+    gdfold : previous inventory (or None)
+    gdfnew : current inventory
+    key : column name or list of column names which identify a target
+
+    returns:
+        A geopandas dataframe with the added, changed (current values) and removed (previous values) targets and a 'change' column
+    """
+    if isinstance(key,str):
+        key=[key]
+    new=gdfnew.drop_duplicates(key).set_index(key)
+    if gdfold is None or len(gdfold) == 0:
+        diff=new.assign(change="added")
+        return gpd.GeoDataFrame(diff.reset_index(),geometry=gdfnew.geometry.name,crs=gdfnew.crs)
+
+    old=gdfold.drop_duplicates(key).set_index(key)
+    added=new.index.difference(old.index)
+    removed=old.index.difference(new.index)
+    common=new.index.intersection(old.index)
+
+    changed=np.zeros(len(common),dtype=bool)
+    oldc=old.loc[common]
+    newc=new.loc[common]
+    geomcol=gdfnew.geometry.name
+    for col in newc.columns:
+        if col not in oldc.columns:
+            continue
+        if col == geomcol:
+            changed|=~shapely.equals_exact(oldc[col].values,newc[col].values,tolerance=1e-7)
+        else:
+            #compare string representations, as types may differ after a round trip through the cache file
+            oldval=oldc[col].astype(str).values
+            newval=newc[col].astype(str).values
+            changed|=(oldval != newval) & ~(oldc[col].isna().values & newc[col].isna().values)
+
+    diff=pd.concat([new.loc[added].assign(change="added"),newc[changed].assign(change="changed"),old.loc[removed].assign(change="removed")])
+    return gpd.GeoDataFrame(diff.reset_index(),geometry=geomcol,crs=gdfnew.crs)
+
+def diffFile(invfile):
+    """Return the file name of the inventory difference which belongs to an inventory file"""
+    base,ext=os.path.splitext(invfile)
+    return base+"_diff"+ext
+
+def saveDiff(diff,invfile):
+    """Persist an inventory difference next to the inventory file (an empty difference is also written)"""
+    return saveInventory(diff,diffFile(invfile))
+
+def loadDiff(invfile):
+    """Load the last persisted inventory difference (or None), together with its modification time"""
+    fdiff=diffFile(invfile)
+    if not os.path.exists(fdiff):
+        return None,None
+    return loadInventory(fdiff),os.path.getmtime(fdiff)
@@ -0,0 +1,92 @@
+## Grid index of the RADS pass coverage: which (mission, pass, segment) entries cross a cell of a fixed global grid
+
+import numpy as np
+import pandas as pd
+import shapely
+from sqlalchemy import text
+from pyaltim.core.logging import altlogger
+
+schema="pyaltim"
+
+coveragetable=f"{schema}.radscoverage"
+
+#default size of the (square, lon/lat) grid cells in degrees, an index keeps the size it was built with in its geoslurp inventory entry
+coveragecellsize=1.0
+
+def missionTable(mission):
+    """Name of the rads table of a mission/phase identifier (e.g. 'j3a')"""
+    return f"{schema}.rads_{mission[0:2]}_{mission[2:3]}"
+
+def coverageCells(geom,cellsize=coveragecellsize):
+    """Return the (i,j) indices of the grid cells which intersect a geometry
+    The cells follow PostGIS ST_SquareGrid: cell (i,j) spans [i*cellsize,(i+1)*cellsize) in longitude and [j*cellsize,(j+1)*cellsize) in latitude
+    """
+    minx,miny,maxx,maxy=geom.bounds
+    ii,jj=np.meshgrid(np.arange(np.floor(minx/cellsize),np.floor(maxx/cellsize)+1,dtype=int),np.arange(np.floor(miny/cellsize),np.floor(maxy/cellsize)+1,dtype=int),indexing="ij")
+    ii=ii.ravel()
+    jj=jj.ravel()
+    boxes=shapely.box(ii*cellsize,jj*cellsize,(ii+1)*cellsize,(jj+1)*cellsize)
+    hit=np.flatnonzero(shapely.intersects(boxes,geom))
+    #the cells are half-open, so drop cells which the geometry only touches at their right or upper edge
+    x0,y0,x1,y1=ii[hit]*cellsize,jj[hit]*cellsize,(ii[hit]+1)*cellsize,(jj[hit]+1)*cellsize
+    edges=shapely.linestrings(np.stack([np.column_stack([x1,y0]),np.column_stack([x1,y1]),np.column_stack([x0,y1])],axis=1))
+    hit=hit[~shapely.covered_by(shapely.intersection(boxes[hit],geom),edges)]
+    return ii[hit],jj[hit]
+
+def coverageCellsize(dbeng):
+    """Cell size of the coverage index as stored in its geoslurp inventory entry (the default coveragecellsize when it is not stored)"""
+    qry="SELECT data->>'cellsize' FROM admin.inventory WHERE scheme = :schema AND dataset = :dataset"
+    with dbeng.connect() as conn:
+        cellsize=conn.execute(text(qry),dict(schema=schema,dataset=coveragetable.split(".")[1])).scalar()
+    return coveragecellsize if cellsize is None else float(cellsize)
+
+def updateCoverage(dbeng,mission,cellsize=None):
+    """Add the passes of a mission which are not yet in the coverage index (and drop entries of passes which were removed)
+    Only passes with an id larger than the largest indexed one are processed, so re-registered passes (which get a new id) are included as well
+    The cell size defaults to the one stored with the index (see coverageCellsize)
+
+    returns:
+        the number of added index entries
+    """
+    if cellsize is None:
+        cellsize=coverageCellsize(dbeng)
+    tbl=missionTable(mission)
+    qry=f"""
+        INSERT INTO {coveragetable} (i,j,mission,passid,cycle,apass,iseg)
+        SELECT g.i, g.j, :mission, t.id, t.cycle, t.apass, d.path[1]-1
+        FROM {tbl} AS t CROSS JOIN LATERAL ST_Dump(ST_Force2D(t.geom::geometry)) AS d
+        CROSS JOIN LATERAL ST_SquareGrid(:cellsize,ST_SetSRID(d.geom,4326)) AS g
+        WHERE t.id > (SELECT COALESCE(max(passid),0) FROM {coveragetable} WHERE mission = :mission) AND ST_Intersects(g.geom,d.geom)
+        """
+    cleanup=f"DELETE FROM {coveragetable} AS c WHERE c.mission = :mission AND NOT EXISTS (SELECT 1 FROM {tbl} AS t WHERE t.id = c.passid)"
+    with dbeng.begin() as conn:
+        nremoved=conn.execute(text(cleanup),dict(mission=mission)).rowcount
+        nadded=conn.execute(text(qry),dict(mission=mission,cellsize=cellsize)).rowcount
+    altlogger.info(f"Coverage index of {mission}: added {nadded}, removed {nremoved} entries")
+    return nadded
+
+def coverageLookup(dbeng,geom,missions=None,cellsize=None):
+    """Find the (mission, pass, segment) entries which cross the grid cells of an area of interest
+    This is a key lookup which returns candidates, the segments may still miss the geometry itself within a cell
+    Parameters
+    ----------
+    dbeng : sqlalchemy engine to the geoslurp database
+    geom : shapely geometry (lon,lat)
+    missions : optional list of mission/phase identifiers (e.g. ['j3a','3aa'])
+    cellsize : cell size of the index (default: the one stored with the index)
+
+    returns:
+        A pandas dataframe with the columns mission, passid, cycle, apass and iseg
+    """
+    if cellsize is None:
+        cellsize=coverageCellsize(dbeng)
+    ii,jj=coverageCells(geom,cellsize)
+    qry=f"SELECT DISTINCT c.mission, c.passid, c.cycle, c.apass, c.iseg FROM {coveragetable} AS c JOIN unnest(CAST(:ii AS int[]),CAST(:jj AS int[])) AS g(i,j) ON c.i = g.i AND c.j = g.j"
+    args=dict(ii=ii.tolist(),jj=jj.tolist())
+    if missions is not None:
+        qry+=" WHERE c.mission = ANY(:missions)"
+        args["missions"]=list(missions)
+    with dbeng.connect() as conn:
+        df=pd.DataFrame(conn.execute(text(qry),args).fetchall(),columns=["mission","passid","cycle","apass","iseg"])
+    altlogger.info(f"Found {len(df)} candidate segments in {len(ii)} grid cells")
+    return df
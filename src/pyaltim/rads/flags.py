@@ -0,0 +1,130 @@
+## Vectorized decoding of the RADS 'flags' variable into named boolean masks
+
+import numpy as np
+
+#default bit layout of the RADS flags variable (bit number: name), a set bit means:
+radsflagbits={
+        "altside":0, # altimeter side B in use
+        "singlefreq":1, # single frequency altimeter (no dual frequency ionosphere)
+        "cband":2, # secondary (C/S) band altimeter data
+        "radiometer":3, # radiometer off/unavailable
+        "land":4, # altimeter land flag
+        "nonocean":5, # altimeter ocean flag (not over open ocean)
+        "radland":6, # radiometer land flag
+        "ice":7, # ice flag
+        "rain":8, # rain flag
+        "rad18":9, # bad 18 GHz radiometer brightness temperature
+        "rad21":10, # bad 21/23 GHz radiometer brightness temperature
+        "rad37":11, # bad 37 GHz radiometer brightness temperature
+        "badrange":12, # range quality flag
+        "badswh":13, # significant wave height quality flag
+        "badsig0":14, # backscatter quality flag
+        "badorbit":15, # orbit quality flag
+        }
+
+#masks which are derived from the bits above
+derivedflags={
+        "water":lambda fl: ~fl.mask("land"),
+        "ocean":lambda fl: ~fl.mask("nonocean"),
+        "inland":lambda fl: fl.mask("nonocean") & ~fl.mask("land"),
+        "good":lambda fl: ~fl.anyof("badrange","badswh","badsig0","badorbit"),
+        }
+
+
+def bitsFromNetcdf(ncvar):
+    """Return a bit layout from the flag_masks/flag_meanings attributes of a netcdf flags variable (or None when absent)"""
+    try:
+        masks=np.atleast_1d(ncvar.getncattr("flag_masks"))
+        meanings=ncvar.getncattr("flag_meanings").split()
+    except (AttributeError,KeyError):
+        return None
+    if len(masks) != len(meanings):
+        return None
+    return {meaning:int(np.log2(mask)) for mask,meaning in zip(masks,meanings) if mask > 0 and (mask & (mask-1)) == 0}
+
+
+class RadsFlags:
+    """Decode a complete flags array at once
+    Usage:
+        fl=RadsFlags(ncrads["flags"][:])
+        fl.land # boolean array
+        fl.select(require=["water"],exclude=["ice","badrange"])
+
+    Parameters
+    ----------
+    flags : integer array with the RADS flags
+    bits : dictionary with name:bit entries (default radsflagbits)
+    """
+    def __init__(self,flags,bits=None):
+        self.flags=np.ma.filled(np.asanyarray(flags),0).astype(np.uint32)
+        self.bits=radsflagbits if bits is None else bits
+        self._cache={}
+
+    @classmethod
+    def from_netcdf(cls,ncvar):
+        """Decode a netcdf flags variable, using its own bit layout when it is described in the attributes"""
+        bits=bitsFromNetcdf(ncvar)
+        if bits is not None:
+            #keep the default names for bits which are not described
+            bits={**radsflagbits,**bits}
+        return cls(ncvar[:],bits)
+
+    def names(self):
+        return list(self.bits)+list(derivedflags)
+
+    def mask(self,name):
+        """Boolean array which is True where the named flag is set"""
+        if name not in self._cache:
+            if name in self.bits:
+                self._cache[name]=(self.flags & np.uint32(1 << self.bits[name])) != 0
+            elif name in derivedflags:
+                self._cache[name]=derivedflags[name](self)
+            else:
+                raise KeyError(f"Unknown RADS flag {name}, choose from {self.names()}")
+        return self._cache[name]
+
+    def __getattr__(self,name):
+        if name.startswith("_") or name in ("flags","bits"):
+            raise AttributeError(name)
+        try:
+            return self.mask(name)
+        except KeyError as exc:
+            raise AttributeError(str(exc))
+
+    def anyof(self,*names):
+        """True where at least one of the named flags is set"""
+        return self._combine(names,np.logical_or,False)
+
+    def allof(self,*names):
+        """True where all of the named flags are set"""
+        return self._combine(names,np.logical_and,True)
+
+    def _combine(self,names,op,init):
+        out=np.full(self.flags.shape,init)
+        for name in names:
+            out=op(out,self.mask(name))
+        return out
+
+    def select(self,require=(),exclude=()):
+        """Combined predicate: all flags in require are set and none of the flags in exclude"""
+        return self.allof(*require) & ~self.anyof(*exclude)
+
+    def to_dict(self,names=None):
+        """Dictionary with the boolean masks of the named (default all) flags"""
+        return {name:self.mask(name) for name in (self.names() if names is None else names)}
+
+
+def flagSegments(lon,split):
+    """Vectorized splitting of a track in segments: a new segment starts when the longitude jumps over the 180 degree meridian or when the split mask changes (e.g. land/water)
+    Parameters
+    ----------
+    lon : longitudes in degrees (-180..180)
+    split : boolean mask (e.g. RadsFlags(flags).land)
+
+    returns:
+        arrays with the (inclusive) start and (exclusive) end index of each segment
+    """
+    lon=np.asarray(lon)
+    split=np.asarray(split)
+    brk=np.flatnonzero((np.abs(np.diff(lon)) > 180) | (split[1:] != split[:-1]))+1
+    return np.r_[0,brk],np.r_[brk,lon.size]
@@ -0,0 +1,98 @@
+## Persisted manifest of the local RADS pass files of a mission phase, to find new and changed files quickly
+
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from pyaltim.core.logging import altlogger
+
+manifestname="manifest.parquet"
+
+def manifestFile(datadir,sat,phase):
+    """Location of the manifest of a mission phase"""
+    return os.path.join(datadir,sat,phase,manifestname)
+
+def _scanCycle(cycledir):
+    """List the netcdf files of a single cycle directory"""
+    entries=[]
+    with os.scandir(cycledir) as it:
+        for entry in it:
+            if entry.name.endswith(".nc") and entry.is_file():
+                stat=entry.stat()
+                entries.append((entry.path,stat.st_size,stat.st_mtime))
+    return entries
+
+def scanPhase(phasedir,cycles=None,nworkers=8):
+    """Scan the cycle directories of a mission phase in parallel
+    Parameters
+    ----------
+    phasedir : directory holding the cXXX cycle directories
+    cycles : optional list of cycles to scan
+    nworkers : number of threads
+
+    returns:
+        A dataframe with the path, size and mtime of the files
+    """
+    if cycles is not None:
+        cycledirs=[os.path.join(phasedir,f"c{cycle:03d}") for cycle in cycles]
+        cycledirs=[cycledir for cycledir in cycledirs if os.path.isdir(cycledir)]
+    else:
+        with os.scandir(phasedir) as it:
+            cycledirs=[entry.path for entry in it if entry.is_dir() and re.fullmatch(r"c[0-9]{3}",entry.name)]
+    with ThreadPoolExecutor(max_workers=nworkers) as executor:
+        entries=[entry for cycentries in executor.map(_scanCycle,sorted(cycledirs)) for entry in cycentries]
+    return pd.DataFrame(entries,columns=["path","size","mtime"])
+
+
+class RadsManifest:
+    """Manifest with the path, size, modification time and registration state of the files of a mission phase
+    Parameters
+    ----------
+    manifestfile : path of the (Parquet) manifest file
+    """
+    def __init__(self,manifestfile):
+        self.manifestfile=manifestfile
+        if os.path.exists(manifestfile):
+            self.df=pd.read_parquet(manifestfile)
+        else:
+            self.df=pd.DataFrame({"path":pd.Series(dtype=str),"size":pd.Series(dtype=np.int64),"mtime":pd.Series(dtype=float),"registered":pd.Series(dtype=bool)})
+
+    def update(self,dfscan,cycles=None):
+        """Merge a directory scan into the manifest
+        Parameters
+        ----------
+        dfscan : dataframe as returned by scanPhase
+        cycles : cycles which were scanned (None when the complete phase was scanned)
+
+        returns:
+            the paths which are new or changed (or not yet registered) and the paths which disappeared
+        """
+        old=self.df.set_index("path")
+        if cycles is None:
+            scanned=old.index
+        else:
+            #only files from the scanned cycles can have disappeared
+            cycpattern="|".join(f"c{cycle:03d}" for cycle in cycles)
+            scanned=old.index[old.index.str.contains(rf"/(?:{cycpattern})/")]
+        removed=scanned.difference(dfscan.path)
+
+        new=dfscan.set_index("path")
+        prev=old.reindex(new.index)
+        unchanged=(prev["size"].values == new["size"].values) & (prev["mtime"].values == new["mtime"].values)
+        new["registered"]=unchanged & prev["registered"].fillna(False).values.astype(bool)
+        todo=new.index[~new["registered"].values].tolist()
+
+        #keep the entries of cycles which were not scanned
+        keep=old.drop(index=scanned.intersection(old.index))
+        self.df=pd.concat([keep,new]).reset_index()
+        altlogger.info(f"Manifest {os.path.basename(os.path.dirname(self.manifestfile))}: {len(todo)} new or changed files, {len(removed)} removed")
+        return todo,removed.tolist()
+
+    def markregistered(self,paths):
+        self.df.loc[self.df.path.isin(paths),"registered"]=True
+
+    def save(self):
+        tmpfile=self.manifestfile+".tmp"
+        self.df.to_parquet(tmpfile,index=False)
+        os.replace(tmpfile,self.manifestfile)
@@ -0,0 +1,129 @@
+## Compact local index of the RADS pass files (one Parquet sidecar per mission phase)
+
+import os
+from glob import glob
+import numpy as np
+import pandas as pd
+import shapely
+from pyaltim.core.logging import altlogger
+
+indexname="passindex.parquet"
+
+#columns of the index (one row per track segment)
+indexcolumns=["sat","phase","uri","cycle","apass","tstart","tend","iseg","segtstart","segtend","istart","iend","land","xmin","ymin","xmax","ymax"]
+
+def passIndexFile(datadir,sat,phase):
+    """Location of the pass index of a mission phase (next to the cycle directories)"""
+    return os.path.join(datadir,sat,phase,indexname)
+
+def spatialKey(xmin,ymin,xmax,ymax,bits=10):
+    """Z-order (Morton) key of the centres of bounding boxes on a global 2^bits x 2^bits grid
+    Rows which are close in the key are close in space, so sorting on it keeps the row groups of the index spatially compact
+    """
+    ncell=1 << bits
+    ix=np.clip((0.5*(np.asarray(xmin)+np.asarray(xmax))+180)/360*ncell,0,ncell-1).astype(np.uint64)
+    iy=np.clip((0.5*(np.asarray(ymin)+np.asarray(ymax))+90)/180*ncell,0,ncell-1).astype(np.uint64)
+    key=np.zeros(ix.shape,dtype=np.uint64)
+    one=np.uint64(1)
+    for ib in range(bits):
+        key|=((ix >> np.uint64(ib)) & one) << np.uint64(2*ib)
+        key|=((iy >> np.uint64(ib)) & one) << np.uint64(2*ib+1)
+    return key
+
+def metaToRows(meta,sat,phase):
+    """Convert the metadata of a pass file (as from radsMetaDataExtractor) into index rows with a bounding box per segment"""
+    tracks=shapely.get_parts(shapely.from_wkb(bytes(meta["geom"])))
+    bounds=shapely.bounds(tracks)
+    rows=[]
+    for iseg,(segment,bnd) in enumerate(zip(meta["data"]["segments"],bounds)):
+        rows.append(dict(sat=sat,phase=phase,uri=meta["uri"],cycle=meta["cycle"],apass=meta["apass"],tstart=meta["tstart"],tend=meta["tend"],
+            iseg=iseg,segtstart=segment["tstart"],segtend=segment["tend"],istart=segment["istart"],iend=segment["iend"],land=segment["land"],
+            xmin=bnd[0],ymin=bnd[1],xmax=bnd[2],ymax=bnd[3]))
+    return rows
+
+
+class PassIndex:
+    """Collects the pass metadata of a mission phase during extraction and merges it into the Parquet sidecar
+    Parameters
+    ----------
+    indexfile : path of the Parquet file
+    sat,phase : mission and phase (e.g. '3a','a')
+    """
+    def __init__(self,indexfile,sat,phase):
+        self.indexfile=indexfile
+        self.sat=sat
+        self.phase=phase
+        self.rows=[]
+        self.removed=set()
+        self.dropall=False
+
+    def add(self,meta):
+        """Add (or replace) the entry of a pass file"""
+        self.removed.add(meta["uri"])
+        self.rows.extend(metaToRows(meta,self.sat,self.phase))
+
+    def remove(self,uris):
+        """Remove pass files from the index"""
+        self.removed.update(uris)
+
+    def clear(self):
+        """Drop all existing entries when writing (to rebuild the index from scratch)"""
+        self.dropall=True
+        self.removed=set()
+
+    def write(self,rowgroupsize=20000):
+        """Merge the collected entries with the existing index and write it"""
+        if not self.rows and not self.removed and not self.dropall:
+            return
+        dfnew=pd.DataFrame(self.rows,columns=indexcolumns)
+        if os.path.exists(self.indexfile) and not self.dropall:
+            dfold=pd.read_parquet(self.indexfile)
+            dfold=dfold[~dfold.uri.isin(self.removed)]
+            dfnew=pd.concat([dfold,dfnew],ignore_index=True) if len(dfnew) > 0 else dfold
+        for col in ["tstart","tend","segtstart","segtend"]:
+            dfnew[col]=pd.to_datetime(dfnew[col])
+        #sorted in space (and in time within a grid cell), so the row group statistics allow pruning on the bounding box
+        order=np.lexsort((dfnew.iseg.to_numpy(),dfnew.tstart.to_numpy(),spatialKey(dfnew.xmin,dfnew.ymin,dfnew.xmax,dfnew.ymax)))
+        dfnew=dfnew.iloc[order].reset_index(drop=True)
+        tmpfile=self.indexfile+".tmp"
+        dfnew.to_parquet(tmpfile,index=False,row_group_size=rowgroupsize)
+        os.replace(tmpfile,self.indexfile)
+        altlogger.info(f"Updated pass index {self.indexfile} ({len(dfnew)} segments)")
+        self.rows=[]
+        self.removed=set()
+        self.dropall=False
+
+
+def queryPasses(datadir,bbox=None,tstart=None,tend=None,missions=None,land=None,columns=None):
+    """Find the pass segments which cross an area in a period, using the local pass indices only
+    Parameters
+    ----------
+    datadir : root of the RADS data directory (containing <sat>/<phase>/passindex.parquet)
+    bbox : optional (minx,miny,maxx,maxy) area of interest
+    tstart,tend : optional time window
+    missions : optional list of missions as '<sat>_<phase>' (e.g. ['3a_a','j3_a']), default all indexed missions
+    land : optionally only return segments over land (True) or water (False)
+    columns : optional subset of the index columns to return
+
+    returns:
+        A dataframe with the matching segments
+    """
+    if missions is None:
+        indexfiles=sorted(glob(os.path.join(datadir,"*","*",indexname)))
+    else:
+        indexfiles=[passIndexFile(datadir,*mission.split("_")) for mission in missions]
+        indexfiles=[indexfile for indexfile in indexfiles if os.path.exists(indexfile)]
+    filters=[]
+    if bbox is not None:
+        minx,miny,maxx,maxy=bbox
+        filters.extend([("xmax",">=",minx),("xmin","<=",maxx),("ymax",">=",miny),("ymin","<=",maxy)])
+    if tstart is not None:
+        filters.append(("tend",">=",pd.Timestamp(tstart)))
+    if tend is not None:
+        filters.append(("tstart","<=",pd.Timestamp(tend)))
+    if land is not None:
+        filters.append(("land","==",int(land)))
+    dfs=[pd.read_parquet(indexfile,columns=columns,filters=filters if filters else None) for indexfile in indexfiles]
+    if len(dfs) == 0:
+        return pd.DataFrame(columns=indexcolumns if columns is None else columns)
+    return pd.concat(dfs,ignore_index=True)
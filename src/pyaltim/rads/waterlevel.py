@@ -0,0 +1,186 @@
+## Derive lake water level time series from RADS along-track data
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import shapely
+from concurrent.futures import ProcessPoolExecutor
+from netCDF4 import Dataset as ncDset
+from sqlalchemy import text
+from pyaltim.core.logging import altlogger
+from pyaltim.rads.coverage import coverageLookup
+
+schema="pyaltim"
+
+#reference epoch of the rads time variable
+t0rads=np.datetime64("1985-01-01T00:00:00","ns")
+
+#corrections which are subtracted from the range (the first available alternative is used)
+radscorrections=[("dry_tropo_era5","dry_tropo_ecmwf"),
+        ("wet_tropo_era5","wet_tropo_ecmwf","wet_tropo_rad"),
+        ("iono_gim","iono_alt"),
+        ("tide_solid",),
+        ("tide_pole",),
+        ("geoid_egm2008",)]
+
+
+def _ncread(ncrads,var,sl):
+    """Read a slice of a netcdf variable as a float array with nans for fill values"""
+    return np.ma.filled(ncrads[var][sl].astype(float),np.nan)
+
+def radsHeight(ncrads,sl):
+    """Default computation of the (orthometric) surface height from a slice of a RADS file
+    The height is computed as orbit - range_ku - corrections, where the orbit is taken from the first alt_* variable
+    """
+    altvar=next((var for var in ncrads.variables if var.startswith("alt_")),None)
+    if altvar is None or "range_ku" not in ncrads.variables:
+        raise KeyError(f"No orbit or ku-band range found in {ncrads.filepath()}")
+    hgt=_ncread(ncrads,altvar,sl)-_ncread(ncrads,"range_ku",sl)
+    for alternatives in radscorrections:
+        corvar=next((var for var in alternatives if var in ncrads.variables),None)
+        if corvar is not None:
+            hgt-=_ncread(ncrads,corvar,sl)
+    return hgt
+
+def aggregatePass(hgt,method="median",nsigma=3.0,minpoints=3):
+    """Robustly aggregate the heights of a single pass over a water body
+    Parameters
+    ----------
+    hgt : array of heights
+    method : 'median' (median and scaled median absolute deviation), 'mean' (mean and standard deviation) or 'mad' (mean and standard deviation after rejecting outliers larger than nsigma scaled MAD's from the median)
+    nsigma : outlier threshold for the 'mad' method
+    minpoints : minimum amount of valid points required
+
+    returns:
+        value, spread and number of points used
+    """
+    hgt=hgt[np.isfinite(hgt)]
+    if hgt.size < minpoints:
+        return np.nan,np.nan,hgt.size
+    if method == "mean":
+        return hgt.mean(),hgt.std(),hgt.size
+
+    med=np.median(hgt)
+    mad=1.4826*np.median(np.abs(hgt-med))
+    if method == "median":
+        return med,mad,hgt.size
+    elif method == "mad":
+        if mad > 0:
+            hgt=hgt[np.abs(hgt-med) <= nsigma*mad]
+        if hgt.size < minpoints:
+            return np.nan,np.nan,hgt.size
+        return hgt.mean(),hgt.std(),hgt.size
+    else:
+        raise ValueError(f"Unknown aggregation method {method}")
+
+
+def radsPassSegments(dbeng,geom,missions,tstart=None,tend=None,land=None,coverage=False):
+    """Select the passes and segment indices of the rads tables which intersect with a polygon
+    Parameters
+    ----------
+    dbeng : sqlalchemy engine to the geoslurp database
+    geom : shapely polygon (lon,lat)
+    missions : list of mission/phase identifiers (e.g. ['j3a','3aa'])
+    tstart,tend : optional time window (applied per segment)
+    land : optionally only select segments over land (True) or water (False)
+    coverage : only test the candidate passes from the grid coverage index (see pyaltim.rads.coverage)
+
+    returns:
+        A pandas dataframe with a row per intersecting segment
+    """
+    wkt=shapely.to_wkt(geom)
+    rows=[]
+    if coverage:
+        dfcand=coverageLookup(dbeng,geom,missions)
+    for mission in missions:
+        tbl=f"{schema}.rads_{mission[0:2]}_{mission[2:3]}"
+        segtbl=f"{tbl}_segments"
+        #the sub-geometries of the tracks are stored in the same order as the segments
+        qry=f"SELECT t.uri, t.cycle, t.apass, s.iseg, s.istart, s.iend FROM {tbl} AS t CROSS JOIN LATERAL ST_Dump(t.geom::geometry) AS d JOIN {segtbl} AS s ON s.passid = t.id AND s.iseg = d.path[1]-1 WHERE ST_Intersects(t.geom,ST_GeogFromText(:wkt)) AND ST_Intersects(d.geom,ST_GeomFromText(:wkt,4326))"
+        args=dict(wkt=wkt)
+        if tstart is not None:
+            qry+=" AND t.tend >= :tstart AND s.tend >= :tstart"
+            args['tstart']=tstart
+        if tend is not None:
+            qry+=" AND t.tstart <= :tend AND s.tstart <= :tend"
+            args['tend']=tend
+        if land is not None:
+            qry+=" AND s.land = :land"
+            args['land']=bool(land)
+        if coverage:
+            candidates=dfcand.passid[dfcand.mission == mission].unique()
+            if len(candidates) == 0:
+                continue
+            qry+=" AND t.id = ANY(:passids)"
+            args['passids']=[int(passid) for passid in candidates]
+        nrows=len(rows)
+        with dbeng.connect() as conn:
+            for entry in conn.execute(text(qry),args):
+                rows.append(dict(mission=mission,uri=entry.uri,cycle=entry.cycle,apass=entry.apass,iseg=entry.iseg,istart=entry.istart,iend=entry.iend))
+        altlogger.info(f"Found {len(rows)-nrows} intersecting segments after querying {tbl}")
+
+    return pd.DataFrame(rows,columns=["mission","uri","cycle","apass","iseg","istart","iend"])
+
+
+def _extractCycle(mission,cycle,passes,polywkb,heightfunc,method,nsigma,minpoints):
+    """Extract the aggregated heights of all passes of a single cycle (runs in a worker process)"""
+    poly=shapely.from_wkb(polywkb)
+    out=[]
+    for (uri,apass),segs in passes.items():
+        #read the data of all segments in one batch
+        sl=slice(min(seg[0] for seg in segs),max(seg[1] for seg in segs))
+        with ncDset(uri) as ncrads:
+            lon=_ncread(ncrads,"lon",sl)
+            lat=_ncread(ncrads,"lat",sl)
+            tsec=_ncread(ncrads,"time",sl)
+            hgt=heightfunc(ncrads,sl)
+        lon=np.where(lon > 180,lon-360,lon)
+        #only use points within the segments and within the polygon
+        insegs=np.zeros(lon.size,dtype=bool)
+        for istart,iend in segs:
+            insegs[istart-sl.start:iend-sl.start]=True
+        mask=insegs & shapely.contains_xy(poly,lon,lat)
+        if not mask.any():
+            continue
+        wl,wlerr,npoints=aggregatePass(hgt[mask],method=method,nsigma=nsigma,minpoints=minpoints)
+        if np.isnan(wl):
+            continue
+        time=t0rads+np.timedelta64(int(np.nanmedian(tsec[mask])*1e9),"ns")
+        out.append(dict(time=time,water_level=wl,wl_err=wlerr,npoints=npoints,mission=mission,cycle=cycle,apass=apass))
+    return out
+
+
+def radsLakeWaterLevel(dbeng,geom,missions,tstart=None,tend=None,method="median",nsigma=3.0,minpoints=3,heightfunc=radsHeight,nworkers=None):
+    """Compute a water level time series for a lake from the registered RADS passes
+    Parameters
+    ----------
+    dbeng : sqlalchemy engine to the geoslurp database
+    geom : shapely polygon of the lake
+    missions : list of mission/phase identifiers (e.g. ['j3a','3aa'])
+    tstart,tend : optional time window
+    method,nsigma,minpoints : aggregation settings (see aggregatePass)
+    heightfunc : function(ncdataset,slice) which computes the heights (must be picklable)
+    nworkers : amount of worker processes (the cycles are processed in parallel)
+
+    returns:
+        A xarray dataset with one water level per pass crossing the lake
+    """
+    dfsegs=radsPassSegments(dbeng,geom,missions,tstart,tend)
+    polywkb=shapely.to_wkb(geom)
+    tasks=[]
+    for (mission,cycle),dfcycle in dfsegs.groupby(["mission","cycle"]):
+        passes={}
+        for row in dfcycle.itertuples():
+            passes.setdefault((row.uri,row.apass),[]).append((row.istart,row.iend))
+        tasks.append((mission,cycle,passes))
+    altlogger.info(f"Extracting heights from {len(dfsegs)} segments in {len(tasks)} cycles")
+
+    results=[]
+    with ProcessPoolExecutor(max_workers=nworkers) as executor:
+        futures=[executor.submit(_extractCycle,mission,cycle,passes,polywkb,heightfunc,method,nsigma,minpoints) for mission,cycle,passes in tasks]
+        for fut in futures:
+            results.extend(fut.result())
+
+    df=pd.DataFrame(results,columns=["time","water_level","wl_err","npoints","mission","cycle","apass"]).sort_values("time")
+    ds=xr.Dataset({ky:("time",df[ky].values) for ky in ["water_level","wl_err","npoints","mission","cycle","apass"]},coords=dict(time=("time",df.time.values.astype("datetime64[ns]"))),attrs=dict(source="RADS",method=method,missions=",".join(missions)))
+    return ds
@@ -0,0 +1,77 @@
+import numpy as np
+import xarray as xr
+from pyaltim.core.cache import StationCache,resultSize
+
+
+def result(n=100,value=1.0):
+    return dict(name="station"),xr.Dataset(dict(water_level=("time",np.full(n,value))))
+
+
+def test_get_put():
+    cache=StationCache()
+    cache.put("dahiti",1,"wl","v1",result())
+    info,ds=cache.get("dahiti",1,"wl","v1")
+    assert info == dict(name="station")
+    assert ds.water_level.size == 100
+    assert cache.get("dahiti",2,"wl","v1") is None
+
+
+def test_no_fingerprint_not_cached():
+    cache=StationCache()
+    cache.put("dahiti",1,"wl",None,result())
+    assert len(cache) == 0
+    assert cache.get("dahiti",1,"wl",None) is None
+
+
+def test_fingerprint_replaces():
+    cache=StationCache()
+    cache.put("dahiti",1,"wl","v1",result(value=1.0))
+    assert cache.get("dahiti",1,"wl","v2") is None
+    cache.put("dahiti",1,"wl","v2",result(value=2.0))
+    assert len(cache) == 1
+    assert cache.get("dahiti",1,"wl","v1") is None
+    assert cache.get("dahiti",1,"wl","v2")[1].water_level.values[0] == 2.0
+    assert cache.nbytes == resultSize(result())
+
+
+def test_eviction_by_size():
+    nbytes=resultSize(result())
+    cache=StationCache(maxbytes=2.5*nbytes)
+    for station in range(3):
+        cache.put("dahiti",station,"wl","v1",result())
+        #touch the first station so the second one is the least recently used
+        cache.get("dahiti",0,"wl","v1")
+    assert len(cache) == 2
+    assert cache.nbytes <= cache.maxbytes
+    assert cache.get("dahiti",1,"wl","v1") is None
+    assert cache.get("dahiti",0,"wl","v1") is not None
+    #entries larger than the cache are not stored
+    cache.put("dahiti",5,"wl","v1",result(n=1000))
+    assert cache.get("dahiti",5,"wl","v1") is None
+    cache.resize(nbytes)
+    assert len(cache) == 1
+
+
+def test_cached_copies_are_independent():
+    cache=StationCache()
+    cache.put("dahiti",1,"wl","v1",result())
+    info,ds=cache.get("dahiti",1,"wl","v1")
+    info["extra"]=1
+    ds["other"]=ds.water_level*2
+    info,ds=cache.get("dahiti",1,"wl","v1")
+    assert "extra" not in info and "other" not in ds
+
+
+def test_invalidate_selectors():
+    cache=StationCache()
+    for portal in ("dahiti","hydroweb"):
+        for station in (1,2):
+            for product in ("a","b"):
+                cache.put(portal,station,product,"v1",result(n=10))
+    assert cache.invalidate("dahiti",1,"a") == 1
+    assert cache.invalidate("dahiti",1) == 1
+    assert cache.invalidate(product="b") == 3
+    assert cache.invalidate("hydroweb") == 2
+    assert len(cache) == 1
+    assert cache.clear() == 1
+    assert cache.nbytes == 0
@@ -0,0 +1,34 @@
+import geopandas as gpd
+import shapely
+from pyaltim.portals.catalogue import TargetCatalogue
+
+
+def catalogue(target_ids,lons,product="WL"):
+    return gpd.GeoDataFrame(dict(product=product,target_id=target_ids,name=target_ids,tstart=None,tend=None,lastupdate=None),
+            geometry=shapely.points([[lon,0] for lon in lons]),crs=4326)
+
+
+def nrtree(cat):
+    return cat.conn.execute("SELECT COUNT(*) FROM targets_rtree").fetchone()[0]
+
+
+def test_duplicates_keep_rtree_consistent(tmp_path):
+    cat=TargetCatalogue(str(tmp_path/"catalogue.sqlite"))
+    #the second entry of target 'a' replaces the first one
+    cat.update("hydrosat",catalogue(["a","b","a"],[0,10,20]))
+    assert cat.conn.execute("SELECT COUNT(*) FROM targets").fetchone()[0] == 2
+    assert nrtree(cat) == 2
+    gdf=cat.query(bbox=(19,-1,21,1))
+    assert gdf.target_id.tolist() == ["a"]
+    assert len(cat.query(bbox=(-1,-1,1,1))) == 0
+
+
+def test_refresh_replaces_entries(tmp_path):
+    cat=TargetCatalogue(str(tmp_path/"catalogue.sqlite"))
+    cat.update("hydroweb",catalogue(["a","b"],[0,10],product="P1"),product="P1")
+    cat.update("hydroweb",catalogue(["c"],[5],product="P2"),product="P2")
+    cat.update("hydroweb",catalogue(["b"],[30],product="P1"),product="P1")
+    assert sorted(cat.query(source="hydroweb").target_id) == ["b","c"]
+    assert nrtree(cat) == 2
+    assert cat.query(bbox=(29,-1,31,1)).target_id.tolist() == ["b"]
+    assert cat.lastrefresh("hydroweb") is not None
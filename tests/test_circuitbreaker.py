@@ -0,0 +1,60 @@
+import pytest
+from pyaltim.core.circuitbreaker import CircuitBreaker
+from pyaltim.portals.api import APITransientError,APIDataNotFound,APIPortalDown
+
+
+def transient():
+    raise APITransientError("server error")
+
+def notfound():
+    raise APIDataNotFound("no data")
+
+
+def test_opens_after_threshold():
+    breaker=CircuitBreaker("test",threshold=2,pause=0.01)
+    with pytest.raises(APITransientError):
+        breaker.call(transient)
+    assert breaker.state == "closed"
+    with pytest.raises(APITransientError):
+        breaker.call(transient)
+    assert breaker.state == "open"
+
+
+def test_successful_probe_closes():
+    breaker=CircuitBreaker("test",threshold=1,pause=0.01)
+    with pytest.raises(APITransientError):
+        breaker.call(transient)
+    assert breaker.state == "open"
+    #the next call waits for the pause and probes the portal
+    assert breaker.call(lambda: 42) == 42
+    assert breaker.state == "closed"
+    assert breaker.failures == 0 and breaker.nprobes == 0
+
+
+def test_failed_probes_reopen_and_go_down():
+    breaker=CircuitBreaker("test",threshold=1,pause=0.01,maxprobes=2)
+    with pytest.raises(APITransientError):
+        breaker.call(transient)
+    with pytest.raises(APITransientError):
+        breaker.call(transient)
+    assert breaker.state == "open"
+    assert breaker.nprobes == 1
+    with pytest.raises(APITransientError):
+        breaker.call(transient)
+    assert breaker.state == "down"
+    with pytest.raises(APIPortalDown):
+        breaker.call(lambda: 42)
+    breaker.reset()
+    assert breaker.call(lambda: 42) == 42
+
+
+def test_other_errors_count_as_success():
+    breaker=CircuitBreaker("test",threshold=2,pause=0.01)
+    with pytest.raises(APITransientError):
+        breaker.call(transient)
+    with pytest.raises(APIDataNotFound):
+        breaker.call(notfound)
+    assert breaker.failures == 0
+    with pytest.raises(APITransientError):
+        breaker.call(transient)
+    assert breaker.state == "closed"
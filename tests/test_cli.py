@@ -0,0 +1,74 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+import geopandas as gpd
+import pyaltim.cli as cli
+from pyaltim.portals.dahiti import DahitiConnect
+from pyaltim.portals.api import APIDataNotFound
+
+pytest.importorskip("netCDF4")
+
+
+def stubTargets(portal,product,aoi,cachedir):
+    """Portal with three stations, of which 'c' has no data"""
+    def fetch(station):
+        if station == "c":
+            raise APIDataNotFound(f"No data for {station}")
+        return f"{station}:10.0,11.5"
+
+    def parse(station,raw):
+        name,levels=raw.split(":")
+        wl=np.array(levels.split(","),dtype=float)
+        ds=xr.Dataset(dict(water_level=("time",wl)),coords=dict(time=pd.date_range("2024-01-01",periods=len(wl),freq="D")))
+        return dict(name=name,product=product),ds
+    return ["a","b","c"],None,fetch,parse
+
+
+def test_portalproducts():
+    assert cli.portalProducts("hydroweb",None) == cli.defaultproducts["hydroweb"]
+    assert cli.portalProducts("hydrosat",["hydrosat:WL","dahiti:water_level_altimetry","Q"]) == ["WL","Q"]
+
+
+def test_sync_files(tmp_path,monkeypatch,capsys):
+    monkeypatch.setattr(cli,"portalTargets",stubTargets)
+    outdir=tmp_path/"data"
+    ret=cli.main(["sync","--portals","hydrosat","--products","WL","--cachedir",str(tmp_path/"cache"),"--outdir",str(outdir),"--workers","2"])
+    assert ret == 0
+    proddir=outdir/"hydrosat"/"WL"
+    assert sorted(os.listdir(proddir)) == ["a.nc","b.nc"]
+    with xr.open_dataset(proddir/"a.nc") as ds:
+        assert ds.water_level.values.tolist() == [10.0,11.5]
+        assert ds.attrs["name"] == "a"
+    out=capsys.readouterr().out.splitlines()
+    header=out[0].split()
+    assert header == ["portal","product","targets","fetched","skipped","failed","bytes","elapsed","stopped","error"]
+    row=dict(zip(header,out[1].split()))
+    assert (row["portal"],row["product"],row["targets"],row["fetched"],row["skipped"],row["failed"]) == ("hydrosat","WL","3","2","0","1")
+
+    #the written stations are up to date in a second run
+    ret=cli.main(["sync","--portals","hydrosat","--products","WL","--cachedir",str(tmp_path/"cache"),"--outdir",str(outdir)])
+    assert ret == 0
+    row=dict(zip(header,capsys.readouterr().out.splitlines()[1].split()))
+    assert row["fetched"] == "0"
+
+
+def test_dahiti_tends(monkeypatch):
+    def list_targets(self,geom=None):
+        return gpd.GeoDataFrame(dict(dahiti_id=[1,2,2],data_access=["water_level_altimetry:public"]*3,last_update=["2024-05-01 10:00:00","2024-06-01 10:00:00","2024-06-01 10:00:00"]),
+                geometry=gpd.points_from_xy([0,1,1],[0,1,1]),crs=4326)
+    monkeypatch.setattr(DahitiConnect,"__init__",lambda self,apikey=None: None)
+    monkeypatch.setattr(DahitiConnect,"list_targets",list_targets)
+    targets,tends,fetch,parse=cli.portalTargets("dahiti","water_level_altimetry",None,None)
+    assert targets == [1,2]
+    assert tends == ["2024-05-01 10:00:00","2024-06-01 10:00:00"]
+
+
+def test_sync_error(tmp_path,monkeypatch,capsys):
+    def failTargets(portal,product,aoi,cachedir):
+        raise RuntimeError("portal unavailable")
+    monkeypatch.setattr(cli,"portalTargets",failTargets)
+    ret=cli.main(["sync","--portals","dahiti","--cachedir",str(tmp_path/"cache"),"--outdir",str(tmp_path/"data")])
+    assert ret == 1
+    assert "portal unavailable" in capsys.readouterr().out
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+import shapely
+from sqlalchemy import create_engine,event,text
+from pyaltim.rads.coverage import coverageCells,coverageCellsize,coveragecellsize
+
+
+def cells(geom,cellsize=1.0):
+    return sorted(zip(*[idx.tolist() for idx in coverageCells(geom,cellsize)]))
+
+
+@pytest.mark.parametrize("cellsize",[1.0,0.5,2.5])
+def test_points_follow_squaregrid(cellsize):
+    #cell (i,j) spans [i*cellsize,(i+1)*cellsize) x [j*cellsize,(j+1)*cellsize), including points on the grid lines
+    rng=np.random.default_rng(3)
+    xy=np.vstack([rng.uniform(-180,180,(200,2)),np.round(rng.uniform(-20,20,(50,2))/cellsize)*cellsize])
+    for x,y in xy:
+        assert cells(shapely.Point(x,y),cellsize) == [(int(np.floor(x/cellsize)),int(np.floor(y/cellsize)))]
+
+
+def test_touching_edges():
+    #the lower and left edges belong to a cell, the upper and right edges to its neighbours
+    assert cells(shapely.box(0,0,0.5,0.5)) == [(0,0)]
+    assert cells(shapely.box(-0.5,0.2,0,0.8)) == [(-1,0),(0,0)]
+    assert cells(shapely.box(0,0,1,1)) == [(0,0),(0,1),(1,0),(1,1)]
+    #a line on a grid line belongs to the cell on its right
+    assert cells(shapely.LineString([(1,0.2),(1,0.8)])) == [(1,0)]
+    assert cells(shapely.LineString([(0.5,1),(1.5,1)])) == [(0,1),(1,1)]
+    #crossing a grid line
+    assert cells(shapely.box(0.5,0.5,1.5,0.7)) == [(0,0),(1,0)]
+    #diagonal line through the corner of four cells
+    assert cells(shapely.LineString([(0.5,0.5),(1.5,1.5)])) == [(0,0),(1,1)]
+
+
+def test_stored_cellsize():
+    eng=create_engine("sqlite://")
+    @event.listens_for(eng,"connect")
+    def attach(dbapi_conn,rec):
+        dbapi_conn.execute("ATTACH DATABASE ':memory:' AS admin")
+    with eng.begin() as conn:
+        conn.execute(text("CREATE TABLE admin.inventory (scheme TEXT, dataset TEXT, data TEXT)"))
+        conn.execute(text("INSERT INTO admin.inventory VALUES ('pyaltim','radscoverage','{}')"))
+    assert coverageCellsize(eng) == coveragecellsize
+    with eng.begin() as conn:
+        conn.execute(text("UPDATE admin.inventory SET data=:data"),dict(data='{"cellsize":0.25}'))
+    assert coverageCellsize(eng) == 0.25
@@ -0,0 +1,49 @@
+import geopandas as gpd
+import pandas as pd
+import shapely
+from shapely import Point
+from pyaltim.portals.dahiti import dahitiTargets2gdf
+from pyaltim.portals.inventory import diffInventory
+
+targets=[
+    dict(dahiti_id=1,target_name="lake a",type="lake",longitude=5.0,latitude=52.0,data_access=dict(water_level_altimetry="public",surface_area=None)),
+    dict(dahiti_id=2,target_name="river b",type="river",longitude=6.0,latitude=53.0,data_access=dict(water_level_altimetry="public",surface_area="restricted")),
+    dict(dahiti_id=3,target_name="river c",type="river",longitude=-60.0,latitude=-3.0,data_access=dict(water_level_altimetry=None,surface_area=None)),
+    dict(dahiti_id=4,target_name="lake d",type="lake",longitude=5.5,latitude=52.5,data_access={}),
+]
+
+def loopTargets2gdf(targets,geom=None):
+    """Former per target construction of the catalogue (reference)"""
+    exportkeys=[ky for ky in targets[0].keys() if ky not in ['longitude','latitude','data_access']]
+    dfdict={colky:[val[colky] for val in targets] for colky in exportkeys}
+    dfdict['data_access']=[[f"{ky}:{da}" for ky,da in target['data_access'].items() if da is not None] for target in targets]
+    gdftargets=gpd.GeoDataFrame(dfdict,geometry=[Point(data['longitude'],data['latitude']) for data in targets])
+    if geom is not None:
+        gdftargets=gdftargets[gdftargets.within(geom)]
+    gdftargets=gdftargets.explode('data_access')
+    return gdftargets.set_crs('EPSG:4326').reset_index(drop=True)
+
+
+def test_same_as_loop():
+    gdf=dahitiTargets2gdf(targets)
+    pd.testing.assert_frame_equal(pd.DataFrame(gdf),pd.DataFrame(loopTargets2gdf(targets)))
+    assert gdf.crs == "EPSG:4326"
+    assert gdf.data_access.tolist()[:3] == ["water_level_altimetry:public","water_level_altimetry:public","surface_area:restricted"]
+
+
+def test_same_as_loop_with_geom():
+    geom=shapely.box(4,51,7,54)
+    gdf=dahitiTargets2gdf(targets,geom)
+    pd.testing.assert_frame_equal(pd.DataFrame(gdf),pd.DataFrame(loopTargets2gdf(targets,geom)))
+    assert set(gdf.dahiti_id) == {1,2,4}
+    assert len(dahitiTargets2gdf(targets,shapely.box(100,0,101,1))) == 0
+
+
+def test_empty_targets():
+    gdf=dahitiTargets2gdf([])
+    assert {"dahiti_id","data_access","geometry"} <= set(gdf.columns)
+    assert gdf.crs == "EPSG:4326"
+    diff=diffInventory(None,gdf,['dahiti_id','data_access'])
+    assert len(diff) == 0
+    diff=diffInventory(dahitiTargets2gdf(targets),gdf,['dahiti_id','data_access'])
+    assert (diff.change == "removed").all()
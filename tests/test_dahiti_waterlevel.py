@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+import xarray as xr
+from pyaltim.portals.api import APIOtherError,APIDataNotFound
+from pyaltim.portals.dahiti import DahitiConnect,decodeJsonWaterlevel,decodeCsvWaterlevel,_findcolumn
+
+netCDF4=pytest.importorskip("netCDF4")
+from pyaltim.portals.dahiti import decodeNetcdfWaterlevel
+
+info=dict(dahiti_id=42,target_name="river x")
+records=[dict(datetime="2020-01-05 10:15:00",water_level=12.5,error=0.1),dict(datetime="2020-02-05 10:16:00",water_level=12.75,error=0.2),
+        dict(datetime="2020-03-06 10:17:30",water_level=13.0,error=0.15)]
+jsonbody=dict(info=info,data=records)
+
+
+def assertSame(result,expected):
+    info1,ds1=result
+    info2,ds2=expected
+    assert ds1.time.dtype == np.dtype("datetime64[ns]")
+    xr.testing.assert_equal(ds1,ds2)
+    assert {ky:str(val) for ky,val in info1.items()} == {ky:str(val) for ky,val in info2.items()}
+
+
+def test_json():
+    _,ds=decodeJsonWaterlevel(jsonbody,42)
+    assert ds.time.values[0] == np.datetime64("2020-01-05T10:15:00")
+    assert ds.water_level.values.tolist() == [12.5,12.75,13.0]
+    with pytest.raises(APIDataNotFound):
+        decodeJsonWaterlevel(dict(info=info,data=[]),42)
+
+
+@pytest.mark.parametrize("sep",[",",";","\t"])
+def test_csv(sep):
+    lines=[f"# {ky}: {val}" for ky,val in info.items()]
+    lines.append(sep.join(["Date","Height","Uncertainty"]))
+    lines.extend(sep.join([rec["datetime"],str(rec["water_level"]),str(rec["error"])]) for rec in records)
+    body="\n".join(lines).encode("utf-8")
+    assertSame(decodeCsvWaterlevel(body,42),decodeJsonWaterlevel(jsonbody,42))
+
+
+def test_netcdf(tmp_path):
+    _,dsjson=decodeJsonWaterlevel(jsonbody,42)
+    dsnc=xr.Dataset(dict(height=("time",dsjson.water_level.values),uncertainty=("time",dsjson.wl_err.values)),coords=dict(time=dsjson.time.values),attrs=info)
+    dsnc.to_netcdf(tmp_path/"dahiti.nc",engine="netcdf4")
+    body=(tmp_path/"dahiti.nc").read_bytes()
+    assertSame(decodeNetcdfWaterlevel(body,42),decodeJsonWaterlevel(jsonbody,42))
+
+
+def test_findcolumn():
+    assert _findcolumn(["Date "," WSE","sigma"],("water_level","height","wse")) == " WSE"
+    #the first matching column wins
+    assert _findcolumn(["time","date"],("datetime","date","time")) == "time"
+    with pytest.raises(KeyError):
+        _findcolumn(["sigma"],("error","uncertainty"))
+
+
+def test_dropformat(monkeypatch):
+    requests=[]
+    def handle_resp(self,apipath,args,raw=False):
+        requests.append(args["format"])
+        if args["format"] == "netcdf":
+            raise APIOtherError("format not supported")
+        if args["format"] == "csv":
+            return b"station;value\nx;1"
+        return jsonbody
+    monkeypatch.setattr(DahitiConnect,"_handle_resp",handle_resp)
+    con=DahitiConnect("key",cache=False)
+    assert con.wlformats == ["netcdf","csv","json"]
+    #the refused netcdf format is dropped at download, the undecodable csv at parsing
+    result=con.parse_waterlevel(con.fetch_waterlevel(42),42)
+    assertSame(result,decodeJsonWaterlevel(jsonbody,42))
+    assert con.wlformats == ["json"]
+    assert requests == ["netcdf","csv","json"]
+    #following downloads use json directly
+    con.get_waterlevel(42)
+    assert requests[3:] == ["json"]
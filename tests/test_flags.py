@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+from pyaltim.rads.flags import RadsFlags,flagSegments,bitsFromNetcdf
+
+
+def test_bit_masks():
+    flags=np.array([0,1<<4,1<<5,(1<<4)|(1<<5),(1<<7)|(1<<12)])
+    fl=RadsFlags(flags)
+    assert fl.land.tolist() == [False,True,False,True,False]
+    assert fl.nonocean.tolist() == [False,False,True,True,False]
+    assert fl.ice.tolist() == [False,False,False,False,True]
+    assert fl.mask("badrange").tolist() == [False,False,False,False,True]
+
+
+def test_derived_masks():
+    flags=np.array([0,1<<4,1<<5,(1<<4)|(1<<5),1<<15])
+    fl=RadsFlags(flags)
+    assert fl.water.tolist() == [True,False,True,False,True]
+    assert fl.ocean.tolist() == [True,True,False,False,True]
+    assert fl.inland.tolist() == [False,False,True,False,False]
+    assert fl.good.tolist() == [True,True,True,True,False]
+    assert fl.select(require=["water"],exclude=["badorbit"]).tolist() == [True,False,True,False,False]
+    assert fl.anyof("land","badorbit").tolist() == [False,True,False,True,True]
+    assert fl.allof("land","nonocean").tolist() == [False,False,False,True,False]
+
+
+def test_masked_flags_and_unknown_names():
+    fl=RadsFlags(np.ma.masked_array([1<<4,1<<4],mask=[False,True]))
+    #masked samples have no flags set
+    assert fl.land.tolist() == [True,False]
+    with pytest.raises(KeyError):
+        fl.mask("nosuchflag")
+    with pytest.raises(AttributeError):
+        fl.nosuchflag
+
+
+def test_bits_from_netcdf_attributes():
+    class NcVar:
+        def getncattr(self,name):
+            return dict(flag_masks=np.array([1,2,16,24]),flag_meanings="a b land notabit")[name]
+    assert bitsFromNetcdf(NcVar()) == dict(a=0,b=1,land=4)
+
+
+def test_flag_segments_boundaries():
+    lon=np.array([170.,175.,179.,-179.,-175.,-170.,-165.])
+    land=np.array([False,False,False,False,True,True,False])
+    istart,iend=flagSegments(lon,land)
+    #breaks at the dateline (index 3) and at the land/water changes (index 4 and 6)
+    assert istart.tolist() == [0,3,4,6]
+    assert iend.tolist() == [3,4,6,7]
+
+
+def test_flag_segments_single():
+    istart,iend=flagSegments(np.array([1.,2.,3.]),np.zeros(3,dtype=bool))
+    assert istart.tolist() == [0] and iend.tolist() == [3]
+    istart,iend=flagSegments(np.array([1.]),np.array([True]))
+    assert istart.tolist() == [0] and iend.tolist() == [1]
@@ -0,0 +1,24 @@
+import geopandas as gpd
+import pytest
+import shapely
+
+pytest.importorskip("geoslurp")
+pytest.importorskip("pystac_client")
+import pyaltim.geoslurp.hydroweb as gshydroweb
+from pyaltim.portals.hydroweb import HydrowebConnect
+
+
+def test_holdings_enumerated_once(monkeypatch):
+    calls=[]
+    def get_items(self,geom=None,collections=None,**kwargs):
+        calls.append(collections)
+        return gpd.GeoDataFrame(dict(item_id=["a","b","c"],collection=[collections[0],collections[1],collections[0]]),geometry=shapely.points([[0,0]]*3),crs="EPSG:4326")
+    monkeypatch.setattr(HydrowebConnect,"get_items",get_items)
+    monkeypatch.setattr(gshydroweb,"_allholdings",{})
+    gdf=gshydroweb.hydrowebHoldings("key")
+    gdf2=gshydroweb.hydrowebHoldings("key")
+    assert calls == [HydrowebConnect.products]
+    assert gdf2 is gdf
+    #a new enumeration after maxage
+    gshydroweb.hydrowebHoldings("key",maxage=-1)
+    assert len(calls) == 2
@@ -0,0 +1,105 @@
+import os
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+import shapely
+from pyaltim.portals.inventory import inventoryFile,existingInventory,saveInventory,loadInventory,diffInventory,diffFile,saveDiff,loadDiff
+
+invformats=["parquet","gpkg"]
+
+
+def inventory(n=50):
+    lons=np.linspace(-170,170,n)
+    return gpd.GeoDataFrame(dict(target_id=[f"t{i}" for i in range(n)],name=[f"river {i}" for i in range(n)],nobs=np.arange(n)),
+            geometry=shapely.points(np.column_stack([lons,lons/4])),crs="EPSG:4326")
+
+
+def sortedtargets(gdf):
+    return gdf.sort_values("target_id").reset_index(drop=True)
+
+
+@pytest.mark.parametrize("invformat",invformats)
+def test_roundtrip(tmp_path,invformat):
+    gdf=sortedtargets(inventory())
+    invfile=saveInventory(gdf,inventoryFile(str(tmp_path),"holdings",invformat))
+    assert invfile.endswith("."+invformat)
+    gdfload=sortedtargets(loadInventory(invfile))
+    assert gdfload.crs == gdf.crs
+    assert gdfload.target_id.tolist() == gdf.target_id.tolist()
+    assert gdfload.name.tolist() == gdf.name.tolist()
+    assert gdfload.nobs.tolist() == gdf.nobs.tolist()
+    assert shapely.equals_exact(gdfload.geometry.values,gdf.geometry.values,tolerance=1e-9).all()
+    #overwriting replaces the previous inventory
+    saveInventory(gdf.iloc[:3],invfile)
+    assert len(loadInventory(invfile)) == 3
+
+
+@pytest.mark.parametrize("invformat",invformats)
+def test_bbox(tmp_path,invformat):
+    gdf=inventory()
+    #small row groups so the parquet reader also has to filter within a group
+    invfile=saveInventory(gdf,inventoryFile(str(tmp_path),"holdings",invformat),rowgroupsize=7)
+    bbox=(-50,-20,30,10)
+    expected=sortedtargets(gdf[gdf.intersects(shapely.box(*bbox))])
+    gdfload=sortedtargets(loadInventory(invfile,bbox=bbox))
+    assert len(expected) > 0
+    assert gdfload.target_id.tolist() == expected.target_id.tolist()
+    assert len(loadInventory(invfile,bbox=(0,60,10,70))) == 0
+
+
+@pytest.mark.parametrize("invformat",invformats)
+def test_columns(tmp_path,invformat):
+    invfile=saveInventory(inventory(),inventoryFile(str(tmp_path),"holdings",invformat))
+    gdfload=loadInventory(invfile,columns=["target_id"])
+    #the geometry is always loaded
+    assert sorted(gdfload.columns) == ["geometry","target_id"]
+    gdfload=loadInventory(invfile,bbox=(-50,-20,30,10),columns=["nobs"])
+    assert sorted(gdfload.columns) == ["geometry","nobs"]
+    assert len(gdfload) > 0
+
+
+def test_formats(tmp_path):
+    with pytest.raises(ValueError):
+        inventoryFile(str(tmp_path),"holdings","csv")
+    invfile=inventoryFile(str(tmp_path),"holdings")
+    assert invfile.endswith(".parquet")
+    assert existingInventory(invfile) is None
+    #a GeoPackage cache of an older version is still found
+    gpkgfile=saveInventory(inventory(),inventoryFile(str(tmp_path),"holdings","gpkg"))
+    assert existingInventory(invfile) == gpkgfile
+    saveInventory(inventory(),invfile)
+    assert existingInventory(invfile) == invfile
+
+
+def holdings(hyd_nos,lons,data_type="WL",name=None):
+    return gpd.GeoDataFrame(dict(hyd_no=hyd_nos,data_type=data_type,name=name if name is not None else [f"station {hyd_no}" for hyd_no in hyd_nos]),
+            geometry=shapely.points([[lon,10] for lon in lons]),crs="EPSG:4326")
+
+
+def test_diff():
+    old=holdings([1,2,3,4],[0,1,2,3])
+    new=holdings([1,2,3,5],[0,1,2.5,4],name=["station 1","renamed","station 3","station 5"])
+    diff=diffInventory(old,new,["hyd_no","data_type"])
+    assert dict(zip(diff.hyd_no,diff.change)) == {2:"changed",3:"changed",4:"removed",5:"added"}
+    #changed rows carry the current values, removed rows the previous ones
+    diff=diff.set_index("hyd_no")
+    assert diff.loc[2,"name"] == "renamed"
+    assert diff.loc[3].geometry.x == 2.5
+    assert diff.loc[4].geometry.x == 3
+    assert (diffInventory(None,new,"hyd_no").change == "added").all()
+
+
+@pytest.mark.parametrize("invformat",invformats)
+def test_diff_cached(tmp_path,invformat):
+    #an inventory read back from the cache is not different from the one which was written
+    gdf=holdings([1,2,3],[0,1,2])
+    gdf["lastupdate"]=pd.to_datetime(["2024-01-01",None,"2024-03-01"])
+    invfile=saveInventory(gdf,inventoryFile(str(tmp_path),"holdings",invformat))
+    assert len(diffInventory(loadInventory(invfile),gdf,["hyd_no","data_type"])) == 0
+    #the difference is saved next to the inventory
+    diff=diffInventory(gdf,holdings([1,2],[0,1]),"hyd_no")
+    saveDiff(diff,invfile)
+    diffload,stamp=loadDiff(invfile)
+    assert diffload.hyd_no.tolist() == [3] and diffload.change.tolist() == ["removed"]
+    assert stamp == os.path.getmtime(diffFile(invfile))
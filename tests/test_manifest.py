@@ -0,0 +1,88 @@
+import os
+import pytest
+from pyaltim.rads.manifest import RadsManifest,scanPhase,manifestFile
+
+pytest.importorskip("pyarrow")
+
+
+def touch(path,content=b"pass",mtime=1e9):
+    os.makedirs(os.path.dirname(path),exist_ok=True)
+    with open(path,"wb") as fid:
+        fid.write(content)
+    os.utime(path,(mtime,mtime))
+    return str(path)
+
+
+@pytest.fixture
+def phasedir(tmp_path):
+    phasedir=tmp_path/"3a"/"a"
+    for cycle in (1,2):
+        for apass in (1,2,3):
+            touch(phasedir/f"c{cycle:03d}"/f"3ap{apass:04d}c{cycle:03d}.nc")
+    #other files are not part of the manifest
+    touch(phasedir/"c001"/"readme.txt")
+    return phasedir
+
+
+def passfile(phasedir,cycle,apass):
+    return str(phasedir/f"c{cycle:03d}"/f"3ap{apass:04d}c{cycle:03d}.nc")
+
+
+def registered(manifest):
+    return manifest.df.set_index("path").registered.to_dict()
+
+
+def test_scan(phasedir):
+    dfscan=scanPhase(str(phasedir))
+    assert sorted(dfscan.path) == sorted(passfile(phasedir,cycle,apass) for cycle in (1,2) for apass in (1,2,3))
+    assert sorted(scanPhase(str(phasedir),cycles=[2,5]).path) == [passfile(phasedir,2,apass) for apass in (1,2,3)]
+
+
+def test_update(tmp_path,phasedir):
+    mfile=manifestFile(str(tmp_path),"3a","a")
+    manifest=RadsManifest(mfile)
+    todo,removed=manifest.update(scanPhase(str(phasedir)))
+    assert len(todo) == 6 and removed == []
+    #pass 3 of cycle 1 failed to register
+    failed=passfile(phasedir,1,3)
+    manifest.markregistered([path for path in todo if path != failed])
+    manifest.save()
+
+    #changed size, changed mtime, a removed and a new file
+    touch(passfile(phasedir,1,2),content=b"longer pass")
+    touch(passfile(phasedir,2,1),mtime=2e9)
+    os.remove(passfile(phasedir,2,2))
+    new=touch(passfile(phasedir,2,4))
+
+    manifest=RadsManifest(mfile)
+    todo,removed=manifest.update(scanPhase(str(phasedir)))
+    assert sorted(todo) == sorted([failed,passfile(phasedir,1,2),passfile(phasedir,2,1),new])
+    assert removed == [passfile(phasedir,2,2)]
+    #the changed files need registering again, the unchanged ones keep their state
+    reg=registered(manifest)
+    assert len(reg) == 6
+    assert not reg[passfile(phasedir,1,2)] and not reg[passfile(phasedir,2,1)] and not reg[new] and not reg[failed]
+    assert reg[passfile(phasedir,1,1)] and reg[passfile(phasedir,2,3)]
+
+
+def test_partial_update(tmp_path,phasedir):
+    manifest=RadsManifest(manifestFile(str(tmp_path),"3a","a"))
+    todo,removed=manifest.update(scanPhase(str(phasedir)))
+    manifest.markregistered(todo)
+    os.remove(passfile(phasedir,1,1))
+    os.remove(passfile(phasedir,2,1))
+    touch(passfile(phasedir,1,2),mtime=2e9)
+
+    #only files of the scanned cycle can have disappeared or changed
+    todo,removed=manifest.update(scanPhase(str(phasedir),cycles=[2]),cycles=[2])
+    assert todo == []
+    assert removed == [passfile(phasedir,2,1)]
+    reg=registered(manifest)
+    #the entries of cycle 1 are kept as they were
+    assert sorted(reg) == sorted([passfile(phasedir,1,apass) for apass in (1,2,3)]+[passfile(phasedir,2,apass) for apass in (2,3)])
+    assert all(reg.values())
+
+    todo,removed=manifest.update(scanPhase(str(phasedir),cycles=[1]),cycles=[1])
+    assert todo == [passfile(phasedir,1,2)]
+    assert removed == [passfile(phasedir,1,1)]
+    assert len(manifest.df) == 4
@@ -0,0 +1,63 @@
+import os
+from datetime import datetime,timedelta
+import numpy as np
+import pandas as pd
+import pytest
+import shapely
+pytest.importorskip("pyarrow")
+from pyaltim.rads.passindex import PassIndex,passIndexFile,queryPasses,spatialKey
+
+
+def passMeta(apass,lon0,lat0,cycle=1):
+    """Pass metadata with two segments starting at lon0,lat0"""
+    t0=datetime(2020,1,1)+timedelta(hours=apass)
+    tracks=[shapely.linestrings([[lon0,lat0,0],[lon0+1,lat0+1,0]]),shapely.linestrings([[lon0+1,lat0+1,0],[lon0+2,lat0+2,0]])]
+    segments=[dict(tstart=(t0+timedelta(minutes=iseg)).isoformat(),tend=(t0+timedelta(minutes=iseg+1)).isoformat(),istart=10*iseg,iend=10*iseg+9,land=iseg) for iseg in range(2)]
+    return dict(uri=f"/data/3a/a/c{cycle:03d}/3ap{apass:04d}c{cycle:03d}.nc",cycle=cycle,apass=apass,tstart=t0,tend=t0+timedelta(minutes=2),
+            data=dict(segments=segments),geom=shapely.to_wkb(shapely.multilinestrings(tracks),flavor="iso",output_dimension=3))
+
+
+def test_spatial_key_locality():
+    key=spatialKey(np.array([0,0.1,100]),np.array([0,0.1,50]),np.array([1,1.1,101]),np.array([1,1.1,51]))
+    assert abs(int(key[1])-int(key[0])) < abs(int(key[2])-int(key[0]))
+
+
+def test_write_and_query(tmp_path):
+    indexfile=passIndexFile(str(tmp_path),"3a","a")
+    os.makedirs(os.path.dirname(indexfile))
+    pindex=PassIndex(indexfile,"3a","a")
+    #passes in time order alternate between two regions
+    for apass in range(6):
+        pindex.add(passMeta(apass,-100 if apass % 2 else 100,0))
+    pindex.write(rowgroupsize=4)
+    df=pd.read_parquet(indexfile)
+    assert len(df) == 12
+    #the rows are grouped in space rather than in time
+    assert (np.diff((df.xmin > 0).to_numpy().astype(int)) != 0).sum() == 1
+
+    df=queryPasses(str(tmp_path),bbox=(99,0,100.5,0.5))
+    assert sorted(set(df.apass)) == [0,2,4]
+    assert (df.iseg == 0).all()
+    df=queryPasses(str(tmp_path),bbox=(-110,-10,-90,10),tend=datetime(2020,1,1,2),land=True)
+    assert df.apass.tolist() == [1]
+
+
+def test_replace_and_rebuild(tmp_path):
+    indexfile=passIndexFile(str(tmp_path),"3a","a")
+    os.makedirs(os.path.dirname(indexfile))
+    pindex=PassIndex(indexfile,"3a","a")
+    for apass in range(3):
+        pindex.add(passMeta(apass,0,0))
+    pindex.write()
+    #re-adding a pass replaces its segments
+    pindex.add(passMeta(1,50,50))
+    pindex.remove([passMeta(2,0,0)["uri"]])
+    pindex.write()
+    df=pd.read_parquet(indexfile)
+    assert sorted(df.apass) == [0,0,1,1]
+    assert df[df.apass == 1].xmin.min() == 50
+    #a rebuild drops all existing entries
+    pindex.clear()
+    pindex.add(passMeta(5,0,0))
+    pindex.write()
+    assert sorted(set(pd.read_parquet(indexfile).apass)) == [5]
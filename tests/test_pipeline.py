@@ -0,0 +1,73 @@
+import pytest
+from pyaltim.core.circuitbreaker import CircuitBreaker
+from pyaltim.core.pipeline import StagedPipeline
+from pyaltim.portals.api import APILimitReached,APIDataNotFound,APIOtherError,APITransientError
+
+
+def runPipeline(fetch,parse=lambda item,raw: raw,write=None,items=range(10),**kwargs):
+    written={}
+    errors={}
+    def store(item,result):
+        written[item]=result
+    pipeline=StagedPipeline(fetch,parse,write or store,nfetch=2,maxqueue=2,name="test",onerror=lambda item,exc: errors.update({item:exc}),
+            breaker=CircuitBreaker("test",threshold=100,pause=0.01),**kwargs)
+    nwritten=pipeline.run(items)
+    return pipeline,nwritten,written,errors
+
+
+def test_all_items_written():
+    pipeline,nwritten,written,errors=runPipeline(lambda item: item*2)
+    assert nwritten == 10
+    assert written == {item:item*2 for item in range(10)}
+    assert not errors and not pipeline.stopped
+
+
+def test_item_errors_are_skipped():
+    def fetch(item):
+        if item == 1:
+            raise APIDataNotFound("no data")
+        elif item == 2:
+            raise APIOtherError("bad request")
+        elif item == 3:
+            raise APITransientError("timeout")
+        return dict(value=item)
+    def parse(item,raw):
+        if item == 4:
+            raise KeyError("value")
+        elif item == 5:
+            raise ValueError("malformed")
+        return raw["value"]
+    pipeline,nwritten,written,errors=runPipeline(fetch,parse)
+    assert sorted(errors) == [1,2,3,4,5]
+    assert sorted(written) == [0,6,7,8,9]
+    assert not pipeline.stopped
+
+
+def test_transient_errors_are_retried():
+    attempts={}
+    def fetch(item):
+        attempts[item]=attempts.get(item,0)+1
+        if attempts[item] < 3:
+            raise APITransientError("timeout")
+        return item
+    pipeline,nwritten,written,errors=runPipeline(fetch,retries=2)
+    assert nwritten == 10 and not errors
+
+
+def test_limit_flushes_fetched_items():
+    def fetch(item):
+        if item >= 5:
+            raise APILimitReached("limit reached")
+        return item
+    pipeline,nwritten,written,errors=runPipeline(fetch,items=range(100))
+    assert pipeline.stopped
+    #everything fetched before the limit is still written
+    assert set(range(5)) <= set(written)
+    assert all(item < 5 for item in written)
+
+
+def test_write_error_cancels():
+    def write(item,result):
+        raise RuntimeError("database gone")
+    with pytest.raises(RuntimeError):
+        runPipeline(lambda item: item,write=write,items=range(100))
@@ -0,0 +1,73 @@
+## Registering a RADS pass stores its segments in the child table (in the same session as the pass)
+
+import pytest
+from datetime import datetime
+
+pytest.importorskip("geoslurp")
+pytest.importorskip("geoalchemy2")
+
+from sqlalchemy import create_engine,event,Column,Integer,String,JSON,LargeBinary,MetaData,text
+from sqlalchemy.dialects.postgresql import TIMESTAMP
+from sqlalchemy.orm import Session,declarative_base
+from sqlalchemy.pool import StaticPool
+from pyaltim.geoslurp.rads import radsclassFactory
+
+#stand-in for the pass table without the geography column (sqlite has no PostGIS)
+PassTBase=declarative_base(metadata=MetaData(schema="pyaltim"))
+class PassT(PassTBase):
+    __tablename__="rads_3a_a"
+    id=Column(Integer,primary_key=True)
+    lastupdate=Column(TIMESTAMP)
+    tstart=Column(TIMESTAMP)
+    tend=Column(TIMESTAMP)
+    cycle=Column(Integer)
+    apass=Column(Integer)
+    uri=Column(String,unique=True)
+    data=Column(JSON)
+    geom=Column(LargeBinary)
+
+
+radscls=radsclassFactory("rads_3a_a")
+
+def passMeta(uri="/rads/3a/a/c012/3ap0101c012.nc",nseg=3):
+    segments=[dict(tstart=f"2020-01-01T00:0{iseg}:00",tend=f"2020-01-01T00:0{iseg}:30",istart=10*iseg,iend=10*iseg+9,land=iseg%2) for iseg in range(nseg)]
+    return dict(lastupdate=datetime(2020,1,2),tstart=datetime(2020,1,1),tend=datetime(2020,1,1,0,5),cycle=12,apass=101,uri=uri,data=dict(segments=segments),geom=b"")
+
+
+@pytest.fixture
+def dset():
+    eng=create_engine("sqlite://",poolclass=StaticPool)
+    @event.listens_for(eng,"connect")
+    def attach(dbapi_conn,rec):
+        dbapi_conn.execute("ATTACH DATABASE ':memory:' AS pyaltim")
+    PassT.__table__.create(eng)
+    radscls.segtable.__table__.create(eng)
+    dset=radscls.__new__(radscls)
+    dset.table=PassT
+    dset._ses=Session(eng)
+    yield dset
+    dset._ses.close()
+
+
+def countSegments(dset):
+    return dset._ses.execute(text(f"SELECT count(*) FROM {dset.segstname()}")).scalar()
+
+def test_register_pass_stores_segments(dset):
+    dset.addPass(passMeta(nseg=3))
+    dset._ses.commit()
+    assert countSegments(dset) == 3
+    passid=dset._ses.query(PassT.id).scalar()
+    rows=dset._ses.execute(text(f"SELECT passid, iseg, istart, iend, land FROM {dset.segstname()} ORDER BY iseg")).fetchall()
+    assert [tuple(row) for row in rows] == [(passid,0,0,9,False),(passid,1,10,19,True),(passid,2,20,29,False)]
+    #the pass row only keeps the segment count
+    assert dset._ses.query(PassT.data).scalar() == {"nsegments":3}
+
+def test_reregistered_pass_replaces_segments(dset):
+    dset.addPass(passMeta(nseg=3))
+    dset._ses.commit()
+    #a re-registration deletes the outdated pass (as retainnewUris does) and adds it again
+    dset._ses.query(PassT).delete()
+    dset.addPass(passMeta(nseg=2))
+    dset._ses.commit()
+    dset.removeOrphanSegments()
+    assert countSegments(dset) == 2
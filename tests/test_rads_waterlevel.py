@@ -0,0 +1,98 @@
+import numpy as np
+import pytest
+import shapely
+
+netCDF4=pytest.importorskip("netCDF4")
+from pyaltim.rads.waterlevel import aggregatePass,radsHeight,_extractCycle,t0rads
+
+
+def test_aggregate_methods():
+    hgt=np.array([10.0,10.2,9.8,10.1,np.nan,9.9])
+    val,spread,npoints=aggregatePass(hgt,method="median")
+    assert (val,npoints) == (pytest.approx(10.0),5)
+    assert spread == pytest.approx(1.4826*0.1)
+    val,spread,npoints=aggregatePass(hgt,method="mean")
+    assert (val,spread,npoints) == (pytest.approx(10.0),pytest.approx(np.nanstd(hgt)),5)
+    with pytest.raises(ValueError):
+        aggregatePass(hgt,method="mode")
+
+
+def test_aggregate_outliers():
+    hgt=np.array([10.0,10.2,9.8,10.1,9.9,25.0])
+    #the outlier is rejected by the mad method only
+    val,spread,npoints=aggregatePass(hgt,method="mad",nsigma=3)
+    assert (val,npoints) == (pytest.approx(10.0),5)
+    assert spread == pytest.approx(np.std(hgt[:-1]))
+    assert aggregatePass(hgt,method="mean")[0] == pytest.approx(hgt.mean())
+    #identical heights have no spread and nothing is rejected
+    assert aggregatePass(np.full(4,3.0),method="mad") == (3.0,0.0,4)
+
+
+def test_aggregate_minpoints():
+    hgt=np.array([10.0,np.nan,10.2,25.0])
+    val,spread,npoints=aggregatePass(hgt,minpoints=4)
+    assert np.isnan(val) and np.isnan(spread) and npoints == 3
+    assert aggregatePass(hgt,minpoints=3)[2] == 3
+    #too few points left after the outlier rejection
+    val,spread,npoints=aggregatePass(np.array([10.0,10.0,10.1,25.0]),method="mad",minpoints=4)
+    assert np.isnan(val) and npoints == 3
+
+
+def radsFile(fname,lon,lat,hgt,tsec,rangefill=()):
+    """Write a minimal RADS pass file with heights hgt=alt-range-corrections"""
+    with netCDF4.Dataset(fname,"w") as nc:
+        nc.createDimension("time",lon.size)
+        def addvar(name,vals):
+            var=nc.createVariable(name,"f8",("time",),fill_value=-9999.0)
+            var[:]=vals
+            return var
+        addvar("time",tsec)
+        addvar("lon",lon%360)
+        addvar("lat",lat)
+        addvar("alt_gdrf",hgt+1000.0+2.0+0.1+30.0)
+        rng=np.full(lon.size,1000.0)
+        rng[list(rangefill)]=-9999.0
+        addvar("range_ku",rng)
+        #only the first available alternative of a correction is applied
+        addvar("dry_tropo_ecmwf",np.full(lon.size,2.0))
+        addvar("wet_tropo_era5",np.full(lon.size,0.1))
+        addvar("wet_tropo_rad",np.full(lon.size,5.0))
+        addvar("geoid_egm2008",np.full(lon.size,30.0))
+    return str(fname)
+
+
+def test_radsheight(tmp_path):
+    n=5
+    fname=radsFile(tmp_path/"pass.nc",np.zeros(n),np.zeros(n),np.arange(n,dtype=float),np.arange(n,dtype=float),rangefill=[3])
+    with netCDF4.Dataset(fname) as nc:
+        hgt=radsHeight(nc,slice(1,5))
+    np.testing.assert_allclose(hgt,[1.0,2.0,np.nan,4.0])
+
+
+def test_extractcycle(tmp_path):
+    n=20
+    #the pass crosses the prime meridian, rads stores longitudes in [0,360)
+    lon=-0.95+0.1*np.arange(n)
+    lat=np.full(n,0.5)
+    hgt=np.full(n,50.0)
+    hgt[[6,13]]=[50.4,50.2]
+    #heights outside of the segments or the polygon are not used
+    hgt[[0,9,10,18]]=500.0
+    tsec=1e8+np.arange(n)
+    fname=radsFile(tmp_path/"pass1.nc",lon,lat,hgt,tsec,rangefill=[5])
+    #second pass outside of the polygon
+    fname2=radsFile(tmp_path/"pass2.nc",lon+20,lat,hgt,tsec)
+    poly=shapely.box(-0.6,0,0.6,1)
+    #points 4-7 and 12-15 are within the segments and the polygon, point 5 has no range
+    passes={(fname,11):[(0,8),(12,20)],(fname2,12):[(0,20)]}
+    out=_extractCycle("3aa",7,passes,shapely.to_wkb(poly),radsHeight,"median",3.0,3)
+    assert len(out) == 1
+    res=out[0]
+    assert (res["mission"],res["cycle"],res["apass"],res["npoints"]) == ("3aa",7,11,7)
+    assert res["water_level"] == pytest.approx(50.0)
+    #the time is the median of all points in the polygon
+    assert res["time"] == t0rads+np.timedelta64(int((1e8+9.5)*1e9),"ns")
+    out=_extractCycle("3aa",7,passes,shapely.to_wkb(poly),radsHeight,"mean",3.0,3)
+    assert out[0]["water_level"] == pytest.approx(np.mean([50.0,50.4,50.0,50.0,50.2,50.0,50.0]))
+    #a pass with too few points in the polygon is skipped
+    assert _extractCycle("3aa",7,passes,shapely.to_wkb(poly),radsHeight,"median",3.0,8) == []
@@ -0,0 +1,103 @@
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+from pyaltim.core.ragged import RaggedStations,groupReduce
+from pyaltim.portals.api import APIDataNotFound
+
+
+def series(n,seed,start="2020-01-01",freq="5D"):
+    rng=np.random.default_rng(seed)
+    wl=100+rng.normal(0,1,n)
+    wl[rng.integers(0,n)]=np.nan
+    return xr.Dataset(dict(water_level=("time",wl),wl_err=("time",np.abs(rng.normal(0,0.1,n)))),coords=dict(time=pd.date_range(start,periods=n,freq=freq)))
+
+@pytest.fixture
+def ragged():
+    return RaggedStations.from_datasets(["a","b","c"],[series(40,0),series(25,1,"2021-03-01"),series(60,2,"2019-06-01",freq="3D")],infos=[dict(name="a"),dict(name="b"),dict(name="c")])
+
+
+@pytest.mark.parametrize("how,func",[("count",lambda v: np.isfinite(v).sum()),("sum",np.nansum),("mean",np.nanmean),("std",np.nanstd),
+    ("min",np.nanmin),("max",np.nanmax),("median",np.nanmedian)])
+def test_group_reduce(how,func):
+    rng=np.random.default_rng(3)
+    groups=np.sort(rng.integers(0,5,200))
+    #group 5 is empty
+    vals=rng.normal(0,1,200)
+    vals[::7]=np.nan
+    out=groupReduce(groups,vals,6,how)
+    for ig in range(5):
+        assert out[ig] == pytest.approx(func(vals[groups == ig]))
+    if how in ("count","sum"):
+        assert out[5] == 0
+    else:
+        assert np.isnan(out[5])
+
+
+def test_group_reduce_unknown():
+    with pytest.raises(ValueError):
+        groupReduce(np.zeros(2,dtype=int),np.ones(2),1,"mode")
+
+
+def test_getitem_and_reduce(ragged):
+    assert ragged.nstations == 3 and ragged.nobs == 125
+    ds=ragged["b"]
+    assert ds.sizes["time"] == 25
+    np.testing.assert_allclose(ragged.reduce("water_level","median").values,[np.nanmedian(ragged[st].water_level.values) for st in "abc"])
+    assert list(ragged.info.name) == ["a","b","c"]
+    with pytest.raises(KeyError):
+        ragged["d"]
+
+
+def test_trend():
+    time=pd.date_range("2020-01-01",periods=100,freq="7D")
+    tyr=(time-time[0]).days.values/365.25
+    dsets=[xr.Dataset(dict(water_level=("time",slope*tyr+5)),coords=dict(time=time)) for slope in (0.5,-2.0)]
+    trend=RaggedStations.from_datasets([1,2],dsets).trend("water_level")
+    np.testing.assert_allclose(trend.values,[0.5,-2.0])
+
+
+def test_anomalies(ragged):
+    anom=ragged.anomalies("water_level")
+    np.testing.assert_allclose(anom.reduce("water_level","mean").values,0,atol=1e-10)
+    monthly=ragged.anomalies("water_level","month")
+    ds=monthly["c"]
+    np.testing.assert_allclose(ds.water_level.groupby("time.month").mean().values,0,atol=1e-10)
+    with pytest.raises(ValueError):
+        ragged.anomalies("water_level","week")
+
+
+@pytest.mark.parametrize("how",["mean","median","max"])
+def test_resample(ragged,how):
+    monthly=ragged.resample("M",how=how)
+    for st in "abc":
+        ref=getattr(ragged[st].to_dataframe().water_level.resample("MS"),how)().dropna()
+        ds=monthly[st].to_dataframe().water_level.dropna()
+        np.testing.assert_allclose(ds.values,ref.values)
+        assert (ds.index == ref.index).all()
+
+
+def test_xarray_roundtrip(ragged):
+    ds=ragged.to_xarray()
+    assert ds.featureType == "timeSeries"
+    assert ds.rowsize.attrs["sample_dimension"] == "obs"
+    back=RaggedStations.from_xarray(ds)
+    np.testing.assert_array_equal(back.stations,ragged.stations)
+    np.testing.assert_array_equal(back.time,ragged.time)
+    np.testing.assert_array_equal(back.rowsize,ragged.rowsize)
+    for var in ragged.data:
+        np.testing.assert_array_equal(back.data[var],ragged.data[var])
+
+
+def test_empty():
+    empty=RaggedStations.from_datasets([],[])
+    assert empty.nstations == 0 and empty.nobs == 0 and empty.data == {}
+    def getfunc(station):
+        raise APIDataNotFound(f"no data for {station}")
+    empty=RaggedStations.from_connector(getfunc,[1,2])
+    assert empty.nstations == 0
+    assert empty.to_xarray().sizes["obs"] == 0
+    empty=RaggedStations.from_datasets([],[],variables=["water_level"])
+    assert empty.reduce("water_level").size == 0
+    assert empty.trend("water_level").size == 0
+    assert empty.resample("M").nobs == 0
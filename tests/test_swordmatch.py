@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+import shapely
+
+from pyaltim.core.geo import haversine,nearestFeatures
+
+
+def test_nearest_in_meters_at_high_latitude():
+    #0.02 degree east is about 760 m at 70N, 0.01 degree north about 1113 m: the nearest feature in degrees is not the nearest in meters
+    points=shapely.points([[10,70],[50,0]])
+    geoms=shapely.points([[10.02,70],[10,70.01],[80,0]])
+    ipnt,igeom,dist=nearestFeatures(points,geoms,2000)
+    assert ipnt.tolist() == [0]
+    assert igeom.tolist() == [0]
+    assert dist[0] == pytest.approx(760,abs=5)
+
+
+def test_distance_to_line_within_tolerance():
+    points=shapely.points([[10,70]])
+    lines=np.array([shapely.LineString([(10.01,69.9),(10.01,70.1)])])
+    ipnt,igeom,dist=nearestFeatures(points,lines,1000)
+    assert dist[0] == pytest.approx(380,abs=5)
+    ipnt,igeom,dist=nearestFeatures(points,lines,300)
+    assert len(ipnt) == 0
+
+
+def test_haversine():
+    #a degree along the equator and along a meridian
+    assert haversine(0,0,1,0) == pytest.approx(111195,abs=1)
+    assert haversine(10,70,10,71) == pytest.approx(111195,abs=1)
+    assert haversine(np.array([0,179.5]),np.array([0,0]),np.array([0,-179.5]),np.array([0,0])) == pytest.approx([0,111195],abs=1)
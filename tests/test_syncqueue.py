@@ -0,0 +1,78 @@
+from datetime import datetime,timedelta,timezone
+import pandas as pd
+from pyaltim.core.syncqueue import SyncQueue
+
+
+def test_never_synced_first(tmp_path):
+    syncq=SyncQueue(str(tmp_path/"queue.sqlite"))
+    syncq.update([1,2],tends=[pd.Timestamp("2024-01-01"),pd.Timestamp("2024-02-01")])
+    syncq.markdone(1)
+    syncq.update([1,2,3],tends=[pd.Timestamp("2024-03-01"),pd.Timestamp("2024-02-01"),None])
+    assert syncq.next() == [2,3,1]
+
+
+def test_parked_target_retried_when_stale(tmp_path):
+    syncq=SyncQueue(str(tmp_path/"queue.sqlite"),maxfailures=3)
+    syncq.update([1,2])
+    for i in range(3):
+        syncq.markfailed(1)
+    syncq.update([1,2])
+    assert syncq.next() == [2]
+    syncq.update([1,2],stalebefore=datetime.now()+timedelta(days=60))
+    assert sorted(syncq.next()) == [1,2]
+
+
+def test_parked_target_retried_after_cooloff(tmp_path):
+    syncq=SyncQueue(str(tmp_path/"queue.sqlite"),maxfailures=1,cooloff=timedelta(days=1))
+    syncq.update([1])
+    syncq.markfailed(1)
+    assert syncq.next() == []
+    syncq.conn.execute("UPDATE queue SET lastattempt=?",((datetime.now(timezone.utc)-timedelta(days=2)).strftime("%Y-%m-%dT%H:%M:%S.%f"),))
+    assert syncq.next() == [1]
+
+
+def test_timezones_compared_in_utc(tmp_path):
+    syncq=SyncQueue(str(tmp_path/"queue.sqlite"))
+    syncq.update([1])
+    syncq.markdone(1)
+    #an aware time one hour ahead of now in another timezone is still later than the last synchronization
+    stale=pd.Timestamp.now(tz="UTC").tz_convert("Etc/GMT+10")+pd.Timedelta(hours=1)
+    syncq.update([1],stalebefore=stale)
+    assert syncq.next() == [1]
+    syncq.markdone(1)
+    syncq.update([1],stalebefore=stale-pd.Timedelta(hours=2))
+    assert syncq.next() == []
+
+
+def test_changed_targets_first(tmp_path):
+    syncq=SyncQueue(str(tmp_path/"queue.sqlite"))
+    syncq.update([1,2,3,4])
+    for day,target in enumerate([3,1,2,4]):
+        syncq.markdone(target)
+        syncq.conn.execute("UPDATE queue SET lastsync=? WHERE target = ?",((datetime.now(timezone.utc)-timedelta(days=10-day)).strftime("%Y-%m-%dT%H:%M:%S.%f"),target))
+    syncq.update([1,2,3,4],stalebefore=datetime.now()+timedelta(days=1))
+    #without changes the stalest target comes first
+    assert syncq.next() == [3,1,2,4]
+    assert syncq.applydiff([4,2],100.0)
+    assert syncq.next()[0:2] == [2,4]
+    status=syncq.status().set_index("target")
+    assert status.tendchanged[[2,4]].notna().all() and status.tendchanged[[1,3]].isna().all()
+
+
+def test_applydiff_once(tmp_path):
+    syncq=SyncQueue(str(tmp_path/"queue.sqlite"))
+    syncq.update([1,2])
+    syncq.markdone(1)
+    syncq.markdone(2)
+    assert syncq.applydiff([1],100.0)
+    syncq.markdone(1)
+    assert syncq.next() == []
+    #the same (or an older) difference is not applied again, also not after reopening the queue
+    assert not syncq.applydiff([1],100.0)
+    syncq.close()
+    syncq=SyncQueue(str(tmp_path/"queue.sqlite"))
+    assert not syncq.applydiff([1,2],99.0)
+    assert syncq.next() == []
+    #a newer difference is applied
+    assert syncq.applydiff([2],101.0)
+    assert syncq.next() == [2]
@@ -0,0 +1,33 @@
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+pytest.importorskip("geoslurp")
+pytest.importorskip("pyarrow")
+from pyaltim.geoslurp.types import ds2arrow,arrow2ds
+
+
+def test_roundtrip_datetime_axis():
+    time=pd.date_range("2020-01-01",periods=5,freq="10D")
+    ds=xr.Dataset(dict(water_level=("time",np.arange(5.0),dict(units="m")),wl_err=("time",np.full(5,0.1)),nobs=("time",np.arange(5))),
+            coords=dict(time=time),attrs=dict(source="test",target_name="lake"))
+    out=arrow2ds(ds2arrow(ds))
+    xr.testing.assert_identical(out,ds)
+    assert out.time.dtype.kind == "M"
+
+
+def test_roundtrip_string_axis_and_scalars():
+    ds=xr.Dataset(dict(water_level=("date",[1.0,np.nan,3.0])),coords=dict(date=["2020-01-01","2020-01-02","2020-01-03"],lon=12.5,tref=np.datetime64("2020-01-01T00:00:00","ns")),
+            attrs=dict(source="test"))
+    ds["height"]=xr.Variable((),np.float32(2.5),attrs=dict(units="m"))
+    out=arrow2ds(ds2arrow(ds,compression=None))
+    xr.testing.assert_identical(out,ds)
+    assert out.height.dtype == np.float32
+    assert "lon" in out.coords and "height" in out.data_vars
+
+
+def test_multidimensional_rejected():
+    ds=xr.Dataset(dict(water_level=(("time","station"),np.zeros((2,2)))))
+    with pytest.raises(ValueError):
+        ds2arrow(ds)